@@ -0,0 +1,301 @@
+"""
+Transcoding benchmark for the video encoder bot
+
+Generates deterministic clips with ffmpeg's lavfi sources, encodes them with
+the bot's own command builders across the preset x resolution x format
+matrix (and in batch mode), and records wall time, encode fps, CPU seconds,
+peak RSS and output size as JSON. With --loop-watchdog each clip is also
+encoded once through the bot's asyncio encode path under the event loop
+watchdog, so a change that blocks the loop shows up as a stall. Results can
+be compared with a stored baseline to flag regressions:
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import Config
+from encoders import ENCODERS
+from loopwatch import LoopWatchdog
+from probe import ProbeService
+from transcoder import (
+    QUALITY_PRESETS, RESOLUTION_PRESETS, SUPPORTED_FORMATS, available_formats, build_batch_command,
+    build_transcode_command, output_extension, transcode_file
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Synthetic video sources: smooth test pattern, detailed fractal, and
+# incompressible noise (fixed seed so every run encodes the same frames)
+SOURCES = {
+    'testsrc2': 'testsrc2=size={size}:rate={rate}',
+    'mandelbrot': 'mandelbrot=size={size}:rate={rate}',
+    'noise': 'color=c=gray:size={size}:rate={rate},noise=alls=60:allf=t+u:all_seed=42'
+}
+
+CLIP_RATE = 30
+
+# Result fields compared against the baseline; higher is worse for all of them
+COMPARED_FIELDS = ('wall', 'cpu_seconds', 'peak_rss_kb', 'output_size')
+
+def make_clip(directory: str, source: str, size: str, duration: int) -> str:
+    """Render a synthetic clip once; later runs reuse the file"""
+    path = os.path.join(directory, f"{source}-{size}-{duration}s.mp4")
+    if os.path.exists(path):
+        return path
+
+    video = SOURCES[source].format(size=size, rate=CLIP_RATE)
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', video,
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(duration), '-map', '0:v', '-map', '1:a',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '10', '-g', str(CLIP_RATE * 2),
+        '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '192k',
+        path
+    ], check=True)
+    return path
+
+def run_measured(cmd: List[str]) -> Dict[str, float]:
+    """Run an ffmpeg command to completion and collect its resource usage
+
+    os.wait4 reports the rusage of exactly this child, so CPU time and peak
+    RSS are not mixed up with the benchmark process or earlier runs.
+    """
+    cmd = [cmd[0], '-v', 'error', '-nostats'] + cmd[1:]
+
+    with tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"ffmpeg failed: {stderr.read().decode(errors='replace')[-2000:]}")
+
+    return {
+        'wall': wall,
+        'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+        'peak_rss_kb': rusage.ru_maxrss  # Kilobytes on Linux
+    }
+
+def measure(cmd: List[str], outputs: List[str], frames: int, repeat: int) -> Dict[str, Any]:
+    """Median of several runs of an encode command"""
+    runs = []
+    for _ in range(max(1, repeat)):
+        runs.append(run_measured(cmd))
+        missing = [path for path in outputs if not os.path.exists(path)]
+        if missing:
+            raise RuntimeError(f"ffmpeg exited cleanly without writing {', '.join(missing)}")
+        sizes = [os.path.getsize(path) for path in outputs]
+        for path in outputs:
+            os.remove(path)
+
+    wall = statistics.median(run['wall'] for run in runs)
+    return {
+        'wall': round(wall, 3),
+        'fps': round(frames * len(outputs) / wall, 2) if wall else 0.0,
+        'cpu_seconds': round(statistics.median(run['cpu_seconds'] for run in runs), 3),
+        'peak_rss_kb': max(run['peak_rss_kb'] for run in runs),
+        'output_size': sum(sizes),
+        'runs': len(runs)
+    }
+
+def ffmpeg_version() -> str:
+    try:
+        output = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, check=True).stdout
+        return output.splitlines()[0]
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_matrix(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Encode every clip across the requested matrix"""
+    os.makedirs(args.workdir, exist_ok=True)
+    watermark_text = None if args.no_watermark else Config.WATERMARK_TEXT
+    results = []
+
+    for source in args.sources:
+        for size in args.sizes:
+            for duration in args.durations:
+                clip = make_clip(args.workdir, source, size, duration)
+                info = asyncio.run(ProbeService().probe(clip))
+                frames = duration * CLIP_RATE
+                clip_id = os.path.splitext(os.path.basename(clip))[0]
+
+                for quality in args.presets:
+                    for resolution in args.resolutions:
+                        for format_type in args.formats:
+                            output = os.path.join(args.workdir, f"out.{output_extension(format_type)}")
+                            cmd = build_transcode_command(clip, output, resolution, quality, format_type,
+                                                          watermark_text=watermark_text, info=info,
+                                                          threads=args.threads)
+                            results.append(record(f"{clip_id}/{quality}/{resolution}/{format_type}",
+                                                  cmd, [output], frames, args.repeat))
+
+                    if args.batch:
+                        outputs = [
+                            (os.path.join(args.workdir, f"batch_{resolution}.mp4"), resolution, 'mp4')
+                            for resolution in args.resolutions
+                        ]
+                        cmd = build_batch_command(clip, outputs, quality, watermark_text=watermark_text,
+                                                  info=info, threads=args.threads)
+                        results.append(record(f"{clip_id}/{quality}/batch/mp4", cmd,
+                                              [path for path, _, _ in outputs], frames, args.repeat))
+
+                if args.loop_watchdog:
+                    results.append(record_loop(f"{clip_id}/loop", clip, info, args.resolutions[0],
+                                               watermark_text, args.loop_watchdog, args.workdir))
+
+    return results
+
+def record(case_id: str, cmd: List[str], outputs: List[str], frames: int, repeat: int) -> Dict[str, Any]:
+    try:
+        result = measure(cmd, outputs, frames, repeat)
+        logger.info(f"{case_id}: {result['wall']:.2f}s, {result['fps']:.1f} fps, "
+                    f"{result['cpu_seconds']:.2f} CPU-s, {result['peak_rss_kb'] / 1024:.0f} MB RSS")
+    except (RuntimeError, OSError) as e:
+        # OSError covers ffmpeg missing and outputs that vanish
+        logger.error(f"{case_id}: {e}")
+        result = {'error': str(e)}
+    for path in outputs:
+        if os.path.exists(path):
+            os.remove(path)
+    return {'id': case_id, **result}
+
+def record_loop(case_id: str, clip: str, info: Optional[Dict[str, Any]], resolution: str,
+                watermark_text: Optional[str], threshold: float, workdir: str) -> Dict[str, Any]:
+    """Encode through the bot's asyncio path and report how the event loop fared"""
+    output = os.path.join(workdir, 'loop.mp4')
+
+    async def on_progress(progress: Dict[str, Any]) -> None:
+        pass
+
+    async def run() -> Dict[str, Any]:
+        watchdog = LoopWatchdog(threshold)
+        watchdog.start()
+        try:
+            await transcode_file(clip, output, resolution, 'fast', 'mp4', watermark_text=watermark_text,
+                                 info=info, progress_callback=on_progress)
+        finally:
+            await watchdog.stop()
+        return {
+            'loop_max_lag': round(watchdog.max_lag, 4),
+            'loop_stalls': len(watchdog.stalls),
+            'loop_culprits': watchdog.culprits
+        }
+
+    try:
+        result = asyncio.run(run())
+        logger.info(f"{case_id}: max loop lag {result['loop_max_lag'] * 1000:.1f}ms, {result['loop_stalls']} stalls")
+    except Exception as e:
+        logger.error(f"{case_id}: {e}")
+        result = {'error': str(e)}
+    if os.path.exists(output):
+        os.remove(output)
+    return {'id': case_id, **result}
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any],
+            threshold: float) -> List[Tuple[str, str, float, float]]:
+    """Cases whose measurements grew by more than threshold relative to the baseline"""
+    previous = {case['id']: case for case in baseline['results']}
+    regressions = []
+
+    for case in results:
+        old = previous.get(case['id'])
+        if not old or 'error' in case or 'error' in old:
+            continue
+        for field in COMPARED_FIELDS:
+            if old.get(field) and field in case and case[field] > old[field] * (1 + threshold):
+                regressions.append((case['id'], field, old[field], case[field]))
+
+        # Any new stall of the event loop is a regression, however small the baseline
+        if case.get('loop_stalls', 0) > old.get('loop_stalls', 0):
+            regressions.append((case['id'], 'loop_stalls', old.get('loop_stalls', 0), case['loop_stalls']))
+
+    return regressions
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the bot's ffmpeg commands on synthetic clips")
+    parser.add_argument('--sources', nargs='+', choices=list(SOURCES), default=list(SOURCES))
+    parser.add_argument('--sizes', nargs='+', default=['1280x720', '1920x1080'], help="Clip sizes, WxH")
+    parser.add_argument('--durations', nargs='+', type=int, default=[10], help="Clip lengths in seconds")
+    parser.add_argument('--presets', nargs='+', choices=list(QUALITY_PRESETS), default=['ultrafast', 'fast', 'medium'])
+    parser.add_argument('--resolutions', nargs='+', choices=list(RESOLUTION_PRESETS), default=list(RESOLUTION_PRESETS))
+    parser.add_argument('--formats', nargs='+', choices=list(SUPPORTED_FORMATS), default=['mp4', 'webm'])
+    parser.add_argument('--no-batch', dest='batch', action='store_false', help="Skip the batch mode runs")
+    parser.add_argument('--no-watermark', action='store_true')
+    parser.add_argument('--threads', type=int, help="Thread limit passed to the command builders")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per case; the median is reported")
+    parser.add_argument('--workdir', default=os.path.join(Config.TEMP_DIR, 'benchmark'))
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Compare against a previous results file")
+    parser.add_argument('--loop-watchdog', type=float, metavar='SECONDS',
+                        help="Also run each clip through the asyncio encode path, counting event loop stalls longer than this")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Allowed growth before flagging (0.10 = 10%%)")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    asyncio.run(ENCODERS.detect())
+    missing = [format_type for format_type in args.formats if format_type not in available_formats()]
+    if missing:
+        logger.warning(f"Skipping formats this ffmpeg cannot encode: {', '.join(missing)}")
+        args.formats = [format_type for format_type in args.formats if format_type not in missing]
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(),
+            'ffmpeg': ffmpeg_version(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'watermark': not args.no_watermark,
+            'threads': args.threads,
+            'encoders': dict(ENCODERS.summary())
+        },
+        'results': run_matrix(args)
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('ffmpeg') != report['meta']['ffmpeg']:
+            logger.warning(f"Baseline was recorded with {baseline['meta'].get('ffmpeg')}")
+
+        regressions = compare(report['results'], baseline, args.threshold)
+        for case_id, field, old, new in regressions:
+            growth = f"+{(new / old - 1) * 100:.1f}%" if old else "new"
+            logger.warning(f"REGRESSION {case_id}: {field} {old} -> {new} ({growth})")
+        if regressions:
+            logger.error(f"{len(regressions)} regression(s) above {args.threshold * 100:.0f}%")
+            return 1
+        logger.info("No regressions against the baseline")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
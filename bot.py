@@ -1,15 +1,40 @@
 import asyncio
+import glob
 import os
-import subprocess
+import shutil
+import sys
 import uuid
 import time
 import logging
+from contextlib import contextmanager
 from datetime import datetime
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 from pyrogram.errors import FloodWait
-import psutil
-import json
+from transcoder import (
+    QUALITY_PRESETS, RESOLUTION_PRESETS, available_formats, output_extension,
+    build_ladder, estimate_output_size, transcode_file, transcode_renditions
+)
+from encoders import ENCODERS
+from utils import format_duration
+from config import Config
+from cpubudget import CpuBudget, available_cores
+from diskbudget import DiskBudget
+from janitor import ExpiryQueue, StorageJanitor
+from estimator import ProcessingEstimator
+from cache import RenditionCache
+from health_check import create_health_server
+from metrics import Registry, LoopLagMonitor
+from loopwatch import LoopWatchdog
+from sysmon import SystemMonitor, WINDOWS
+from progress import ProgressReporter
+from ingest import SpoolFile, is_streamable, stream_to_spool
+from probe import ProbeService
+from store import Store, SessionTable, JobTable, StatsTable, reconcile_storage
+from workqueue import EncodeQueue, DONE, FAILED, CANCELLED, to_storage_path
+from singleflight import SingleFlight
+from tracing import Tracer
+from scheduler import ChunkPool, JobScheduler, Job, ProcessingQueueView, PRIORITY_ADMIN, PRIORITY_SHORT, PRIORITY_NORMAL
 
 # Configure logging
 logging.basicConfig(
@@ -37,52 +62,296 @@ except (ValueError, TypeError) as e:
 app = Client("transcoder_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 # Create necessary directories
-for directory in ["downloads", "outputs", "temp"]:
+for directory in [Config.DOWNLOAD_DIR, Config.OUTPUT_DIR, Config.TEMP_DIR, Config.LOG_DIR, Config.CACHE_DIR]:
     os.makedirs(directory, exist_ok=True)
 
-# Memory-based session storage
-video_sessions = {}
-user_stats = {}
-processing_queue = {}
-
-# Supported formats and presets
-SUPPORTED_FORMATS = {
-    'mp4': 'MP4 (H.264)',
-    'mkv': 'MKV (H.264)',
-    'avi': 'AVI (H.264)',
-    'webm': 'WebM (VP9)',
-    'mov': 'MOV (H.264)'
-}
+# Persistent session, job and stats storage
+store = Store(Config.DATABASE_PATH, Config.DB_BUSY_TIMEOUT)
+video_sessions = SessionTable(store)
+user_stats = StatsTable(store)
+pending_jobs = JobTable(store)
+
+# Encodes handed to worker.py processes when ENCODE_QUEUE is enabled
+encode_queue = EncodeQueue(store)
+
+# Encode time predictions calibrated from finished jobs
+estimator = ProcessingEstimator(store, WATERMARK_TEXT)
+
+# Downloads still streaming into their spool file, by video_id
+ingests = {}
+
+# Downloads in progress by Telegram file_unique_id; the same file sent again
+# meanwhile is linked from the first download instead of being fetched twice
+downloads = {}
+
+# CPU, memory, disk and ffmpeg usage sampled in the background
+system_monitor = SystemMonitor(Config.DOWNLOAD_DIR, Config.SYSMON_INTERVAL)
+
+# Global worker pool; processing_queue is a user_id -> video_id view of its jobs.
+# Queued jobs are held back while the machine is short of memory.
+scheduler = JobScheduler(Config.MAX_CONCURRENT_PROCESSES, Config.PREEMPT_AFTER, Config.MAX_PREEMPTIONS,
+                         can_start=lambda: not memory_pressure())
+processing_queue = ProcessingQueueView(scheduler)
+
+# Single editor for every download, encode and upload progress message
+progress_reporter = ProgressReporter(Config.PROGRESS_INTERVAL, Config.PROGRESS_EDITS_PER_SECOND)
+
+# Single ffprobe implementation, memoised by Telegram file_unique_id
+probe_service = ProbeService(Config.MAX_CONCURRENT_PROBES, Config.PROBE_CACHE_SIZE)
+
+# Uploads to Telegram in flight across all jobs
+upload_slots = asyncio.Semaphore(Config.MAX_CONCURRENT_UPLOADS)
+
+# Encode slots shared by the chunks of all segmented jobs, as many as one
+# conversion's share of the cores so chunks do not crowd out the other slots
+chunk_pool = ChunkPool(len(available_cores(Config.CPU_CORES)) // Config.MAX_CONCURRENT_PROCESSES)
 
-QUALITY_PRESETS = {
-    'ultrafast': {'preset': 'ultrafast', 'crf': '28'},
-    'fast': {'preset': 'fast', 'crf': '23'},
-    'medium': {'preset': 'medium', 'crf': '20'},
-    'slow': {'preset': 'slow', 'crf': '18'},
-    'veryslow': {'preset': 'veryslow', 'crf': '15'}
+# Cores divided between every ffmpeg encode running in this process: one per
+# conversion slot plus one per chunk slot
+cpu_budget = CpuBudget(Config.CPU_CORES, pin=Config.CPU_AFFINITY,
+                       expected=Config.MAX_CONCURRENT_PROCESSES + chunk_pool.size)
+
+# Disk space reserved for downloads, outputs and segment chunks before they are written
+disk_budget = DiskBudget(Config.DISK_HEADROOM_BYTES)
+
+# Finished renditions keyed on the source file_unique_id and output settings
+rendition_cache = RenditionCache(Config.CACHE_DIR, Config.CACHE_MAX_BYTES, Config.CACHE_MIN_FREE_BYTES)
+
+# Single conversions in progress, keyed like the rendition cache, so identical requests share one encode
+conversions = SingleFlight()
+
+# Sessions whose source a shared encode is reading
+encoding_sources = set()
+
+# Sessions expire exactly SESSION_TIMEOUT after they were created
+session_expiry = ExpiryQueue()
+
+# Orphaned files in the scratch directories are swept in the background
+janitor = StorageJanitor([Config.DOWNLOAD_DIR, Config.OUTPUT_DIR, Config.TEMP_DIR],
+                         Config.JANITOR_MIN_AGE, Config.JANITOR_MAX_DELETIONS)
+
+# Per-video traces of every stage, written to LOG_DIR as JSON lines
+tracer = Tracer(os.path.join(Config.LOG_DIR, 'traces.jsonl'), Config.TRACE_FILE_MAX_BYTES,
+                Config.TRACE_FILE_BACKUPS, Config.TRACE_HISTORY)
+
+# Prometheus metrics served on /metrics next to /health
+metrics = Registry('encoder_')
+stage_latency = metrics.histogram('stage_duration_seconds', "Time spent in each pipeline stage", ['stage'])
+encode_fps = metrics.histogram('encode_fps', "Source frames per second of finished encodes",
+                               buckets=(1, 5, 10, 25, 50, 100, 200, 400, 800))
+encode_speed = metrics.histogram('encode_speed_factor', "Source seconds encoded per wall-clock second",
+                                 buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+active_encodes = metrics.gauge('active_encodes', "Encodes running here or waiting on encoder workers")
+bytes_in = metrics.counter('bytes_in_total', "Source bytes downloaded from Telegram")
+bytes_out = metrics.counter('bytes_out_total', "Rendition bytes uploaded to Telegram")
+metrics.callback('queued_jobs', "Conversions waiting for a worker slot", 'gauge', lambda: scheduler.queued_count)
+metrics.callback('running_jobs', "Conversions holding a worker slot", 'gauge', lambda: scheduler.running_count)
+metrics.callback('shared_conversions', "Single conversions in progress, each shared by all identical requests",
+                 'gauge', lambda: len(conversions))
+metrics.callback('system_cpu_percent', "CPU usage averaged over the window", 'gauge',
+                 lambda: {(f"{minutes}m",): value for minutes, value in system_monitor.averages('cpu').items()
+                          if value is not None}, ['window'])
+metrics.callback('system_cpu_core_percent', "CPU usage per core in the latest sample", 'gauge',
+                 lambda: {(str(core),): value for core, value in enumerate(latest_sample('per_core') or ())},
+                 ['core'])
+metrics.callback('system_memory_available_bytes', "Available memory", 'gauge',
+                 lambda: latest_sample('memory_available'))
+metrics.callback('system_disk_free_bytes', "Free space on the storage disk", 'gauge',
+                 lambda: latest_sample('disk_free'))
+metrics.callback('system_disk_read_bytes_per_second', "Disk read throughput", 'gauge',
+                 lambda: latest_sample('disk_read'))
+metrics.callback('system_disk_write_bytes_per_second', "Disk write throughput", 'gauge',
+                 lambda: latest_sample('disk_write'))
+metrics.callback('ffmpeg_rss_bytes', "Resident memory of running ffmpeg processes", 'gauge',
+                 lambda: latest_sample('ffmpeg_rss'))
+metrics.callback('janitor_removed_total', "Orphaned files and directories removed by the janitor",
+                 'counter', lambda: janitor.removed)
+metrics.callback('coalesced_conversions_total', "Conversions that joined an identical one in progress",
+                 'counter', lambda: conversions.coalesced)
+metrics.callback('encode_queue_jobs', "Jobs in the encoder worker queue by state", 'gauge',
+                 lambda: {(state,): count for state, count in encode_queue.counts().items()}, ['state'])
+metrics.callback('cache_lookups_total', "Cache lookups by cache and result", 'counter', lambda: {
+    ('rendition', 'hit'): rendition_cache.hits, ('rendition', 'miss'): rendition_cache.misses,
+    ('probe', 'hit'): probe_service.hits, ('probe', 'miss'): probe_service.misses
+}, ['cache', 'result'])
+metrics.callback('cache_hit_ratio', "Share of cache lookups that hit", 'gauge', lambda: {
+    ('rendition',): rendition_cache.hit_ratio,
+    ('probe',): probe_service.hits / max(1, probe_service.hits + probe_service.misses)
+}, ['cache'])
+metrics.callback('rendition_cache_bytes', "Bytes held by the rendition cache", 'gauge',
+                 lambda: rendition_cache.total_bytes)
+metrics.callback('disk_reserved_bytes', "Disk space reserved for files being written", 'gauge',
+                 lambda: disk_budget.reserved)
+metrics.callback('disk_waiting_reservations', "Downloads and encodes waiting for disk space", 'gauge',
+                 lambda: disk_budget.waiting)
+metrics.callback('flood_waits_total', "FloodWait errors hit while editing progress messages", 'counter',
+                 lambda: progress_reporter.flood_waits)
+loop_lag = metrics.histogram(
+    'event_loop_lag_seconds', "Delay of event loop wake-ups", buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+if Config.LOOP_WATCHDOG:
+    # Also logs the stack of whatever blocks the loop, and counts stalls per function
+    loop_monitor = LoopWatchdog(Config.LOOP_WATCHDOG_THRESHOLD, histogram=loop_lag)
+    metrics.callback('event_loop_stalls_total', "Event loop stalls over the watchdog threshold, by blocking function",
+                     'counter', lambda: {(culprit,): count for culprit, count in loop_monitor.culprits.items()},
+                     ['function'])
+else:
+    loop_monitor = LoopLagMonitor(histogram=loop_lag)
+metrics.callback('event_loop_lag_last_seconds', "Most recent event loop lag sample", 'gauge',
+                 lambda: loop_monitor.lag)
+
+BATCH_CONFIGS = {
+    'all': [('240p', 'mp4'), ('360p', 'mp4'), ('480p', 'mp4'), ('720p', 'mp4'), ('1080p', 'mp4')],
+    'mobile': [('240p', 'mp4'), ('360p', 'mp4')],
+    'hd': [('720p', 'mp4'), ('1080p', 'mp4')]
 }
 
-RESOLUTION_PRESETS = {
-    '240p': {'height': 240, 'bitrate': '400k'},
-    '360p': {'height': 360, 'bitrate': '800k'},
-    '480p': {'height': 480, 'bitrate': '1200k'},
-    '720p': {'height': 720, 'bitrate': '2500k'},
-    '1080p': {'height': 1080, 'bitrate': '5000k'}
+BATCH_LABELS = {
+    'all': "All Resolutions",
+    'mobile': "Mobile Pack",
+    'hd': "HD Pack"
 }
 
+# Seconds before an expired session that is still in use is checked again
+BUSY_SESSION_RECHECK = 60
+
+def latest_sample(field):
+    """A field of the latest system sample; no metric sample before the first one"""
+    sample = system_monitor.latest
+    return getattr(sample, field) if sample else {}
+
 def get_system_stats():
-    """Get current system resource usage"""
-    cpu_percent = psutil.cpu_percent(interval=1)
-    memory = psutil.virtual_memory()
-    disk = psutil.disk_usage('/')
+    """Current system resource usage, read from the background sampler"""
+    sample = system_monitor.latest
+    if sample is None:
+        return None
     
     return {
-        'cpu': cpu_percent,
-        'memory_used': memory.percent,
-        'memory_available': memory.available // (1024**3),  # GB
-        'disk_free': disk.free // (1024**3)  # GB
+        'cpu': sample.cpu,
+        'cpu_averages': system_monitor.averages('cpu'),
+        'per_core': sample.per_core,
+        'memory_used': sample.memory_used,
+        'memory_available': sample.memory_available,
+        'disk_free': sample.disk_free,
+        'disk_read': system_monitor.average('disk_read', 1),
+        'disk_write': system_monitor.average('disk_write', 1),
+        'ffmpeg_rss': sample.ffmpeg_rss
     }
 
+def memory_pressure():
+    """Whether available memory is below ADMISSION_MIN_MEMORY"""
+    sample = system_monitor.latest
+    return bool(sample and Config.ADMISSION_MIN_MEMORY and sample.memory_available < Config.ADMISSION_MIN_MEMORY)
+
+def overload_reason():
+    """Why new conversions should be turned away right now, if they should"""
+    cpu = system_monitor.average('cpu', 1)
+    if Config.ADMISSION_MAX_CPU and cpu is not None and cpu >= Config.ADMISSION_MAX_CPU and scheduler.queued_count:
+        return f"the server is busy (CPU {cpu:.0f}%)"
+    if memory_pressure() and scheduler.running_count:
+        return "the server is low on memory"
+    return None
+
+def health_status():
+    """Health report for /health; degraded while the bot should shed load"""
+    problems = []
+    
+    if scheduler.queued_count >= Config.HEALTH_MAX_QUEUE:
+        problems.append(f"queue saturated ({scheduler.queued_count} jobs waiting)")
+    
+    disk_free = shutil.disk_usage(Config.STORAGE_DIR or '.').free - disk_budget.outstanding()
+    if disk_free < Config.CACHE_MIN_FREE_BYTES or disk_budget.waiting:
+        problems.append(f"low disk space ({format_file_size(disk_free)} free)")
+    
+    if loop_monitor.lag > Config.HEALTH_MAX_LOOP_LAG:
+        problems.append(f"event loop lagging ({loop_monitor.lag:.1f}s)")
+    
+    if memory_pressure():
+        problems.append(f"low memory ({format_file_size(system_monitor.latest.memory_available)} available)")
+    
+    return {
+        'status': 'degraded' if problems else 'healthy',
+        'problems': problems,
+        'queued_jobs': scheduler.queued_count,
+        'running_jobs': scheduler.running_count,
+        'disk_free': disk_free
+    }
+
+def record_encode_rate(info, seconds):
+    """Observe the fps and speed factor of a finished encode"""
+    duration = info.get('duration') if info else 0
+    if not duration or seconds <= 0:
+        return
+    encode_speed.observe(duration / seconds)
+    encode_fps.observe(duration * (info.get('fps') or 30) / seconds)
+
+@contextmanager
+def stage(name, trace=None, **attrs):
+    """Time a pipeline stage in the latency histogram and as a span of the job's trace"""
+    with stage_latency.time(stage=name), tracer.span(name, trace, **attrs) as span:
+        yield span
+
+def record_stage(trace, name, started, **attrs):
+    """Account for a stage timed by hand, started being a time.time() value"""
+    stage_latency.observe(time.time() - started, stage=name)
+    if trace:
+        trace.record(name, started, **attrs)
+
+def traced_progress(span, progress_callback=None):
+    """Sample ffmpeg's fps and speed into an encode span on the way to progress_callback"""
+    async def callback(progress):
+        if span and not progress['done']:
+            span.sample(fps=progress['fps'], speed=progress['speed'], percent=progress['percent'])
+        if progress_callback:
+            await progress_callback(progress)
+
+    return callback
+
+def notify_on(message):
+    """Status callback that edits message right away"""
+    return lambda text: progress_reporter.edit_now(message, text)
+
+async def reserve_disk(notify, files):
+    """Reserve disk space for files {path: bytes}, telling the user while the disk is full"""
+    await disk_budget.reserve(
+        files,
+        on_wait=lambda: notify("💾 Disk is full, waiting for space..."),
+        timeout=Config.DISK_WAIT_TIMEOUT or None
+    )
+
+def output_reservation(session, outputs, segmented=False):
+    """Disk space to reserve before encoding outputs [(path, resolution, format), ...]"""
+    info = session['info']
+    files = {
+        path: estimate_output_size(info, resolution, format_type, WATERMARK_TEXT, session['original_size'])
+        for path, resolution, format_type in outputs
+    }
+    
+    # Segmented encodes hold every chunk in TEMP_DIR until they are joined
+    if segmented and is_segmented(info):
+        for path, size in list(files.items()):
+            files[chunk_workdir(path)] = size
+    
+    return files
+
+def is_segmented(info):
+    """Whether this process encodes the source in parallel chunks"""
+    return bool(not Config.ENCODE_QUEUE and Config.SEGMENT_MIN_DURATION and info
+                and info['duration'] >= Config.SEGMENT_MIN_DURATION)
+
+def chunk_workdir(output_file):
+    """Fixed chunk directory of a segmented encode, so a paused encode can resume"""
+    return os.path.join(Config.TEMP_DIR, os.path.basename(output_file) + '.chunks')
+
+def has_finished_chunks(workdir):
+    """Whether an earlier run of a resumable encode left encoded chunks in workdir"""
+    return bool(workdir and glob.glob(os.path.join(glob.escape(workdir), 'enc_[0-9][0-9][0-9][0-9].mkv')))
+
+def discard_chunks(video_id):
+    """Remove chunks kept for resuming any encode of the video"""
+    for workdir in glob.glob(os.path.join(Config.TEMP_DIR, f"{glob.escape(video_id)}_*.chunks")):
+        shutil.rmtree(workdir, ignore_errors=True)
+
 def format_file_size(size_bytes):
     """Convert bytes to human readable format"""
     if size_bytes == 0:
@@ -94,47 +363,18 @@ def format_file_size(size_bytes):
         i += 1
     return f"{size_bytes:.1f}{size_names[i]}"
 
-def get_video_info(file_path):
-    """Extract video information using ffprobe"""
-    try:
-        cmd = [
-            'ffprobe', '-v', 'quiet', '-print_format', 'json',
-            '-show_format', '-show_streams', file_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            video_stream = next((s for s in data['streams'] if s['codec_type'] == 'video'), None)
-            
-            if video_stream:
-                return {
-                    'duration': float(data['format'].get('duration', 0)),
-                    'width': int(video_stream.get('width', 0)),
-                    'height': int(video_stream.get('height', 0)),
-                    'codec': video_stream.get('codec_name', 'unknown'),
-                    'bitrate': int(data['format'].get('bit_rate', 0)),
-                    'fps': eval(video_stream.get('r_frame_rate', '0/1'))
-                }
-    except Exception as e:
-        logger.error(f"Error getting video info: {e}")
-    
-    return None
+async def update_user_stats(user_id, action, size=0):
+    """Update user statistics (written to the database in batches)"""
+    user_stats.record(user_id, action, size)
 
-async def update_user_stats(user_id, action):
-    """Update user statistics"""
-    if user_id not in user_stats:
-        user_stats[user_id] = {
-            'videos_processed': 0,
-            'total_size_processed': 0,
-            'first_use': datetime.now().isoformat(),
-            'last_use': datetime.now().isoformat()
-        }
-    
-    user_stats[user_id]['last_use'] = datetime.now().isoformat()
-    
-    if action == 'video_processed':
-        user_stats[user_id]['videos_processed'] += 1
+async def flush_user_stats():
+    """Write batched user statistics periodically"""
+    while True:
+        await asyncio.sleep(Config.STATS_FLUSH_INTERVAL)
+        try:
+            user_stats.flush()
+        except Exception as e:
+            logger.error(f"Stats flush error: {e}")
 
 @app.on_message(filters.command("start"))
 async def start(client, message):
@@ -233,7 +473,7 @@ async def stats_command(client, message):
 async def formats_command(client, message):
     formats_text = "📋 **Supported Output Formats:**\n\n"
     
-    for ext, desc in SUPPORTED_FORMATS.items():
+    for ext, desc in available_formats().items():
         formats_text += f"• **{ext.upper()}** - {desc}\n"
     
     formats_text += "\n🎯 **Available Resolutions:**\n"
@@ -245,25 +485,51 @@ async def formats_command(client, message):
 @app.on_message(filters.command("admin") & filters.user(ADMIN_IDS))
 async def admin_panel(client, message):
     system_stats = get_system_stats()
-    total_users = len(user_stats)
-    total_videos = sum(stats.get('videos_processed', 0) for stats in user_stats.values())
-    active_processes = len(processing_queue)
+    if system_stats:
+        averages = ' | '.join(f"{minutes}m {system_stats['cpu_averages'][minutes]:.0f}%" for minutes in WINDOWS)
+        system_text = f"""🖥️ CPU Usage: {system_stats['cpu']:.1f}% ({averages})
+🧩 Cores: {' '.join(f"{core:.0f}" for core in system_stats['per_core'])}
+💾 Memory Usage: {system_stats['memory_used']:.1f}% ({format_file_size(system_stats['memory_available'])} available)
+💿 Free Disk Space: {format_file_size(system_stats['disk_free'])}
+📀 Disk I/O: {format_file_size(system_stats['disk_read'])}/s read | {format_file_size(system_stats['disk_write'])}/s write
+🎞️ ffmpeg memory: {format_file_size(system_stats['ffmpeg_rss'])}"""
+    else:
+        system_text = "⏳ Collecting the first sample..."
+    totals = user_stats.totals()
+    total_users = totals['users']
+    total_videos = totals['videos']
+    active_processes = scheduler.running_count
     
     admin_text = f"""
 🔧 **Admin Panel**
 
 **System Status:**
-🖥️ CPU Usage: {system_stats['cpu']:.1f}%
-💾 Memory Usage: {system_stats['memory_used']:.1f}%
-💿 Free Disk Space: {system_stats['disk_free']}GB
+{system_text}
 
 **Bot Statistics:**
 👥 Total Users: {total_users}
 🎬 Total Videos Processed: {total_videos}
 ⚙️ Active Processes: {active_processes}
+🧮 ffmpeg encoders: {cpu_budget.active} on {len(cpu_budget.cores)} cores
+🎯 Calibrated estimate buckets: {estimator.calibrated_buckets()}
 
 **Queue Status:**
-📋 Videos in queue: {len(processing_queue)}
+📋 Videos in queue: {scheduler.queued_count}
+👥 Users with jobs: {len(processing_queue)}
+🛑 Use /cancel to list or stop conversions
+🐢 Use /slowjobs to see the slowest recent jobs by stage
+
+**Rendition Cache:**
+♻️ Hits: {rendition_cache.hits} | Misses: {rendition_cache.misses} ({rendition_cache.hit_ratio * 100:.1f}% hit ratio)
+📦 Cached: {format_file_size(rendition_cache.total_bytes)}
+    """
+    
+    if Config.ENCODE_QUEUE:
+        encode_counts = encode_queue.counts()
+        admin_text += f"""
+**Encoder Workers:**
+🏭 Active workers: {len(encode_queue.workers())}
+📋 Queued: {encode_counts.get('queued', 0)} | ⚙️ Encoding: {encode_counts.get('leased', 0)}
     """
     
     buttons = [
@@ -274,150 +540,477 @@ async def admin_panel(client, message):
     
     await message.reply(admin_text, reply_markup=InlineKeyboardMarkup(buttons))
 
+@app.on_message(filters.command("cancel") & filters.user(ADMIN_IDS))
+async def cancel_command(client, message):
+    """List conversions, or cancel one by job or video id"""
+    if len(message.command) < 2:
+        jobs = scheduler.jobs()
+        if not jobs:
+            await message.reply("📭 No conversions are queued or running.")
+            return
+        lines = [
+            f"`{job.job_id}` {job.state} - user {job.user_id}, ~{format_duration(job.remaining())} left"
+            for job in jobs
+        ]
+        await message.reply("📋 **Conversions:**\n" + "\n".join(lines) + "\n\nUse /cancel <job> to stop one.")
+        return
+    
+    target = message.command[1]
+    job = scheduler.get(target) or scheduler.find_by_video(target)
+    if not job:
+        await message.reply(f"❌ No queued or running job {target}")
+        return
+    
+    # A queued job's menu is restored on the user's own progress message
+    progress_message = None
+    pending = pending_jobs.get(job.video_id)
+    if pending and job.state == 'queued':
+        try:
+            progress_message = await app.get_messages(pending['chat_id'], pending['message_id'])
+        except Exception as e:
+            logger.warning(f"Could not load the message of job {job.job_id}: {e}")
+    
+    if await cancel_job(job, progress_message):
+        await message.reply(f"🛑 Cancelled job {job.job_id} of user {job.user_id}")
+    else:
+        await message.reply(f"❌ Job {job.job_id} has already finished")
+
+# Stages in pipeline order for the slowest jobs breakdown; others follow by name
+TRACE_STAGES = ('queue_wait', 'download', 'probe', 'encode', 'shared_encode', 'encode_wait', 'upload', 'cleanup')
+
+@app.on_message(filters.command("slowjobs") & filters.user(ADMIN_IDS))
+async def slow_jobs_command(client, message):
+    """Show the slowest recently finished jobs broken down by stage"""
+    try:
+        count = min(20, max(1, int(message.command[1]))) if len(message.command) > 1 else 5
+    except ValueError:
+        await message.reply("❌ Usage: /slowjobs [count]")
+        return
+
+    slowest = tracer.slowest(count)
+    if not slowest:
+        await message.reply("📭 No traced jobs have finished yet.")
+        return
+
+    lines = [f"🐢 **Slowest of the last {len(tracer.recent)} jobs** (full spans in traces.jsonl)\n"]
+    for n, trace in enumerate(slowest, 1):
+        stages = trace['stages']
+        names = [name for name in TRACE_STAGES if name in stages]
+        names += sorted(name for name in stages if name not in TRACE_STAGES)
+        breakdown = ' | '.join(f"{name.replace('_', ' ')} {stages[name]:.1f}s" for name in names)
+
+        lines.append(f"{n}. `{trace['trace_id'][:12]}` {trace['action']} - user {trace['attrs'].get('user_id')}, "
+                     f"{trace['outcome']}")
+        lines.append(f"⏱️ {trace['duration']:.1f}s: {breakdown}")
+        if trace['fps'] is not None:
+            lines.append(f"🎞️ {trace['fps']:.1f} fps | ⚡ {trace['speed'] or 0:.2f}x")
+        lines.append("")
+
+    await message.reply("\n".join(lines))
+
 @app.on_message(filters.video | filters.document)
 async def handle_video(client, message):
     user_id = message.from_user.id
     
     # Check file size
-    file_size = message.video.file_size if message.video else message.document.file_size
+    media = message.video or message.document
+    file_size = media.file_size
     if file_size > MAX_FILE_SIZE:
         await message.reply(f"❌ File too large! Max size: {format_file_size(MAX_FILE_SIZE)}")
         return
     
-    # Check if user has active processing
-    if user_id in processing_queue:
-        await message.reply("⏳ You already have a video being processed. Please wait for it to complete.")
+    # Check if user has too many queued or running jobs
+    if len(scheduler.jobs_for_user(user_id)) >= Config.MAX_JOBS_PER_USER:
+        await message.reply("⏳ You already have videos being processed. Please wait for them to complete.")
+        return
+    
+    # Generate unique ID and path
+    video_id = str(uuid.uuid4())
+    file_extension = message.video.file_name.split('.')[-1] if message.video and message.video.file_name else 'mp4'
+    video_path = os.path.join(Config.DOWNLOAD_DIR, f"{video_id}.{file_extension}")
+    
+    session = {
+        'path': video_path,
+        'user_id': user_id,
+        'original_size': file_size,
+        'info': None,
+        'timestamp': time.time(),
+        'file_unique_id': media.file_unique_id,
+        'chat_id': message.chat.id,
+        'message_id': message.id,
+        'downloaded': False
+    }
+    trace = tracer.begin(video_id, user_id=user_id, size=file_size)
+    
+    # Sources we already hold renditions of are only downloaded on a cache miss
+    if rendition_cache.has_source(media.file_unique_id):
+        session['info'] = (rendition_cache.source_info(media.file_unique_id)
+                           or probe_service.get_cached(media.file_unique_id))
+        add_session(video_id, session)
+        await show_video_options(message, video_id)
         return
     
     msg = await message.reply("⬇️ Downloading video... 0%")
+    download_task = None
     
     try:
-        # Generate unique ID and path
-        video_id = str(uuid.uuid4())
-        file_extension = message.video.file_name.split('.')[-1] if message.video and message.video.file_name else 'mp4'
-        video_path = f"downloads/{video_id}.{file_extension}"
-        
-        # Download with progress
-        start_time = time.time()
-        
-        def progress_callback(current, total):
-            percent = (current / total) * 100
-            if time.time() - start_time > 2:  # Update every 2 seconds
-                asyncio.create_task(msg.edit(f"⬇️ Downloading video... {percent:.1f}%"))
+        download_start = time.time()
+        shared = await join_download(notify_on(msg), media.file_unique_id, video_path)
+        if not shared:
+            await reserve_disk(notify_on(msg), {video_path: file_size})
+            
+            # Download with progress
+            def progress_callback(current, total):
+                percent = (current / total) * 100
+                progress_reporter.update(msg, f"⬇️ Downloading video... {percent:.1f}%")
+            
+            if Config.STREAMING_INGEST:
+                spool = SpoolFile(video_path)
+                download_task = asyncio.create_task(stream_to_spool(client, message, spool, progress_callback))
+                track_download(media.file_unique_id, video_path, download_task)
+                
+                # Streamable containers are probed and offered while still downloading
+                if is_streamable(await spool.head()):
+                    with stage('probe', trace, streaming=True):
+                        session['info'] = await probe_service.probe_stream(spool, cache_key=media.file_unique_id)
+                    add_session(video_id, session)
+                    ingests[video_id] = {'spool': spool, 'task': download_task, 'started': download_start}
+                    asyncio.create_task(finish_ingest(video_id, msg))
+                    await show_video_options(message, video_id)
+                    return
+            else:
+                download_task = asyncio.create_task(message.download(file_name=video_path, progress=progress_callback))
+                track_download(media.file_unique_id, video_path, download_task)
+            
+            # Otherwise (e.g. MP4 with the moov atom at the end) wait for the whole file
+            await download_task
+            bytes_in.inc(file_size)
         
-        await message.download(file_name=video_path, progress=progress_callback)
+        record_stage(trace, 'download', download_start, shared=shared)
         
         # Get video information
-        video_info = get_video_info(video_path)
-        
-        video_sessions[video_id] = {
-            'path': video_path,
-            'user_id': user_id,
-            'original_size': file_size,
-            'info': video_info,
-            'timestamp': time.time()
-        }
-        
-        await msg.edit("✅ Download complete! Analyzing video...")
-        
-        # Show video info and options
-        info_text = "📹 **Video Information:**\n"
-        if video_info:
-            info_text += f"📐 Resolution: {video_info['width']}x{video_info['height']}\n"
-            info_text += f"⏱️ Duration: {video_info['duration']:.1f}s\n"
-            info_text += f"🎞️ Codec: {video_info['codec']}\n"
-            info_text += f"📊 Bitrate: {format_file_size(video_info['bitrate']//8)}/s\n"
-            info_text += f"🎬 FPS: {video_info['fps']:.1f}\n"
-        
-        info_text += f"📦 File Size: {format_file_size(file_size)}\n\n"
-        info_text += "🎯 Choose conversion options:"
-        
-        buttons = [
-            [InlineKeyboardButton("🎬 Quick Convert", callback_data=f"quick|{video_id}")],
-            [InlineKeyboardButton("⚙️ Advanced Options", callback_data=f"advanced|{video_id}")],
-            [InlineKeyboardButton("📋 Batch Convert", callback_data=f"batch|{video_id}")]
-        ]
+        with stage('probe', trace):
+            session['info'] = await probe_service.probe(video_path, cache_key=media.file_unique_id)
+        session['downloaded'] = True
+        add_session(video_id, session)
         
-        await message.reply(info_text, reply_markup=InlineKeyboardMarkup(buttons))
+        await progress_reporter.edit_now(msg, "✅ Download complete! Analyzing video...")
+        await show_video_options(message, video_id)
         
     except Exception as e:
         logger.error(f"Error handling video: {e}")
-        await msg.edit(f"❌ Error downloading video: {str(e)}")
+        await progress_reporter.edit_now(msg, f"❌ Error downloading video: {str(e)}")
+        if download_task and not download_task.done():
+            download_task.cancel()
         if video_id in video_sessions:
             cleanup_session(video_id)
+        else:
+            if os.path.exists(video_path):
+                os.remove(video_path)
+            disk_budget.release(video_path)
+            tracer.finish(video_id)
+
+async def finish_ingest(video_id, msg):
+    """Wait for a streamed download to land and finalise its session"""
+    ingest = ingests[video_id]
+    
+    try:
+        await ingest['task']
+    except asyncio.CancelledError:
+        return
+    except Exception as e:
+        logger.error(f"Streaming download failed: {e}")
+        await progress_reporter.edit_now(msg, f"❌ Error downloading video: {str(e)}")
+        cleanup_session(video_id)
+        return
+    finally:
+        ingests.pop(video_id, None)
+    
+    session = video_sessions.get(video_id)
+    if session is None:
+        return
+    
+    session['downloaded'] = True
+    trace = tracer.get(video_id)
+    record_stage(trace, 'download', ingest['started'], streaming=True)
+    bytes_in.inc(session['original_size'])
+    
+    # The piped probe may lack the duration and never measures keyframes; a
+    # failed refresh keeps what it did find
+    with stage('probe', trace):
+        info = await probe_service.probe(session['path'], cache_key=session['file_unique_id'], refresh=True)
+    if info:
+        session['info'] = info
+    video_sessions.save(video_id)
+    
+    await progress_reporter.edit_now(msg, "✅ Download complete!")
+
+async def show_video_options(message, video_id):
+    """Reply with the video's information and the conversion menu"""
+    session = video_sessions[video_id]
+    video_info = session['info']
+    file_size = session['original_size']
+    
+    # Show video info and options
+    info_text = "📹 **Video Information:**\n"
+    if video_info:
+        info_text += f"📐 Resolution: {video_info['width']}x{video_info['height']}\n"
+        info_text += f"⏱️ Duration: {video_info['duration']:.1f}s\n"
+        info_text += f"🎞️ Codec: {video_info['codec']}"
+        if video_info.get('pix_fmt'):
+            info_text += f" ({video_info['pix_fmt']})"
+        info_text += "\n"
+        info_text += f"📊 Bitrate: {format_file_size(video_info['bitrate']//8)}/s\n"
+        info_text += f"🎬 FPS: {video_info['fps']:.1f}\n"
+    
+    info_text += f"📦 File Size: {format_file_size(file_size)}\n\n"
+    info_text += "🎯 Choose conversion options:"
+    
+    await message.reply(info_text, reply_markup=video_options_markup(video_id))
+
+def video_options_markup(video_id):
+    """Top-level conversion menu of a video"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🎬 Quick Convert", callback_data=f"quick|{video_id}")],
+        [InlineKeyboardButton("⚙️ Advanced Options", callback_data=f"advanced|{video_id}")],
+        [InlineKeyboardButton("📋 Batch Convert", callback_data=f"batch|{video_id}")]
+    ])
 
-def cleanup_session(video_id):
-    """Clean up session files and data"""
+def cancel_markup(video_id):
+    """Cancel button shown on queued and progress messages of a conversion"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🛑 Cancel", callback_data=f"cancel|{video_id}")]])
+
+def add_session(video_id, session):
+    """Store a new session and schedule its expiry"""
+    video_sessions[video_id] = session
+    session_expiry.schedule(video_id, session['timestamp'] + Config.SESSION_TIMEOUT)
+
+def session_in_use(video_id):
+    """Whether a download, job or shared encode still needs the session"""
+    return bool(video_id in ingests or video_id in encoding_sources or scheduler.find_by_video(video_id))
+
+async def expire_session(video_id):
+    """Drop a session whose time is up, unless it is still in use"""
+    if video_id not in video_sessions:
+        return None
+    if session_in_use(video_id):
+        return time.time() + BUSY_SESSION_RECHECK
+    logger.info(f"Session {video_id} expired")
+    cleanup_session(video_id)
+    return None
+
+def cleanup_session(video_id, finish_trace=True):
+    """Clean up session files and data
+    
+    Also finishes the video's trace, unless the caller times the cleanup as a
+    stage of it and finishes the trace itself afterwards.
+    """
+    session_expiry.cancel(video_id)
+    ingest = ingests.pop(video_id, None)
+    if ingest and not ingest['task'].done():
+        ingest['task'].cancel()
+    
     if video_id in video_sessions:
         session = video_sessions[video_id]
         if os.path.exists(session['path']):
             os.remove(session['path'])
+        disk_budget.release(session['path'])
         del video_sessions[video_id]
     
-    # Remove from processing queue
-    for user_id, vid_id in list(processing_queue.items()):
-        if vid_id == video_id:
-            del processing_queue[user_id]
+    discard_chunks(video_id)
+    if finish_trace:
+        tracer.finish(video_id)
+
+def make_encode_progress(message, label):
+    """Build a progress callback that reports live ffmpeg progress on message"""
+    async def callback(progress):
+        if progress['done']:
+            return
+
+        text = f"⚙️ Encoding {label}..."
+        if progress['percent'] is not None:
+            text += f" {progress['percent']:.1f}%"
+        text += f"\n🎞️ {progress['fps']:.1f} fps | ⚡ {progress['speed']:.2f}x"
+        text += f"\n📦 {format_file_size(progress['total_size'])}"
+        if progress['eta'] is not None:
+            text += f" | ⏳ ETA {format_duration(progress['eta'])}"
+
+        progress_reporter.update(message, text)
 
-async def transcode_video(input_file, output_file, resolution, quality_preset, format_type, watermark=True, progress_callback=None):
-    """Advanced video transcoding with progress tracking"""
+    return callback
+
+def make_upload_progress(message, label):
+    """Build a Pyrogram upload progress callback that reports on message"""
+    def callback(current, total):
+        if total:
+            progress_reporter.update(message, f"⬆️ Uploading {label}... {current / total * 100:.1f}%")
+
+    return callback
+
+async def wait_for_spool(spool):
+    """Wait until a streaming download has fully landed on disk"""
+    if spool and not spool.done:
+        await spool.wait_for(float('inf'))
+    if spool and spool.error:
+        raise Exception(f"Download failed: {spool.error}")
+
+async def run_on_worker(kind, payload, progress_callback=None):
+    """Hand an encode to the worker queue and wait for it, relaying its progress
+    
+    Queue calls contend with the workers for the database lock, so they run
+    off the event loop.
+    """
+    job_id = await asyncio.to_thread(encode_queue.enqueue, kind, payload, Config.ENCODE_MAX_ATTEMPTS)
+    last_progress = None
+    
     try:
-        # Build ffmpeg command
-        cmd = ['ffmpeg', '-i', input_file, '-y']
-        
-        # Video filters
-        filters = []
-        
-        # Resolution scaling
-        if resolution in RESOLUTION_PRESETS:
-            height = RESOLUTION_PRESETS[resolution]['height']
-            filters.append(f"scale=-2:{height}")
-        
-        # Watermark
-        if watermark and WATERMARK_TEXT:
-            watermark_filter = f"drawtext=text='{WATERMARK_TEXT}':fontcolor=white:fontsize=24:x=10:y=10:enable='between(t,0,999999)'"
-            filters.append(watermark_filter)
-        
-        if filters:
-            cmd.extend(['-vf', ','.join(filters)])
-        
-        # Quality settings
-        if quality_preset in QUALITY_PRESETS:
-            preset_settings = QUALITY_PRESETS[quality_preset]
-            cmd.extend(['-preset', preset_settings['preset']])
-            cmd.extend(['-crf', preset_settings['crf']])
-        
-        # Codec settings based on format
-        if format_type == 'webm':
-            cmd.extend(['-c:v', 'libvpx-vp9', '-c:a', 'libopus'])
-        else:
-            cmd.extend(['-c:v', 'libx264', '-c:a', 'aac'])
+        while True:
+            await asyncio.sleep(Config.WORKER_POLL_INTERVAL)
+            job = await asyncio.to_thread(encode_queue.get, job_id)
+            
+            if job is None or job['state'] == CANCELLED:
+                raise Exception("Encode job was withdrawn")
+            if job['state'] in (DONE, FAILED):
+                await asyncio.to_thread(encode_queue.remove, job_id)
+                if job['state'] == FAILED:
+                    raise Exception(job['error'] or "Encoder worker failed")
+                return
+            
+            if progress_callback and job['progress'] and job['progress'] != last_progress:
+                last_progress = job['progress']
+                await progress_callback(last_progress)
+    
+    except asyncio.CancelledError:
+        await asyncio.to_thread(encode_queue.cancel, job_id)
+        raise
+    
+    finally:
+        # The worker has recorded its timing for the estimator
+        await asyncio.to_thread(estimator.reload)
+
+async def transcode_video(input_file, output_file, resolution, quality_preset, format_type, watermark=True, progress_callback=None, info=None, spool=None, workdir=None):
+    """Advanced video transcoding with progress tracking
+    
+    When the probed info is given, streams that already match the target are
+    stream-copied and no-op scaling is skipped. Long sources that need a video
+    encode are split into chunks encoded in parallel; with a fixed workdir the
+    chunks survive cancellation so the encode can resume. A spool that is still
+    downloading is piped into ffmpeg as it arrives. With ENCODE_QUEUE enabled
+    the encode runs on an encoder worker instead.
+    """
+    active_encodes.inc()
+    encode_start = time.monotonic()
+    encode_span = tracer.open('encode', resolution=resolution, format=format_type, quality=quality_preset,
+                              worker=Config.ENCODE_QUEUE)
+    progress_callback = traced_progress(encode_span, progress_callback)
+    try:
+        watermark_text = WATERMARK_TEXT if watermark else None
         
-        # Bitrate settings
-        if resolution in RESOLUTION_PRESETS:
-            cmd.extend(['-b:v', RESOLUTION_PRESETS[resolution]['bitrate']])
+        if Config.ENCODE_QUEUE:
+            await wait_for_spool(spool)
+            await run_on_worker('single', {
+                'input': to_storage_path(input_file, Config.STORAGE_DIR),
+                'output': to_storage_path(output_file, Config.STORAGE_DIR),
+                'resolution': resolution,
+                'quality': quality_preset,
+                'format': format_type,
+                'watermark_text': watermark_text,
+                'info': info
+            }, progress_callback)
+            return True
         
-        cmd.extend(['-b:a', '128k'])
-        cmd.append(output_file)
+        input_stream = None
+        if spool and not spool.done:
+            input_file, input_stream = 'pipe:0', spool.follow()
         
-        # Execute with progress tracking
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True
+        # A resumed encode only does what its earlier runs left over
+        resumed = has_finished_chunks(workdir)
+        start_time = time.time()
+        concurrent = scheduler.running_count
+        await transcode_file(
+            input_file, output_file, resolution, quality_preset, format_type,
+            watermark_text=watermark_text, info=info,
+            pool=chunk_pool, temp_dir=Config.TEMP_DIR,
+            segment_min_duration=Config.SEGMENT_MIN_DURATION,
+            min_segment_seconds=Config.SEGMENT_MIN_SECONDS,
+            progress_callback=progress_callback, input_stream=input_stream,
+            cpu=cpu_budget, workdir=workdir
         )
         
-        stdout, stderr = process.communicate()
-        
-        if process.returncode != 0:
-            raise Exception(f"FFmpeg error: {stderr}")
+        # Piped encodes are paced by the download and resumed ones timed only their last part,
+        # so neither says anything about encode speed
+        if not input_stream and not resumed:
+            estimator.record(info, [(resolution, format_type)], quality_preset,
+                             max(concurrent, scheduler.running_count), time.time() - start_time)
+            record_encode_rate(info, time.time() - start_time)
         
         return True
         
     except Exception as e:
         logger.error(f"Transcoding error: {e}")
+        if encode_span:
+            encode_span.attrs['error'] = str(e)
+        raise
+    finally:
+        active_encodes.dec()
+        stage_latency.observe(time.monotonic() - encode_start, stage='encode')
+        if encode_span:
+            encode_span.close()
+
+async def transcode_batch(input_file, outputs, quality_preset, watermark=True, progress_callback=None, info=None, spool=None):
+    """Encode several renditions from a single decode of the source"""
+    active_encodes.inc()
+    encode_start = time.monotonic()
+    encode_span = tracer.open('encode', renditions=[resolution for _, resolution, _ in outputs],
+                              quality=quality_preset, worker=Config.ENCODE_QUEUE)
+    progress_callback = traced_progress(encode_span, progress_callback)
+    try:
+        watermark_text = WATERMARK_TEXT if watermark else None
+        
+        if Config.ENCODE_QUEUE:
+            await wait_for_spool(spool)
+            await run_on_worker('batch', {
+                'input': to_storage_path(input_file, Config.STORAGE_DIR),
+                'outputs': [
+                    (to_storage_path(path, Config.STORAGE_DIR), resolution, format_type)
+                    for path, resolution, format_type in outputs
+                ],
+                'quality': quality_preset,
+                'watermark_text': watermark_text,
+                'info': info
+            }, progress_callback)
+            return True
+        
+        input_stream = None
+        if spool and not spool.done:
+            input_file, input_stream = 'pipe:0', spool.follow()
+        
+        start_time = time.time()
+        concurrent = scheduler.running_count
+        await transcode_renditions(
+            input_file, outputs, quality_preset,
+            watermark_text=watermark_text, info=info,
+            progress_callback=progress_callback, input_stream=input_stream,
+            cpu=cpu_budget
+        )
+        
+        if not input_stream:
+            estimator.record(info, [(resolution, format_type) for _, resolution, format_type in outputs],
+                             quality_preset, max(concurrent, scheduler.running_count), time.time() - start_time)
+            record_encode_rate(info, time.time() - start_time)
+        
+        return True
+        
+    except Exception as e:
+        logger.error(f"Batch transcoding error: {e}")
+        if encode_span:
+            encode_span.attrs['error'] = str(e)
         raise
+    finally:
+        active_encodes.dec()
+        stage_latency.observe(time.monotonic() - encode_start, stage='encode')
+        if encode_span:
+            encode_span.close()
 
 @app.on_callback_query()
 async def handle_callback(client, callback_query):
@@ -436,7 +1029,7 @@ async def handle_callback(client, callback_query):
             await callback_query.message.edit_text("❌ Invalid selection or session expired.")
             return
         
-        if not os.path.exists(session['path']):
+        if session['downloaded'] and not os.path.exists(session['path']):
             await callback_query.message.edit_text("❌ Video file not found.")
             cleanup_session(video_id)
             return
@@ -447,24 +1040,75 @@ async def handle_callback(client, callback_query):
             await show_advanced_options(callback_query, video_id)
         elif action == "batch":
             await show_batch_options(callback_query, video_id)
+        elif action == "quality_select":
+            await show_quality_options(callback_query, video_id)
+        elif action == "format_select":
+            await show_format_options(callback_query, video_id)
         elif action.startswith("convert_"):
-            await process_conversion(callback_query, video_id, action)
+            await enqueue_conversion(callback_query, video_id, action)
+        elif action == "cancel":
+            job = scheduler.find_by_video(video_id)
+            if job and await cancel_job(job, callback_query.message):
+                await callback_query.answer("🛑 Cancelling...")
+            else:
+                await callback_query.answer("Nothing to cancel.")
         
     except Exception as e:
         logger.error(f"Callback error: {e}")
         await callback_query.message.edit_text(f"❌ Error: {str(e)}")
 
+def option_button(label, action, video_id):
+    """Conversion button labelled with its estimated processing time"""
+    cost = estimate_job_cost(video_sessions[video_id], parse_conversion_action(action))
+    return InlineKeyboardButton(f"{label} (~{format_duration(cost)})", callback_data=f"{action}|{video_id}")
+
+def queue_wait_text(user_id, video_id):
+    """Current queue wait for a new job, for option menus"""
+    _, wait = scheduler.predict_start(Job(user_id, video_id, None))
+    return f"\n⏳ Queue wait: ~{format_duration(wait)}" if wait else ""
+
 async def show_quick_options(callback_query, video_id):
     """Show quick conversion options"""
     buttons = [
-        [InlineKeyboardButton("360p MP4", callback_data=f"convert_360p_mp4_fast|{video_id}")],
-        [InlineKeyboardButton("480p MP4", callback_data=f"convert_480p_mp4_fast|{video_id}")],
-        [InlineKeyboardButton("720p MP4", callback_data=f"convert_720p_mp4_fast|{video_id}")],
+        [option_button("360p MP4", "convert_360p_mp4_fast", video_id)],
+        [option_button("480p MP4", "convert_480p_mp4_fast", video_id)],
+        [option_button("720p MP4", "convert_720p_mp4_fast", video_id)],
         [InlineKeyboardButton("🔙 Back", callback_data=f"back|{video_id}")]
     ]
     
     await callback_query.message.edit_text(
-        "🚀 **Quick Convert Options:**\n\nFast processing with good quality",
+        "🚀 **Quick Convert Options:**\n\nFast processing with good quality"
+        + queue_wait_text(callback_query.from_user.id, video_id),
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+async def show_quality_options(callback_query, video_id):
+    """Show the quality presets with their estimated processing times"""
+    resolution, format_type = Config.DEFAULT_RESOLUTION, Config.DEFAULT_FORMAT
+    buttons = [
+        [option_button(preset.title(), f"convert_{resolution}_{format_type}_{preset}", video_id)]
+        for preset in QUALITY_PRESETS
+    ]
+    buttons.append([InlineKeyboardButton("🔙 Back", callback_data=f"back|{video_id}")])
+    
+    await callback_query.message.edit_text(
+        f"⚡ **Choose Quality:**\n\n{resolution} {format_type.upper()}, slower presets give smaller files"
+        + queue_wait_text(callback_query.from_user.id, video_id),
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+async def show_format_options(callback_query, video_id):
+    """Show the output formats this ffmpeg build can encode"""
+    resolution, quality = Config.DEFAULT_RESOLUTION, Config.DEFAULT_QUALITY
+    buttons = [
+        [option_button(desc, f"convert_{resolution}_{format_type}_{quality}", video_id)]
+        for format_type, desc in available_formats().items()
+    ]
+    buttons.append([InlineKeyboardButton("🔙 Back", callback_data=f"back|{video_id}")])
+    
+    await callback_query.message.edit_text(
+        f"🎨 **Choose Format:**\n\n{resolution} {quality.title()}, H.265 and AV1 give smaller files but encode slower"
+        + queue_wait_text(callback_query.from_user.id, video_id),
         reply_markup=InlineKeyboardMarkup(buttons)
     )
 
@@ -483,129 +1127,663 @@ async def show_advanced_options(callback_query, video_id):
     )
 
 async def show_batch_options(callback_query, video_id):
-    """Show batch conversion options"""
-    buttons = [
-        [InlineKeyboardButton("All Resolutions (MP4)", callback_data=f"convert_batch_all_mp4|{video_id}")],
-        [InlineKeyboardButton("Mobile Pack (240p+360p)", callback_data=f"convert_batch_mobile|{video_id}")],
-        [InlineKeyboardButton("HD Pack (720p+1080p)", callback_data=f"convert_batch_hd|{video_id}")],
-        [InlineKeyboardButton("🔙 Back", callback_data=f"back|{video_id}")]
-    ]
+    """Show the batch packs that make sense for the video"""
+    session = video_sessions[video_id]
+    source_height = session['info']['height'] if session['info'] else 0
     
-    await callback_query.message.edit_text(
-        "📋 **Batch Convert Options:**\n\nProcess multiple formats at once",
-        reply_markup=InlineKeyboardMarkup(buttons)
-    )
+    buttons = []
+    for batch_type, label in BATCH_LABELS.items():
+        # A pack made only of rungs above the source would just upscale it
+        if source_height and all(RESOLUTION_PRESETS[resolution]['height'] > source_height
+                                 for resolution, _ in BATCH_CONFIGS[batch_type]):
+            continue
+        resolutions = '+'.join(resolution for resolution, _ in batch_renditions(session, batch_type))
+        buttons.append([option_button(f"{label} ({resolutions})", f"convert_batch_{batch_type}", video_id)])
+    
+    if buttons:
+        text = ("📋 **Batch Convert Options:**\n\nProcess multiple formats at once"
+                + queue_wait_text(callback_query.from_user.id, video_id))
+    else:
+        text = (f"📋 Batch convert is not available for this video: at {source_height}p it is "
+                "smaller than every batch resolution.\n\nUse Quick Convert or Advanced Options instead.")
+    buttons.append([InlineKeyboardButton("🔙 Back", callback_data=f"back|{video_id}")])
+    
+    await callback_query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
 
-async def process_conversion(callback_query, video_id, action):
-    """Process the video conversion"""
+def parse_conversion_action(action):
+    """Split a convert_* callback action into its parameters"""
+    parts = action.replace("convert_", "").split("_")
+    
+    if parts[0] == "batch":
+        return {'batch': parts[1]}
+    
+    return {
+        'resolution': parts[0],
+        'format': parts[1],
+        'quality': parts[2] if len(parts) > 2 else 'fast'
+    }
+
+def batch_renditions(session, batch_type):
+    """Renditions a batch pack produces from the session's source"""
+    return build_ladder(session['info'], BATCH_CONFIGS.get(batch_type, []))
+
+def batch_passes(configs):
+    """Split batch renditions into ffmpeg passes, smallest renditions first"""
+    ordered = sorted(configs, key=lambda config: RESOLUTION_PRESETS.get(config[0], {}).get('height', 0))
+    per_pass = Config.BATCH_OUTPUTS_PER_PASS or len(ordered)
+    return [ordered[i:i + per_pass] for i in range(0, len(ordered), per_pass)]
+
+def estimate_job_cost(session, params):
+    """Estimated processing seconds for a conversion under the current load"""
+    info = session['info']
+    concurrent = min(scheduler.max_workers, scheduler.running_count + 1)
+    
+    if 'batch' in params:
+        return sum(
+            estimator.estimate(info, group, 'fast', concurrent)
+            for group in batch_passes(batch_renditions(session, params['batch']))
+        )
+    
+    return estimator.estimate(info, [(params['resolution'], params['format'])], params['quality'], concurrent)
+
+def build_conversion_job(message, user_id, video_id, action):
+    """Scheduler job for a conversion, prioritised by user and estimated cost"""
+    params = parse_conversion_action(action)
+    cost = estimate_job_cost(video_sessions[video_id], params)
+    
+    if user_id in ADMIN_IDS:
+        priority = PRIORITY_ADMIN
+    elif cost <= Config.SHORT_JOB_SECONDS:
+        priority = PRIORITY_SHORT
+    else:
+        priority = PRIORITY_NORMAL
+    
+    job = Job(user_id, video_id, None, priority=priority, cost=cost)
+    job.run = lambda: process_conversion(message, job, action)
+    # Paused batches keep their delivered renditions and segmented encodes their chunks
+    job.preemptible = not Config.ENCODE_QUEUE and ('batch' in params or is_segmented(video_sessions[video_id]['info']))
+    return job
+
+async def enqueue_conversion(callback_query, video_id, action):
+    """Queue a conversion on the scheduler and tell the user where it stands"""
+    if scheduler.find_by_video(video_id):
+        await callback_query.answer("⏳ This video is already queued.")
+        return
+    
+    message = callback_query.message
     user_id = callback_query.from_user.id
-    session = video_sessions[video_id]
+    job = build_conversion_job(message, user_id, video_id, action)
+    
+    # Admission: turn away work that would only start after MAX_QUEUE_WAIT
+    joins = shared_conversion_key(video_id, action) in conversions
+    if Config.MAX_QUEUE_WAIT and user_id not in ADMIN_IDS and not joins:
+        _, wait = scheduler.predict_start(job)
+        if wait > Config.MAX_QUEUE_WAIT:
+            await callback_query.answer(
+                f"⏳ The queue is full (~{format_duration(wait)} wait). Please try again later.",
+                show_alert=True
+            )
+            return
     
-    # Add to processing queue
-    processing_queue[user_id] = video_id
+    # Load-aware admission: shed new work while the machine is saturated
+    reason = None if user_id in ADMIN_IDS or joins else overload_reason()
+    if reason:
+        await callback_query.answer(f"⏳ Sorry, {reason}. Please try again in a few minutes.", show_alert=True)
+        return
     
+    pending_jobs.add(video_id, user_id, action, message.chat.id, message.id, time.time())
+    
+    await submit_conversion(message, job, action)
+
+def shared_conversion_key(video_id, action):
+    """Key single conversions are shared under, None for batches"""
+    params = parse_conversion_action(action)
+    if 'batch' in params:
+        return None
+    return rendition_cache_key(video_sessions[video_id], params['resolution'], params['format'], params['quality'])
+
+async def submit_conversion(message, job, action):
+    """Put a conversion on the scheduler; also used to resume jobs after a restart"""
+    # An identical conversion is already running: wait on it without taking a worker slot
+    if shared_conversion_key(job.video_id, action) in conversions:
+        scheduler.attach(job)
+        return
+    
+    scheduler.submit(job)
+    
+    position, wait = scheduler.position(job.job_id)
+    if position:
+        await message.edit_text(
+            f"📋 Queued at position {position}\n"
+            f"⏳ Estimated start in {format_duration(wait)}, "
+            f"processing ~{format_duration(job.cost)}",
+            reply_markup=cancel_markup(job.video_id)
+        )
+
+async def cancel_job(job, message=None):
+    """Stop a conversion: withdraw it from the queue, or kill its running encode
+
+    A running job cleans up after itself as it unwinds. A queued one never
+    ran, so its pending entry is dropped and its menu offered again here.
+    The source stays, so the user can pick different settings.
+    """
+    was_queued = job.state == 'queued'
+    if not scheduler.cancel(job.job_id):
+        return False
+    
+    if was_queued:
+        pending_jobs.remove(job.video_id)
+        if message and job.video_id in video_sessions:
+            await progress_reporter.edit_now(message, "🛑 Conversion cancelled. Choose another option:",
+                                             reply_markup=video_options_markup(job.video_id))
+    
+    logger.info(f"Job {job.job_id} for {job.video_id} cancelled")
+    return True
+
+async def process_conversion(message, job, action):
+    """Process the video conversion"""
+    user_id, video_id = job.user_id, job.video_id
+    
+    if video_id not in video_sessions:
+        await progress_reporter.edit_now(message, "❌ Session expired before processing started.")
+        return
+    
+    # Parse conversion parameters
+    params = parse_conversion_action(action)
+    
+    # The job's task is its own, so everything it awaits or spawns nests under the job span
+    trace = tracer.begin(video_id, user_id=user_id)
+    job_span = trace.open('job', job_id=job.job_id, action=action, run=job.preemptions + 1)
+    tracer.activate(job_span)
+    trace.record('queue_wait', job.resume.pop('requeued', job.created), job.started, parent=job_span)
+    
+    progress_reporter.set_markup(message, cancel_markup(video_id))
     try:
-        await callback_query.message.edit_text("⚙️ Starting conversion... Please wait.")
-        
-        # Parse conversion parameters
-        parts = action.replace("convert_", "").split("_")
+        if job.preemptions:
+            await progress_reporter.edit_now(message, "▶️ Resuming conversion...")
+        else:
+            await progress_reporter.edit_now(message, "⚙️ Starting conversion... Please wait.")
         
-        if parts[0] == "batch":
-            await process_batch_conversion(callback_query, video_id, parts[1])
+        if 'batch' in params:
+            await process_batch_conversion(message, video_id, params['batch'],
+                                           job.resume.setdefault('delivered', set()))
         else:
-            resolution = parts[0]
-            format_type = parts[1]
-            quality = parts[2] if len(parts) > 2 else 'fast'
-            
-            await process_single_conversion(callback_query, video_id, resolution, format_type, quality)
+            await process_single_conversion(
+                message, video_id, params['resolution'], params['format'], params['quality'], job
+            )
+            if job.requeued:
+                return
         
         # Update user stats
-        await update_user_stats(user_id, 'video_processed')
+        await update_user_stats(user_id, 'video_processed', video_sessions[video_id]['original_size'])
         
     except Exception as e:
         logger.error(f"Conversion error: {e}")
-        await callback_query.message.reply(f"❌ Conversion failed: {str(e)}")
+        job_span.attrs['error'] = str(e)
+        await message.reply(f"❌ Conversion failed: {str(e)}")
     finally:
-        # Cleanup
-        cleanup_session(video_id)
-        if user_id in processing_queue:
-            del processing_queue[user_id]
+        if job.preempted:
+            # Back in the queue; chunks and delivered renditions are kept for the next run
+            job_span.close(outcome='preempted')
+            job.resume['requeued'] = time.time()
+            progress_reporter.set_markup(message, None)
+            await progress_reporter.edit_now(
+                message, "⏸️ Paused to let shorter jobs through, it will resume automatically.",
+                reply_markup=cancel_markup(video_id)
+            )
+        elif job.requeued and not job.cancelled:
+            # The shared encode it was attached to ended without a result for it
+            job_span.close(outcome='requeued')
+            job.resume['requeued'] = time.time()
+            progress_reporter.set_markup(message, None)
+            await progress_reporter.edit_now(message, "📋 Waiting for a free worker...",
+                                             reply_markup=cancel_markup(video_id))
+        elif job.cancelled:
+            # Keep the source so the user can pick different settings
+            job_span.close(outcome='cancelled')
+            progress_reporter.set_markup(message, None)
+            pending_jobs.remove(video_id)
+            discard_chunks(video_id)
+            if 'batch' not in params and video_id in video_sessions:
+                session = video_sessions[video_id]
+                discard_rendition_chunks(
+                    rendition_cache_key(session, params['resolution'], params['format'], params['quality'])
+                )
+            await progress_reporter.edit_now(message, "🛑 Conversion cancelled. Choose another option:",
+                                             reply_markup=video_options_markup(video_id))
+        else:
+            job_span.attrs['outcome'] = 'failed' if 'error' in job_span.attrs else 'done'
+            await progress_reporter.clear_markup(message)
+            pending_jobs.remove(video_id)
+            # The cleanup span must end before the trace is written out
+            try:
+                with tracer.span('cleanup'):
+                    cleanup_session(video_id, finish_trace=False)
+            finally:
+                job_span.close()
+                tracer.finish(video_id)
+
+def rendition_cache_key(session, resolution, format_type, quality):
+    """Cache key of a rendition of the session's source"""
+    return RenditionCache.make_key(session['file_unique_id'], resolution, format_type, quality, WATERMARK_TEXT)
+
+def uploaded_file_id(sent):
+    """Telegram file_id of an uploaded video message, if any"""
+    media = (sent.video or sent.document) if sent else None
+    return media.file_id if media else None
+
+async def send_cached_rendition(message, key, entry, caption):
+    """Re-send a cached rendition, by file_id when possible. Returns False if unusable."""
+    if entry['file_id']:
+        try:
+            await message.reply_video(video=entry['file_id'], caption=caption)
+            return True
+        except Exception as e:
+            logger.warning(f"Cached file_id rejected, falling back to file: {e}")
+            rendition_cache.set_file_id(key, None)
+    
+    if entry['path'] and os.path.exists(entry['path']):
+        with stage('upload', cached=True):
+            sent = await message.reply_video(video=entry['path'], caption=caption)
+        bytes_out.inc(entry['size'])
+        rendition_cache.set_file_id(key, uploaded_file_id(sent))
+        return True
+    
+    return False
 
-async def process_single_conversion(callback_query, video_id, resolution, format_type, quality):
-    """Process single video conversion"""
+def store_rendition(key, session, output_file, sent):
+    """Move an uploaded output into the rendition cache"""
+    try:
+        rendition_cache.put(key, session['file_unique_id'], output_file, file_id=uploaded_file_id(sent))
+        rendition_cache.remember_source(session['file_unique_id'], session['info'])
+    except Exception as e:
+        logger.error(f"Failed to cache rendition: {e}")
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+def active_spool(video_id):
+    """Spool of a download that is still streaming in, if any"""
+    ingest = ingests.get(video_id)
+    return ingest['spool'] if ingest else None
+
+async def ensure_source_downloaded(notify, video_id):
+    """Download a session's source if it was deferred because of cached renditions"""
     session = video_sessions[video_id]
-    input_file = session['path']
+    if session['downloaded'] or video_id in ingests:
+        return
     
-    output_file = f"outputs/{video_id}_{resolution}.{format_type}"
+    with stage('download', deferred=True):
+        if not await join_download(notify, session['file_unique_id'], session['path']):
+            await reserve_disk(notify, {session['path']: session['original_size']})
+            await notify("⬇️ Downloading source video...")
+            source = await app.get_messages(session['chat_id'], session['message_id'])
+            download_task = asyncio.create_task(source.download(file_name=session['path']))
+            track_download(session['file_unique_id'], session['path'], download_task)
+            await download_task
+            bytes_in.inc(session['original_size'])
+    session['downloaded'] = True
     
-    start_time = time.time()
+    if not session['info']:
+        with stage('probe'):
+            session['info'] = await probe_service.probe(session['path'], cache_key=session['file_unique_id'])
+    video_sessions.save(video_id)
+
+def track_download(file_unique_id, path, task):
+    """Let later uploads of the same file wait for this download until it finishes"""
+    downloads[file_unique_id] = {'path': path, 'task': task}
+    
+    def forget(_):
+        if downloads.get(file_unique_id, {}).get('task') is task:
+            del downloads[file_unique_id]
+    
+    task.add_done_callback(forget)
+
+async def join_download(notify, file_unique_id, path):
+    """Hard-link path to a download of the same file in progress, once it lands
+    
+    Returns False when there is none or it fails, and the caller fetches the
+    file itself. The link shares the first download's disk space and outlives
+    its session.
+    """
+    download = downloads.get(file_unique_id)
+    if download is None:
+        return False
+    
+    await notify("⬇️ This video is already downloading, waiting for it...")
+    task = download['task']
+    await asyncio.wait([task])
+    if task.cancelled() or task.exception():
+        return False
     
     try:
-        await transcode_video(input_file, output_file, resolution, quality, format_type)
+        os.link(download['path'], path)
+    except OSError as e:
+        # The first session may already be gone, or the filesystem has no hard links
+        logger.info(f"Could not share the download of {file_unique_id}: {e}")
+        return False
+    return True
+
+def rendition_output(key, format_type):
+    """Output path of a single conversion, shared by every request for the rendition"""
+    return os.path.join(Config.OUTPUT_DIR, f"{key}.{output_extension(format_type)}")
+
+def discard_rendition_chunks(key):
+    """Remove chunks kept for resuming a single conversion nobody is waiting on any more"""
+    if key in conversions:
+        return
+    for workdir in glob.glob(os.path.join(Config.TEMP_DIR, f"{glob.escape(key)}.*.chunks")):
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+def make_flight_listener(message, label):
+    """Relay a shared encode's status texts and progress to one waiting message"""
+    encode_progress = make_encode_progress(message, label)
+    
+    async def listener(event):
+        if isinstance(event, str):
+            await progress_reporter.edit_now(message, event)
+        else:
+            await encode_progress(event)
+    
+    return listener
+
+async def encode_rendition(flight, video_id, output_file, resolution, format_type, quality):
+    """Download and encode one rendition for every conversion waiting on it"""
+    session = video_sessions[video_id]
+    encoding_sources.add(video_id)
+    try:
+        await ensure_source_downloaded(flight.report, video_id)
         
-        processing_time = time.time() - start_time
-        output_size = os.path.getsize(output_file)
+        reservation = output_reservation(session, [(output_file, resolution, format_type)], segmented=True)
+        await reserve_disk(flight.report, reservation)
+        try:
+            await transcode_video(session['path'], output_file, resolution, quality, format_type,
+                                  progress_callback=flight.report, info=session['info'],
+                                  spool=active_spool(video_id), workdir=chunk_workdir(output_file))
+        except asyncio.CancelledError:
+            remove_file(output_file)
+            raise
+        except Exception as e:
+            remove_file(output_file)
+            raise Exception(f"Single conversion failed: {str(e)}")
+        finally:
+            # Whatever was written is on disk now, so the estimate is no longer needed
+            disk_budget.release(*reservation)
         
+        return output_file
+    finally:
+        encoding_sources.discard(video_id)
+
+def pass_on_slot(job, flight):
+    """Keep a shared encode in a worker slot when the job holding one leaves it early
+    
+    The encode goes on for the jobs still waiting; unless one of them holds a
+    slot of its own, an attached one takes over the leaving job's slot.
+    """
+    if flight.task.done() or not scheduler.holds_slot(job):
+        return
+    others = [member for member in flight.members if member is not job]
+    if any(scheduler.holds_slot(other) for other in others):
+        return
+    successor = next((other for other in others if scheduler.is_attached(other)), None)
+    if successor:
+        scheduler.hand_off(job, successor)
+
+async def process_single_conversion(message, video_id, resolution, format_type, quality, job=None):
+    """Process single video conversion
+    
+    Identical conversions (same source, settings and watermark) share one
+    download and encode: a request for a rendition already being encoded
+    joins it, follows its progress and is sent the same output. The encode
+    runs in the worker slot of the job that started it; if that job leaves
+    early, another waiting job takes the slot over.
+    """
+    session = video_sessions[video_id]
+    
+    # Serve repeated requests straight from the rendition cache
+    key = rendition_cache_key(session, resolution, format_type, quality)
+    entry = rendition_cache.get(key)
+    if entry:
         caption = f"""
 🎬 **Conversion Complete!**
 
+📐 Resolution: {resolution}
+📁 Format: {format_type.upper()}
+⚡ Quality: {quality}
+♻️ Served from cache
+        """
+        if await send_cached_rendition(message, key, entry, caption):
+            return
+    
+    label = f"{resolution} {format_type.upper()}"
+    joined = key in conversions
+    if joined:
+        await progress_reporter.edit_now(message, f"🔗 Joining an identical {label} conversion already in progress...")
+    
+    output_file = rendition_output(key, format_type)
+    start_time = time.time()
+    
+    # An attached job holds no worker slot, so it may only wait on an encode still in flight.
+    # If that ended in the meantime, wait for a slot instead; a finished output is served
+    # from the cache then. Nothing is awaited between this check and joining.
+    if job and scheduler.is_attached(job) and key not in conversions:
+        scheduler.requeue(job)
+        return
+    
+    async with conversions.join(
+        key,
+        lambda flight: encode_rendition(flight, video_id, output_file, resolution, format_type, quality),
+        listener=make_flight_listener(message, label),
+        cleanup=lambda: remove_file(output_file),
+        member=job
+    ) as flight:
+        # The encode's own spans are in the trace of the job that started it
+        with tracer.span('shared_encode' if joined else 'encode_wait', rendition=key):
+            try:
+                await flight.result()
+            except asyncio.CancelledError:
+                if job:
+                    pass_on_slot(job, flight)
+                raise
+        processing_time = time.time() - start_time
+        
+        # One waiter at a time: the first uploads and caches the output, the rest re-send it
+        async with flight.lock:
+            if not os.path.exists(output_file):
+                entry = rendition_cache.get(key)
+                caption = f"""
+🎬 **Conversion Complete!**
+
+📐 Resolution: {resolution}
+📁 Format: {format_type.upper()}
+⚡ Quality: {quality}
+⏱️ Processing time: {processing_time:.1f}s
+🔗 Shared with an identical request
+                """
+                if not entry or not await send_cached_rendition(message, key, entry, caption):
+                    raise Exception("Single conversion failed: the shared output is no longer available")
+                return
+            
+            output_size = os.path.getsize(output_file)
+            caption = f"""
+🎬 **Conversion Complete!**
+
 📐 Resolution: {resolution}
 📁 Format: {format_type.upper()}
 ⚡ Quality: {quality}
 ⏱️ Processing time: {processing_time:.1f}s
 📦 Output size: {format_file_size(output_size)}
 💾 Compression: {((session['original_size'] - output_size) / session['original_size'] * 100):.1f}%
-        """
-        
-        await callback_query.message.reply_video(
-            video=output_file,
-            caption=caption
-        )
-        
-        os.remove(output_file)
-        
-    except Exception as e:
-        raise Exception(f"Single conversion failed: {str(e)}")
+            """
+            
+            async with upload_slots:
+                with stage('upload', size=output_size):
+                    sent = await message.reply_video(
+                        video=output_file,
+                        caption=caption,
+                        progress=make_upload_progress(message, label)
+                    )
+            bytes_out.inc(output_size)
+            
+            store_rendition(key, session, output_file, sent)
 
-async def process_batch_conversion(callback_query, video_id, batch_type):
-    """Process batch video conversion"""
+async def process_batch_conversion(message, video_id, batch_type, delivered=None):
+    """Process batch video conversion
+    
+    delivered collects the cache keys of renditions already sent, so a run
+    resumed after preemption does not send them again.
+    """
     session = video_sessions[video_id]
+    delivered = set() if delivered is None else delivered
+    
+    configs = batch_renditions(session, batch_type)
+    
+    # Send cached renditions right away and only encode the rest
+    keys = {}
+    missing = []
+    for resolution, format_type in configs:
+        key = rendition_cache_key(session, resolution, format_type, 'fast')
+        if key in delivered:
+            continue
+        entry = rendition_cache.get(key)
+        caption = f"🎬 {resolution} {format_type.upper()} - ♻️ cached"
+        if entry and await send_cached_rendition(message, key, entry, caption):
+            delivered.add(key)
+            continue
+        keys[resolution, format_type] = key
+        missing.append((resolution, format_type))
+    
+    if not missing:
+        await progress_reporter.edit_now(message, "✅ Batch conversion complete!")
+        return
+    
+    await ensure_source_downloaded(notify_on(message), video_id)
     input_file = session['path']
     
-    batch_configs = {
-        'all': [('240p', 'mp4'), ('360p', 'mp4'), ('480p', 'mp4'), ('720p', 'mp4'), ('1080p', 'mp4')],
-        'mobile': [('240p', 'mp4'), ('360p', 'mp4')],
-        'hd': [('720p', 'mp4'), ('1080p', 'mp4')]
-    }
+    total_files = len(missing)
     
-    configs = batch_configs.get(batch_type, [])
-    total_files = len(configs)
+    await progress_reporter.edit_now(message, f"⚙️ Processing {total_files} files...")
     
-    await callback_query.message.edit_text(f"⚙️ Processing {total_files} files...")
+    # Smallest renditions first, so their uploads overlap the heavier encodes
+    passes = [
+        [(os.path.join(Config.OUTPUT_DIR, f"{video_id}_{resolution}.{output_extension(format_type)}"), resolution, format_type)
+         for resolution, format_type in group]
+        for group in batch_passes(missing)
+    ]
+    outputs = [output for pass_outputs in passes for output in pass_outputs]
     
-    for i, (resolution, format_type) in enumerate(configs, 1):
-        try:
-            output_file = f"outputs/{video_id}_{resolution}.{format_type}"
+    timings = {'encode': 0.0, 'upload': 0.0, 'uploaded': 0}
+    batch_start = time.time()
+    
+    upload_queue = asyncio.Queue()
+    uploaders = [
+        asyncio.create_task(batch_uploader(message, session, keys, upload_queue, timings, delivered))
+        for _ in range(Config.MAX_CONCURRENT_UPLOADS)
+    ]
+    
+    try:
+        for n, pass_outputs in enumerate(passes, 1):
+            encode_start = time.time()
+            label = ', '.join(resolution for _, resolution, _ in pass_outputs)
+            if len(passes) > 1:
+                label = f"pass {n}/{len(passes)} ({label})"
             
-            await callback_query.message.edit_text(f"⚙️ Processing {i}/{total_files}: {resolution} {format_type.upper()}")
+            await reserve_disk(notify_on(message), output_reservation(session, pass_outputs))
             
-            await transcode_video(input_file, output_file, resolution, 'fast', format_type)
+            try:
+                # Decode once and encode every rendition of the pass from a split filter graph
+                progress = make_encode_progress(message, label)
+                await transcode_batch(input_file, pass_outputs, 'fast', progress_callback=progress,
+                                      info=session['info'], spool=active_spool(video_id))
+                for output in pass_outputs:
+                    upload_queue.put_nowait(output)
+            except Exception as e:
+                logger.warning(f"Multi-output batch failed, falling back to sequential encodes: {e}")
+                for path, _, _ in pass_outputs:
+                    if os.path.exists(path):
+                        os.remove(path)
+                await process_batch_sequential(message, video_id, pass_outputs, upload_queue)
             
+            timings['encode'] += time.time() - encode_start
+        
+        # Wait for the remaining uploads to be confirmed
+        await upload_queue.join()
+        
+    finally:
+        for uploader in uploaders:
+            uploader.cancel()
+        # An uploader may still be sending a file; let it stop before the file goes
+        await asyncio.gather(*uploaders, return_exceptions=True)
+        for path, _, _ in outputs:
+            if os.path.exists(path):
+                os.remove(path)
+            disk_budget.release(path)
+    
+    await progress_reporter.edit_now(
+        message,
+        f"✅ Batch conversion complete!\n\n"
+        f"⚙️ Encode: {timings['encode']:.1f}s ({len(passes)} pass{'es' if len(passes) > 1 else ''})\n"
+        f"⬆️ Upload: {timings['upload']:.1f}s ({timings['uploaded']}/{total_files} files)\n"
+        f"⏱️ Total: {time.time() - batch_start:.1f}s"
+    )
+
+async def batch_uploader(message, session, keys, upload_queue, timings, delivered):
+    """Upload finished batch renditions while the next pass is encoding"""
+    while True:
+        output_file, resolution, format_type = await upload_queue.get()
+        
+        try:
             output_size = os.path.getsize(output_file)
             
             caption = f"🎬 {resolution} {format_type.upper()} - {format_file_size(output_size)}"
             
-            await callback_query.message.reply_video(
-                video=output_file,
-                caption=caption
-            )
+            async with upload_slots:
+                upload_start = time.time()
+                with stage('upload', resolution=resolution, format=format_type, size=output_size):
+                    sent = await message.reply_video(
+                        video=output_file,
+                        caption=caption,
+                        progress=make_upload_progress(message, f"{resolution} {format_type.upper()}")
+                    )
+                timings['upload'] += time.time() - upload_start
+                timings['uploaded'] += 1
+                bytes_out.inc(output_size)
             
-            os.remove(output_file)
+            # Leaves outputs/ as soon as the upload is confirmed
+            delivered.add(keys[resolution, format_type])
+            store_rendition(keys[resolution, format_type], session, output_file, sent)
             
         except Exception as e:
-            await callback_query.message.reply(f"❌ Failed to process {resolution}: {str(e)}")
+            await message.reply(f"❌ Failed to upload {resolution}: {str(e)}")
+        finally:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            disk_budget.release(output_file)
+            upload_queue.task_done()
+
+async def process_batch_sequential(message, video_id, outputs, upload_queue):
+    """Encode batch renditions one at a time, used when the multi-output run fails"""
+    session = video_sessions[video_id]
+    info = session['info']
+    total_files = len(outputs)
     
-    await callback_query.message.edit_text("✅ Batch conversion complete!")
+    for i, (output_file, resolution, format_type) in enumerate(outputs, 1):
+        try:
+            await progress_reporter.edit_now(message, f"⚙️ Processing {i}/{total_files}: {resolution} {format_type.upper()}")
+            
+            progress = make_encode_progress(
+                message, f"{i}/{total_files}: {resolution} {format_type.upper()}"
+            )
+            await transcode_video(session['path'], output_file, resolution, 'fast', format_type,
+                                  progress_callback=progress, info=info,
+                                  spool=active_spool(video_id))
+            upload_queue.put_nowait((output_file, resolution, format_type))
+            
+        except Exception as e:
+            await message.reply(f"❌ Failed to process {resolution}: {str(e)}")
 
 async def handle_admin_callback(client, callback_query):
     """Handle admin panel callbacks"""
@@ -616,53 +1794,138 @@ async def handle_admin_callback(client, callback_query):
         current_time = time.time()
         cleared = 0
         
-        for video_id in list(video_sessions.keys()):
-            session = video_sessions[video_id]
-            if current_time - session['timestamp'] > 3600:  # 1 hour old
+        for video_id in video_sessions.older_than(current_time - 3600):  # 1 hour old
+            if not session_in_use(video_id):
                 cleanup_session(video_id)
                 cleared += 1
         
-        await callback_query.message.edit_text(f"🗑️ Cleared {cleared} old sessions")
+        removed = await sweep_storage()
+        await callback_query.message.edit_text(f"🗑️ Cleared {cleared} old sessions and {removed} orphaned files")
     
     elif action == "detailed_stats":
         stats_text = "📊 **Detailed Statistics:**\n\n"
         
-        total_users = len(user_stats)
-        total_videos = sum(stats.get('videos_processed', 0) for stats in user_stats.values())
+        totals = user_stats.totals()
         
-        stats_text += f"👥 Total Users: {total_users}\n"
-        stats_text += f"🎬 Total Videos: {total_videos}\n"
+        stats_text += f"👥 Total Users: {totals['users']}\n"
+        stats_text += f"🎬 Total Videos: {totals['videos']}\n"
+        stats_text += f"📦 Total Data: {format_file_size(totals['size'])}\n"
         stats_text += f"📁 Active Sessions: {len(video_sessions)}\n"
-        stats_text += f"⚙️ Processing Queue: {len(processing_queue)}\n"
+        stats_text += f"⚙️ Running Jobs: {scheduler.running_count}/{scheduler.max_workers}\n"
+        stats_text += f"📋 Queued Jobs: {scheduler.queued_count}\n"
         
         await callback_query.message.edit_text(stats_text)
     
     elif action == "restart":
         await callback_query.message.edit_text("🔄 Restarting bot...")
+        # Sessions and jobs are already on disk; only batched stats are pending
+        user_stats.flush()
         # In a real deployment, you might want to implement graceful restart
         os._exit(0)
 
-# Cleanup old sessions periodically
-async def cleanup_old_sessions():
-    """Cleanup old sessions every hour"""
+def storage_owner(path):
+    """Session or shared-encode id a stored file is named after"""
+    return os.path.basename(path).replace('_', '.').split('.', 1)[0]
+
+async def sweep_storage():
+    """One janitor pass over the scratch directories, off the event loop"""
+    # Snapshot what is live here, so the sweep thread never touches shared state
+    live_ids = set(video_sessions) | set(conversions.keys())
+    for job in pending_jobs.all():
+        if job['video_id'] in video_sessions:
+            live_ids.add(shared_conversion_key(job['video_id'], job['action']))
+    live_paths = {os.path.abspath(path) for path in disk_budget.paths()}
+    
+    def is_live(path):
+        return storage_owner(path) in live_ids or os.path.abspath(path) in live_paths
+    
+    return await asyncio.to_thread(janitor.sweep, is_live)
+
+async def storage_janitor():
+    """Remove orphaned files left by crashes and failed uploads every JANITOR_INTERVAL"""
     while True:
+        await asyncio.sleep(Config.JANITOR_INTERVAL)
         try:
-            current_time = time.time()
-            for video_id in list(video_sessions.keys()):
-                session = video_sessions[video_id]
-                if current_time - session['timestamp'] > 3600:  # 1 hour
-                    cleanup_session(video_id)
-            
-            await asyncio.sleep(3600)  # Run every hour
+            await sweep_storage()
+            await asyncio.to_thread(encode_queue.purge, time.time() - 3600)
+        except Exception as e:
+            logger.error(f"Janitor error: {e}")
+
+async def resume_pending_jobs():
+    """Re-queue conversions that were accepted before the last shutdown"""
+    for job in pending_jobs.all():
+        try:
+            message = await app.get_messages(job['chat_id'], job['message_id'])
+            await submit_conversion(
+                message, build_conversion_job(message, job['user_id'], job['video_id'], job['action']), job['action']
+            )
+            logger.info(f"Resumed conversion of {job['video_id']} for user {job['user_id']}")
         except Exception as e:
-            logger.error(f"Cleanup error: {e}")
-            await asyncio.sleep(300)  # Retry in 5 minutes
+            logger.error(f"Could not resume job {job['video_id']}: {e}")
+            pending_jobs.remove(job['video_id'])
+
+async def start_local_workers():
+    """Start LOCAL_WORKERS encoder worker processes next to the bot"""
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+    return [
+        await asyncio.create_subprocess_exec(sys.executable, worker_script)
+        for _ in range(Config.LOCAL_WORKERS)
+    ]
+
+async def main():
+    """Start the bot together with its background workers"""
+    # Encodes queued by a previous run have no one waiting for them any more
+    withdrawn = encode_queue.cancel_all()
+    if withdrawn:
+        logger.info(f"Withdrew {withdrawn} encode jobs from the previous run")
+    
+    # Workers on other hosts may still be writing to the shared scratch directories
+    removed = reconcile_storage(video_sessions, pending_jobs, Config.DOWNLOAD_DIR, [Config.OUTPUT_DIR, Config.TEMP_DIR],
+                                scratch_min_age=Config.WORKER_LEASE_SECONDS if Config.ENCODE_QUEUE else 0)
+    logger.info(f"Storage reconciled: {removed}")
+    
+    for video_id, session in video_sessions.items():
+        session_expiry.schedule(video_id, session['timestamp'] + Config.SESSION_TIMEOUT)
+    
+    await ENCODERS.detect()
+    
+    local_workers = await start_local_workers() if Config.ENCODE_QUEUE else []
+    
+    health_server = await create_health_server(metrics, health_status, Config.HEALTH_PORT)
+    loop_monitor.start()
+    system_monitor.start()
+    
+    await app.start()
+    
+    # Start job workers, progress editor and background tasks
+    scheduler.start()
+    progress_reporter.start()
+    background_tasks = [
+        asyncio.create_task(session_expiry.run(expire_session)),
+        asyncio.create_task(storage_janitor()),
+        asyncio.create_task(flush_user_stats())
+    ]
+    
+    await resume_pending_jobs()
+    
+    await idle()
+    
+    for task in background_tasks:
+        task.cancel()
+    await scheduler.stop()
+    await progress_reporter.stop()
+    await loop_monitor.stop()
+    await system_monitor.stop()
+    await health_server.cleanup()
+    for worker in local_workers:
+        worker.terminate()
+        await worker.wait()
+    user_stats.flush()
+    await app.stop()
+    store.close()
 
 if __name__ == "__main__":
     logger.info("Starting Advanced Video Encoder Bot...")
     
-    # Start cleanup task
-    asyncio.create_task(cleanup_old_sessions())
-    
     # Run the bot
-    app.run()
\ No newline at end of file
+    app.run(main())
\ No newline at end of file
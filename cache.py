@@ -0,0 +1,164 @@
+"""
+Content-addressed rendition cache for the video encoder bot
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class RenditionCache:
+    """Size-bounded LRU store of finished renditions
+
+    Entries are keyed on the source's Telegram file_unique_id plus every
+    setting that changes the output. Each entry remembers the encoded file on
+    disk and, once uploaded, the Telegram file_id so it can be re-sent without
+    uploading again. When disk pressure evicts the file, the file_id is kept.
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, directory: str, max_bytes: int, min_free_bytes: int, max_entries: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._sources: Dict[str, Dict[str, Any]] = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(file_unique_id: str, resolution: str, format_type: str,
+                 quality: str, watermark_text: Optional[str]) -> str:
+        """Stable cache key for one rendition of one source"""
+        raw = json.dumps([file_unique_id, resolution, format_type, quality, watermark_text or ''])
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry['size'] for entry in self._entries.values() if entry['path'])
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up a rendition, refreshing its LRU position on a hit"""
+        entry = self._entries.get(key)
+
+        if entry and entry['path'] and not os.path.exists(entry['path']):
+            entry['path'] = None
+            entry['size'] = 0
+
+        if not entry or not (entry['path'] or entry['file_id']):
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        entry['last_access'] = time.time()
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, source_id: str, output_file: str, file_id: Optional[str] = None) -> Dict[str, Any]:
+        """Move a finished output into the cache and record it"""
+        cached_path = os.path.join(self.directory, f"{key}{os.path.splitext(output_file)[1]}")
+        os.replace(output_file, cached_path)
+
+        self._entries[key] = {
+            'source_id': source_id,
+            'path': cached_path,
+            'size': os.path.getsize(cached_path),
+            'file_id': file_id,
+            'last_access': time.time()
+        }
+        self._entries.move_to_end(key)
+
+        self._evict()
+        self._save()
+        return self._entries[key]
+
+    def set_file_id(self, key: str, file_id: Optional[str]) -> None:
+        """Record (or forget) the Telegram file_id of an uploaded rendition"""
+        if key in self._entries:
+            self._entries[key]['file_id'] = file_id
+            self._save()
+
+    def remember_source(self, file_unique_id: str, info: Optional[Dict[str, Any]]) -> None:
+        """Keep the probed metadata of a source so it can be shown without downloading"""
+        self._sources[file_unique_id] = info or {}
+        self._save()
+
+    def has_source(self, file_unique_id: str) -> bool:
+        return any(entry['source_id'] == file_unique_id for entry in self._entries.values())
+
+    def source_info(self, file_unique_id: str) -> Optional[Dict[str, Any]]:
+        return self._sources.get(file_unique_id) or None
+
+    def _free_bytes(self) -> float:
+        """Free space on the cache's disk, unlimited if it cannot be read"""
+        try:
+            return shutil.disk_usage(self.directory).free
+        except OSError:
+            return float('inf')
+
+    def _evict(self) -> None:
+        """Drop least recently used files until size and free-space limits hold"""
+        for key in list(self._entries):
+            if self.total_bytes <= self.max_bytes and self._free_bytes() >= self.min_free_bytes:
+                break
+
+            entry = self._entries[key]
+            if entry['path']:
+                try:
+                    os.remove(entry['path'])
+                except OSError as e:
+                    logger.warning(f"Failed to evict {entry['path']}: {e}")
+                entry['path'] = None
+                entry['size'] = 0
+
+            if not entry['file_id']:
+                del self._entries[key]
+
+        # Bound the number of file_id-only entries as well
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        live_sources = {entry['source_id'] for entry in self._entries.values()}
+        for source_id in list(self._sources):
+            if source_id not in live_sources:
+                del self._sources[source_id]
+
+    def _load(self) -> None:
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        try:
+            with open(index_path) as f:
+                data = json.load(f)
+            entries = sorted(data.get('entries', {}).items(), key=lambda item: item[1]['last_access'])
+            self._entries = OrderedDict(entries)
+            self._sources = data.get('sources', {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Failed to load rendition cache index: {e}")
+
+    def _save(self) -> None:
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        tmp_path = index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': self._entries, 'sources': self._sources}, f)
+            os.replace(tmp_path, index_path)
+        except Exception as e:
+            logger.error(f"Failed to save rendition cache index: {e}")
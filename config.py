@@ -24,6 +24,86 @@ class Config:
     # Processing settings
     MAX_CONCURRENT_PROCESSES: int = int(os.environ.get("MAX_CONCURRENT_PROCESSES", "3"))
     SESSION_TIMEOUT: int = int(os.environ.get("SESSION_TIMEOUT", "3600"))  # 1 hour
+    MAX_JOBS_PER_USER: int = int(os.environ.get("MAX_JOBS_PER_USER", "3"))
+    SHORT_JOB_SECONDS: int = int(os.environ.get("SHORT_JOB_SECONDS", "60"))
+    MAX_QUEUE_WAIT: int = int(os.environ.get("MAX_QUEUE_WAIT", "0"))  # Refuse jobs that would wait longer (0 = never)
+    PREEMPT_AFTER: int = int(os.environ.get("PREEMPT_AFTER", "120"))  # Seconds before long jobs may be paused (0 = never)
+    MAX_PREEMPTIONS: int = int(os.environ.get("MAX_PREEMPTIONS", "2"))  # Pauses per job
+    
+    # System sampler and load-aware admission: new conversions are refused while the 1-minute CPU
+    # average is above ADMISSION_MAX_CPU with jobs waiting (off by default: busy encoders keep
+    # the CPU near 100%, so any threshold caps the queue), and no further encode starts below
+    # ADMISSION_MIN_MEMORY of available memory (0 = ignore either)
+    SYSMON_INTERVAL: int = int(os.environ.get("SYSMON_INTERVAL", "5"))
+    ADMISSION_MAX_CPU: int = int(os.environ.get("ADMISSION_MAX_CPU", "0"))  # Percent
+    ADMISSION_MIN_MEMORY: int = int(os.environ.get("ADMISSION_MIN_MEMORY", "268435456"))  # 256MB
+    
+    # CPU budget: cores shared by concurrent encodes (0 = all available) and core pinning
+    CPU_CORES: int = int(os.environ.get("CPU_CORES", "0"))
+    CPU_AFFINITY: bool = os.environ.get("CPU_AFFINITY", "false").lower() == "true"
+    
+    # ffprobe concurrency and memoised results
+    MAX_CONCURRENT_PROBES: int = int(os.environ.get("MAX_CONCURRENT_PROBES", "4"))
+    PROBE_CACHE_SIZE: int = int(os.environ.get("PROBE_CACHE_SIZE", "256"))
+    
+    # Stream media into a spool file so probing and encoding overlap the download
+    STREAMING_INGEST: bool = os.environ.get("STREAMING_INGEST", "true").lower() == "true"
+    
+    # Segmented encoding: long sources are split into chunks encoded in parallel
+    SEGMENT_MIN_DURATION: int = int(os.environ.get("SEGMENT_MIN_DURATION", "300"))  # 5 minutes
+    SEGMENT_MIN_SECONDS: int = int(os.environ.get("SEGMENT_MIN_SECONDS", "30"))
+    
+    # Batch pipeline: renditions per ffmpeg pass (0 = all in one pass) and parallel uploads
+    BATCH_OUTPUTS_PER_PASS: int = int(os.environ.get("BATCH_OUTPUTS_PER_PASS", "0"))
+    MAX_CONCURRENT_UPLOADS: int = int(os.environ.get("MAX_CONCURRENT_UPLOADS", "2"))
+    
+    # Progress message editing: seconds between edits per chat, and global edit budget
+    PROGRESS_INTERVAL: float = float(os.environ.get("PROGRESS_INTERVAL", "3"))
+    PROGRESS_EDITS_PER_SECOND: float = float(os.environ.get("PROGRESS_EDITS_PER_SECOND", "20"))
+    
+    # Rendition cache settings
+    CACHE_MAX_BYTES: int = int(os.environ.get("CACHE_MAX_BYTES", "2147483648"))  # 2GB
+    CACHE_MIN_FREE_BYTES: int = int(os.environ.get("CACHE_MIN_FREE_BYTES", "1073741824"))  # 1GB
+    
+    # Disk budget: space kept free beyond all reservations, and how long a job waits for space (0 = forever)
+    DISK_HEADROOM_BYTES: int = int(os.environ.get("DISK_HEADROOM_BYTES", "536870912"))  # 512MB
+    DISK_WAIT_TIMEOUT: int = int(os.environ.get("DISK_WAIT_TIMEOUT", "3600"))
+    
+    # Storage janitor: seconds between passes, age before an unowned file counts as orphaned, deletions per pass
+    JANITOR_INTERVAL: int = int(os.environ.get("JANITOR_INTERVAL", "300"))
+    JANITOR_MIN_AGE: int = int(os.environ.get("JANITOR_MIN_AGE", "3600"))
+    JANITOR_MAX_DELETIONS: int = int(os.environ.get("JANITOR_MAX_DELETIONS", "100"))
+    
+    # Persistent storage; downloads, outputs and the database live under STORAGE_DIR,
+    # which must be shared with encoder workers on other hosts
+    STORAGE_DIR: str = os.environ.get("STORAGE_DIR", "")
+    DATABASE_PATH: str = os.environ.get("DATABASE_PATH", os.path.join(STORAGE_DIR, "bot.db"))
+    STATS_FLUSH_INTERVAL: int = int(os.environ.get("STATS_FLUSH_INTERVAL", "10"))
+    DB_BUSY_TIMEOUT: int = int(os.environ.get("DB_BUSY_TIMEOUT", "1000"))  # ms the bot blocks waiting for the database lock
+    
+    # Encoder workers: hand encodes to worker.py processes through the shared queue
+    ENCODE_QUEUE: bool = os.environ.get("ENCODE_QUEUE", "false").lower() == "true"
+    LOCAL_WORKERS: int = int(os.environ.get("LOCAL_WORKERS", "0"))  # Workers started by the bot itself
+    WORKER_CONCURRENCY: int = int(os.environ.get("WORKER_CONCURRENCY", "1"))
+    WORKER_LEASE_SECONDS: int = int(os.environ.get("WORKER_LEASE_SECONDS", "60"))
+    WORKER_HEARTBEAT_INTERVAL: float = float(os.environ.get("WORKER_HEARTBEAT_INTERVAL", "5"))
+    WORKER_POLL_INTERVAL: float = float(os.environ.get("WORKER_POLL_INTERVAL", "1"))
+    ENCODE_MAX_ATTEMPTS: int = int(os.environ.get("ENCODE_MAX_ATTEMPTS", "3"))
+    
+    # Health and metrics server; /health reports degraded above these limits
+    HEALTH_PORT: int = int(os.environ.get("PORT", "8080"))
+    HEALTH_MAX_QUEUE: int = int(os.environ.get("HEALTH_MAX_QUEUE", "50"))
+    HEALTH_MAX_LOOP_LAG: float = float(os.environ.get("HEALTH_MAX_LOOP_LAG", "5"))
+    
+    # Event loop watchdog (opt-in): log the stack of whatever blocks the loop for longer than the threshold
+    LOOP_WATCHDOG: bool = os.environ.get("LOOP_WATCHDOG", "false").lower() == "true"
+    LOOP_WATCHDOG_THRESHOLD: float = float(os.environ.get("LOOP_WATCHDOG_THRESHOLD", "0.5"))
+    
+    # Job tracing: spans go to LOG_DIR/traces.jsonl, rotated at TRACE_FILE_MAX_BYTES, keeping
+    # TRACE_FILE_BACKUPS old files; the last TRACE_HISTORY traced jobs are kept for /slowjobs
+    TRACE_FILE_MAX_BYTES: int = int(os.environ.get("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+    TRACE_FILE_BACKUPS: int = int(os.environ.get("TRACE_FILE_BACKUPS", "5"))
+    TRACE_HISTORY: int = int(os.environ.get("TRACE_HISTORY", "200"))
     
     # Quality settings
     DEFAULT_QUALITY: str = os.environ.get("DEFAULT_QUALITY", "fast")
@@ -31,10 +111,11 @@ class Config:
     DEFAULT_FORMAT: str = os.environ.get("DEFAULT_FORMAT", "mp4")
     
     # Directories
-    DOWNLOAD_DIR: str = "downloads"
-    OUTPUT_DIR: str = "outputs"
-    TEMP_DIR: str = "temp"
+    DOWNLOAD_DIR: str = os.path.join(STORAGE_DIR, "downloads")
+    OUTPUT_DIR: str = os.path.join(STORAGE_DIR, "outputs")
+    TEMP_DIR: str = os.environ.get("TEMP_DIR", os.path.join(STORAGE_DIR, "temp"))  # May point at a tmpfs
     LOG_DIR: str = "logs"
+    CACHE_DIR: str = os.path.join(STORAGE_DIR, "cache")
     
     @classmethod
     def validate(cls) -> bool:
@@ -54,7 +135,7 @@ class Config:
     @classmethod
     def create_directories(cls) -> None:
         """Create necessary directories"""
-        directories = [cls.DOWNLOAD_DIR, cls.OUTPUT_DIR, cls.TEMP_DIR, cls.LOG_DIR]
+        directories = [cls.DOWNLOAD_DIR, cls.OUTPUT_DIR, cls.TEMP_DIR, cls.LOG_DIR, cls.CACHE_DIR]
         
         for directory in directories:
             os.makedirs(directory, exist_ok=True)
\ No newline at end of file
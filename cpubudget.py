@@ -0,0 +1,96 @@
+"""
+CPU budget for concurrent ffmpeg processes in the video encoder bot
+"""
+import logging
+import os
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+def available_cores(limit: Optional[int] = None) -> List[int]:
+    """Cores this process may run on, only the first limit of them when given"""
+    if hasattr(os, 'sched_getaffinity'):
+        detected = sorted(os.sched_getaffinity(0))
+    else:
+        detected = list(range(os.cpu_count() or 1))
+    return detected[:limit] if limit else detected
+
+class CpuGrant:
+    """One process's share of the CPU budget"""
+
+    def __init__(self, threads: int):
+        self.threads = threads
+        self.cores: Set[int] = set()
+        self.pid: Optional[int] = None
+
+    def attach(self, pid: int) -> None:
+        """Bind the grant to a started process and pin it to its cores"""
+        self.pid = pid
+        self.apply()
+
+    def apply(self) -> None:
+        if self.pid is None or not self.cores or not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            os.sched_setaffinity(self.pid, self.cores)
+        except OSError as e:
+            # The process may have exited between rebalance and pinning
+            logger.debug(f"Could not pin pid {self.pid}: {e}")
+
+class CpuBudget:
+    """Splits the cores evenly between running encoder processes
+
+    A grant is taken before an ffmpeg command is built, and its thread count
+    is fixed for the life of that process, so shares are sized for the
+    expected number of concurrent encodes rather than the ones running at
+    that moment; the first encode of a burst would otherwise claim every
+    core and oversubscribe them once the rest start. With pinning enabled every
+    grant also owns a disjoint slice of the cores, and the slices are
+    recomputed whenever a grant is added or returned; thread counts of
+    running processes cannot change, but their core sets follow the budget.
+    """
+
+    def __init__(self, cores: Optional[int] = None, pin: bool = False, expected: int = 1):
+        self.cores = available_cores(cores)
+        self.pin = pin and hasattr(os, 'sched_setaffinity')
+        self.expected = max(1, expected)
+        self._grants: List[CpuGrant] = []
+
+    @property
+    def active(self) -> int:
+        return len(self._grants)
+
+    def share(self, processes: int) -> int:
+        """Threads per process when the given number of processes run at once"""
+        return max(1, len(self.cores) // max(1, processes))
+
+    @contextmanager
+    def grant(self) -> Iterator[CpuGrant]:
+        """Hold a share of the cores for the duration of the block"""
+        grant = CpuGrant(self.share(max(self.expected, self.active + 1)))
+        self._grants.append(grant)
+        self._rebalance()
+        try:
+            yield grant
+        finally:
+            self._grants.remove(grant)
+            self._rebalance()
+
+    def _rebalance(self) -> None:
+        """Give every grant a contiguous slice of the cores, oldest grants first"""
+        if not self.pin or not self._grants:
+            return
+
+        total = len(self.cores)
+        count = len(self._grants)
+        start = 0
+        for index, grant in enumerate(self._grants):
+            if count <= total:
+                size = total // count + (1 if index < total % count else 0)
+                grant.cores = set(self.cores[start:start + size])
+                start += size
+            else:
+                # More processes than cores: share them round-robin
+                grant.cores = {self.cores[index % total]}
+            grant.apply()
@@ -0,0 +1,137 @@
+"""
+Disk space budget for the video encoder bot
+"""
+import asyncio
+import logging
+import os
+import shutil
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class DiskSpaceError(Exception):
+    """Disk space for a reservation cannot be had"""
+
+def _locate(path: str) -> Tuple[int, str]:
+    """Filesystem device and closest existing directory that will hold path"""
+    directory = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    return os.stat(directory).st_dev, directory
+
+class DiskBudget:
+    """Reserves disk space for files before they are written
+
+    A reservation names the files a job is about to write with their expected
+    sizes. Until a file is released, the part of its estimate that is not yet
+    on disk counts against the free space of its filesystem, so concurrent
+    downloads and encodes cannot overcommit the disk between them. Files on
+    different filesystems (e.g. TEMP_DIR on a tmpfs) are accounted separately.
+    Reservations that do not fit wait, first come first served, until enough
+    files are released or space is freed by someone else.
+    """
+
+    def __init__(self, headroom: int = 0, poll_interval: float = 5.0):
+        self.headroom = headroom
+        self.poll_interval = poll_interval
+        self._files: Dict[str, Tuple[int, int]] = {}  # path -> (device, bytes)
+        self._waiting: deque = deque()
+        self._changed = asyncio.Event()
+
+    @property
+    def reserved(self) -> int:
+        """Bytes currently reserved, written or not"""
+        return sum(size for _, size in self._files.values())
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def paths(self) -> List[str]:
+        """Files currently holding a reservation"""
+        return list(self._files)
+
+    def outstanding(self, device: Optional[int] = None) -> int:
+        """Reserved bytes not yet on disk, optionally for one filesystem"""
+        total = 0
+        for path, (file_device, size) in self._files.items():
+            if device is not None and file_device != device:
+                continue
+            try:
+                written = os.path.getsize(path)
+            except OSError:
+                written = 0
+            total += max(0, size - written)
+        return total
+
+    @staticmethod
+    def _needs(located: Dict[str, Tuple[int, str, int]]) -> Dict[int, Tuple[str, int]]:
+        """Bytes requested per filesystem, with a directory on each"""
+        needs: Dict[int, Tuple[str, int]] = {}
+        for device, directory, size in located.values():
+            needs[device] = (directory, needs.get(device, (directory, 0))[1] + size)
+        return needs
+
+    def _fits(self, needs: Dict[int, Tuple[str, int]]) -> bool:
+        for device, (directory, size) in needs.items():
+            free = shutil.disk_usage(directory).free - self.outstanding(device) - self.headroom
+            if size > free:
+                return False
+        return True
+
+    async def reserve(self, files: Dict[str, int], on_wait: Optional[Callable[[], Awaitable[None]]] = None,
+                      timeout: Optional[float] = None) -> None:
+        """Reserve space for files {path: bytes}, waiting while the disk is full
+
+        on_wait is awaited once if the reservation has to wait. Raises
+        DiskSpaceError if the files could never fit, or on timeout.
+        """
+        located = {os.path.abspath(path): (*_locate(path), size) for path, size in files.items()}
+        needs = self._needs(located)
+        for directory, size in needs.values():
+            if size > shutil.disk_usage(directory).total - self.headroom:
+                raise DiskSpaceError(f"Not enough disk space in {directory} for {size} bytes")
+
+        ticket = object()
+        self._waiting.append(ticket)
+        deadline = time.monotonic() + timeout if timeout else None
+        notified = False
+
+        try:
+            while self._waiting[0] is not ticket or not self._fits(needs):
+                if not notified:
+                    notified = True
+                    logger.info(f"Waiting for disk space for {sum(files.values())} bytes "
+                                f"({self.waiting - 1} reservations ahead)")
+                    if on_wait:
+                        await on_wait()
+                    continue
+
+                remaining = deadline - time.monotonic() if deadline else self.poll_interval
+                if remaining <= 0:
+                    raise DiskSpaceError("Timed out waiting for disk space")
+
+                # Space can also be freed by other processes, so poll as well
+                self._changed.clear()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+
+            for path, (device, _, size) in located.items():
+                self._files[path] = (device, size)
+
+        finally:
+            self._waiting.remove(ticket)
+            self._changed.set()
+
+    def release(self, *paths: str) -> None:
+        """Return the space of files that were deleted or moved out of the budget"""
+        released = False
+        for path in paths:
+            if self._files.pop(os.path.abspath(path), None):
+                released = True
+        if released:
+            self._changed.set()
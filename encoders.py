@@ -0,0 +1,203 @@
+"""
+Encoder profiles for the video encoder bot
+"""
+import asyncio
+import logging
+import math
+from typing import List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Quality levels offered to users, fastest first
+QUALITY_LEVELS = ('ultrafast', 'fast', 'medium', 'slow', 'veryslow')
+DEFAULT_QUALITY = 'fast'
+
+# Encoders for each target codec (as ffprobe names it), preferred first
+VIDEO_ENCODERS = {
+    'h264': ['libx264'],
+    'hevc': ['libx265'],
+    'vp9': ['libvpx-vp9'],
+    'av1': ['libsvtav1', 'libaom-av1']
+}
+
+AUDIO_ENCODERS = {
+    'aac': ['aac'],
+    'opus': ['libopus']
+}
+
+# Assumed to exist when ffmpeg cannot be asked, as the bot always required them
+DEFAULT_ENCODERS = {'libx264', 'libvpx-vp9', 'aac', 'libopus'}
+
+# Per quality level: x264/x265 (preset, crf)
+X264_QUALITY = {
+    'ultrafast': ('ultrafast', 28),
+    'fast': ('fast', 23),
+    'medium': ('medium', 20),
+    'slow': ('slow', 18),
+    'veryslow': ('veryslow', 15)
+}
+
+# x265 reaches x264's quality at a higher CRF
+X265_QUALITY = {
+    'ultrafast': ('ultrafast', 32),
+    'fast': ('fast', 28),
+    'medium': ('medium', 25),
+    'slow': ('slow', 23),
+    'veryslow': ('veryslow', 20)
+}
+
+# libvpx-vp9 (deadline, cpu-used, crf); libvpx ignores -preset entirely
+VP9_QUALITY = {
+    'ultrafast': ('realtime', 8, 40),
+    'fast': ('good', 4, 34),
+    'medium': ('good', 2, 31),
+    'slow': ('good', 1, 28),
+    'veryslow': ('good', 0, 24)
+}
+
+# SVT-AV1 (preset, crf) and libaom (cpu-used, crf)
+SVTAV1_QUALITY = {
+    'ultrafast': (12, 40),
+    'fast': (10, 35),
+    'medium': (8, 32),
+    'slow': (6, 30),
+    'veryslow': (4, 28)
+}
+
+AOM_QUALITY = {
+    'ultrafast': (8, 40),
+    'fast': (6, 35),
+    'medium': (5, 32),
+    'slow': (4, 30),
+    'veryslow': (3, 28)
+}
+
+def tile_columns(height: Optional[int]) -> int:
+    """log2 of the tile columns for a 16:9 frame of this height (tiles are at least 256 px wide)"""
+    if not height:
+        return 0
+    width = height * 16 / 9
+    return max(0, min(6, int(math.log2(max(1.0, width / 256)))))
+
+def parse_encoders(output: str) -> Set[str]:
+    """Encoder names from `ffmpeg -encoders`"""
+    names = set()
+    listing = False
+    for line in output.splitlines():
+        if line.strip().startswith('------'):
+            listing = True
+            continue
+        fields = line.split()
+        if listing and len(fields) >= 2:
+            names.add(fields[1])
+    return names
+
+class EncoderRegistry:
+    """Encoders the local ffmpeg build provides, with tuned options per quality level
+
+    Until detect() has run, only the encoders the bot always relied on are
+    assumed to exist.
+    """
+
+    def __init__(self):
+        self.available: Set[str] = set(DEFAULT_ENCODERS)
+        self.detected = False
+
+    async def detect(self, ffmpeg: str = 'ffmpeg') -> Set[str]:
+        """Ask ffmpeg which encoders it was built with"""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                ffmpeg, '-hide_banner', '-encoders',
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            stdout, _ = await asyncio.wait_for(process.communicate(), 30)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Could not list ffmpeg encoders, assuming the defaults: {e}")
+            return self.available
+
+        names = parse_encoders(stdout.decode(errors='replace'))
+        if names:
+            self.available = names
+            self.detected = True
+        usable = [encoder for encoders in VIDEO_ENCODERS.values() for encoder in encoders if encoder in names]
+        logger.info(f"Video encoders available: {', '.join(usable) or 'none'}")
+        return self.available
+
+    def video_encoder(self, codec: str) -> Optional[str]:
+        return next((e for e in VIDEO_ENCODERS.get(codec, []) if e in self.available), None)
+
+    def audio_encoder(self, codec: str) -> Optional[str]:
+        return next((e for e in AUDIO_ENCODERS.get(codec, []) if e in self.available), None)
+
+    def supports(self, codec: str) -> bool:
+        return self.video_encoder(codec) is not None
+
+    def video_args(self, codec: str, quality: str, bitrate: Optional[int] = None,
+                   height: Optional[int] = None, threads: Optional[int] = None) -> List[str]:
+        """Encoder and rate control options for a video codec at a quality level
+
+        bitrate caps the stream: x264/x265 run CRF under a VBV maxrate, VP9 and
+        libaom use constrained quality with bitrate as the ceiling.
+        """
+        encoder = self.video_encoder(codec)
+        if encoder is None:
+            raise ValueError(f"No {codec} encoder available in this ffmpeg build")
+        quality = quality if quality in QUALITY_LEVELS else DEFAULT_QUALITY
+
+        if encoder == 'libx264':
+            preset, crf = X264_QUALITY[quality]
+            args = ['-c:v', encoder, '-preset', preset, '-crf', str(crf)]
+            args += self._vbv(bitrate)
+            # libx264 passes this on as its threads parameter
+            if threads:
+                args += ['-threads', str(threads)]
+
+        elif encoder == 'libx265':
+            preset, crf = X265_QUALITY[quality]
+            args = ['-c:v', encoder, '-preset', preset, '-crf', str(crf)]
+            args += self._vbv(bitrate)
+            if threads:
+                args += ['-x265-params', f"pools={threads}:log-level=error"]
+
+        elif encoder == 'libvpx-vp9':
+            deadline, cpu_used, crf = VP9_QUALITY[quality]
+            args = ['-c:v', encoder, '-deadline', deadline, '-cpu-used', str(cpu_used), '-crf', str(crf),
+                    '-b:v', str(bitrate or 0), '-row-mt', '1', '-tile-columns', str(tile_columns(height))]
+            if threads:
+                args += ['-threads', str(threads)]
+
+        elif encoder == 'libsvtav1':
+            preset, crf = SVTAV1_QUALITY[quality]
+            args = ['-c:v', encoder, '-preset', str(preset), '-crf', str(crf)]
+            if threads:
+                args += ['-svtav1-params', f"lp={threads}"]
+
+        else:
+            cpu_used, crf = AOM_QUALITY[quality]
+            args = ['-c:v', encoder, '-cpu-used', str(cpu_used), '-crf', str(crf), '-b:v', str(bitrate or 0),
+                    '-row-mt', '1', '-tile-columns', str(tile_columns(height))]
+            if threads:
+                args += ['-threads', str(threads)]
+
+        return args
+
+    @staticmethod
+    def _vbv(bitrate: Optional[int]) -> List[str]:
+        return ['-maxrate', str(bitrate), '-bufsize', str(bitrate * 2)] if bitrate else []
+
+    def audio_args(self, codec: str) -> List[str]:
+        """Encoder options for an audio codec"""
+        encoder = self.audio_encoder(codec)
+        if encoder is None:
+            raise ValueError(f"No {codec} encoder available in this ffmpeg build")
+        if encoder == 'libopus':
+            # Opus is transparent at lower bitrates than AAC
+            return ['-c:a', encoder, '-b:a', '96k', '-vbr', 'on']
+        return ['-c:a', encoder, '-b:a', '128k']
+
+    def summary(self) -> List[Tuple[str, Optional[str]]]:
+        """(codec, encoder used or None) for every video codec"""
+        return [(codec, self.video_encoder(codec)) for codec in VIDEO_ENCODERS]
+
+# Shared by every command builder in the process
+ENCODERS = EncoderRegistry()
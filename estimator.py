@@ -0,0 +1,214 @@
+"""
+Self-calibrating processing time estimator for the video encoder bot
+"""
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from store import Store
+from transcoder import RESOLUTION_PRESETS, TARGET_VIDEO_CODECS, plan_transcode
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS estimator_buckets (
+    bucket TEXT PRIMARY KEY,
+    samples INTEGER NOT NULL,
+    stats TEXT NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+# Seconds per second of source video used until a bucket has been measured
+PRIOR_RESOLUTION_FACTORS = {
+    '240p': 0.5,
+    '360p': 0.7,
+    '480p': 1.0,
+    '720p': 1.5,
+    '1080p': 2.5
+}
+
+PRIOR_QUALITY_FACTORS = {
+    'ultrafast': 0.3,
+    'fast': 0.7,
+    'medium': 1.0,
+    'slow': 1.8,
+    'veryslow': 3.0
+}
+
+PRIOR_COPY_FACTOR = 0.05
+
+# Regression features: intercept, work, and work slowed down by other jobs
+FEATURES = 3
+
+def solve(matrix: List[List[float]], vector: List[float]) -> Optional[List[float]]:
+    """Solve a small linear system by Gaussian elimination; None if singular"""
+    size = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(size)]
+
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(size):
+            if r != col:
+                factor = rows[r][col] / rows[col][col]
+                rows[r] = [a - factor * b for a, b in zip(rows[r], rows[col])]
+
+    return [rows[i][size] / rows[i][i] for i in range(size)]
+
+class ProcessingEstimator:
+    """Predicts encode seconds from measurements of finished jobs
+
+    Jobs are grouped into buckets by source codec, target codec and preset.
+    Each bucket keeps the running sums of a least-squares fit
+
+        seconds = a + b * work + c * work * (concurrent_jobs - 1)
+
+    where work is megapixel-frames decoded plus encoded. The sums are decayed
+    on every update so the fit follows hardware and load changes, and are
+    stored after each job, so calibration survives restarts. Buckets with too
+    few samples fall back to a codec-wide bucket and then to fixed priors.
+    """
+
+    def __init__(self, store: Store, watermark_text: Optional[str] = None,
+                 min_samples: int = 3, decay: float = 0.98):
+        self._store = store
+        self.watermark_text = watermark_text
+        self.min_samples = min_samples
+        self.decay = decay
+        store.execute(SCHEMA)
+        self._buckets: Dict[str, Dict[str, Any]] = {}
+        self.reload()
+
+    def reload(self) -> None:
+        """Pick up calibration recorded by other processes"""
+        self._buckets = {
+            row['bucket']: json.loads(row['stats'])
+            for row in self._store.execute("SELECT bucket, stats FROM estimator_buckets")
+        }
+
+    def _describe(self, info: Optional[Dict[str, Any]], outputs: List[Tuple[str, str]],
+                  quality: str) -> Tuple[List[str], float]:
+        """Bucket keys (most specific first) and work units of a job"""
+        source_codec = info.get('codec', 'unknown') if info else 'unknown'
+        duration = info.get('duration', 0) if info else 0
+        fps = (info.get('fps') or 30) if info else 30
+        width = info.get('width', 0) if info else 0
+        height = info.get('height', 0) if info else 0
+        frames = duration * fps
+
+        encoded_codecs = set()
+        pixels = width * height
+        for resolution, format_type in outputs:
+            plan = plan_transcode(info, resolution, format_type, self.watermark_text)
+            if plan['video'] != 'encode':
+                continue
+            encoded_codecs.add(TARGET_VIDEO_CODECS.get(format_type, 'h264'))
+            target_height = (plan['scale_height'] or height
+                             or RESOLUTION_PRESETS.get(resolution, {}).get('height', 0))
+            target_width = target_height * width / height if height else target_height * 16 / 9
+            pixels += target_width * target_height
+
+        if encoded_codecs:
+            target = '+'.join(sorted(encoded_codecs))
+            if len(outputs) > 1:
+                target = f"batch:{target}"
+        else:
+            target, quality = 'copy', '-'
+
+        keys = [f"{source_codec}|{target}|{quality}", f"*|{target}|{quality}"]
+        return keys, frames * pixels / 1e6
+
+    @staticmethod
+    def _features(work: float, concurrent: int) -> List[float]:
+        return [1.0, work, work * max(0, concurrent - 1)]
+
+    def _prior(self, info: Optional[Dict[str, Any]], outputs: List[Tuple[str, str]], quality: str) -> float:
+        duration = info.get('duration', 0) if info else 0
+        total = 0.0
+        for resolution, format_type in outputs:
+            plan = plan_transcode(info, resolution, format_type, self.watermark_text)
+            if plan['video'] == 'encode':
+                total += (duration * PRIOR_RESOLUTION_FACTORS.get(resolution, 1.0)
+                          * PRIOR_QUALITY_FACTORS.get(quality, 1.0))
+            else:
+                total += duration * PRIOR_COPY_FACTOR
+        return total
+
+    def _predict(self, key: str, x: List[float]) -> Optional[float]:
+        stats = self._buckets.get(key)
+        if not stats or stats['samples'] < self.min_samples:
+            return None
+
+        # A little ridge regularisation keeps young buckets solvable
+        xtx = [row[:] for row in stats['xtx']]
+        for i in range(1, FEATURES):
+            xtx[i][i] += 1e-6 * (xtx[i][i] or 1.0)
+
+        coefficients = solve(xtx, stats['xty'])
+        if coefficients:
+            prediction = sum(c * v for c, v in zip(coefficients, x))
+            if prediction > 0:
+                return prediction
+
+        # Degenerate fit: fall back to the bucket's average speed
+        return stats['seconds'] / stats['work'] * x[1] if stats['work'] else None
+
+    def estimate(self, info: Optional[Dict[str, Any]], outputs: List[Tuple[str, str]],
+                 quality: str, concurrent: int = 1) -> float:
+        """Expected seconds to encode outputs [(resolution, format), ...] in one run"""
+        keys, work = self._describe(info, outputs, quality)
+        x = self._features(work, concurrent)
+
+        for key in keys:
+            prediction = self._predict(key, x)
+            if prediction is not None:
+                return prediction
+
+        return self._prior(info, outputs, quality)
+
+    def record(self, info: Optional[Dict[str, Any]], outputs: List[Tuple[str, str]],
+               quality: str, concurrent: int, seconds: float) -> None:
+        """Feed the measured duration of a finished encode into its buckets"""
+        keys, work = self._describe(info, outputs, quality)
+        if work <= 0:
+            return
+        x = self._features(work, concurrent)
+
+        now = time.time()
+        d = self.decay
+        # Re-read inside the transaction: encoder workers update the same buckets
+        try:
+            with self._store.transaction() as conn:
+                for key in keys:
+                    row = conn.execute("SELECT stats FROM estimator_buckets WHERE bucket = ?", (key,)).fetchone()
+                    stats = json.loads(row['stats']) if row else {
+                        'samples': 0,
+                        'xtx': [[0.0] * FEATURES for _ in range(FEATURES)],
+                        'xty': [0.0] * FEATURES,
+                        'work': 0.0,
+                        'seconds': 0.0
+                    }
+                    stats['xtx'] = [[d * stats['xtx'][i][j] + x[i] * x[j] for j in range(FEATURES)]
+                                    for i in range(FEATURES)]
+                    stats['xty'] = [d * stats['xty'][i] + x[i] * seconds for i in range(FEATURES)]
+                    stats['work'] = d * stats['work'] + work
+                    stats['seconds'] = d * stats['seconds'] + seconds
+                    stats['samples'] += 1
+                    self._buckets[key] = stats
+                    conn.execute(
+                        "INSERT OR REPLACE INTO estimator_buckets (bucket, samples, stats, updated) VALUES (?, ?, ?, ?)",
+                        (key, stats['samples'], json.dumps(stats), now)
+                    )
+        except Exception as e:
+            # Calibration must never fail the job that produced it
+            logger.warning(f"Could not record encode timing: {e}")
+            return
+
+        logger.debug(f"Recorded {seconds:.1f}s for {keys[0]} ({work:.0f} work units, {concurrent} jobs)")
+
+    def calibrated_buckets(self) -> int:
+        return sum(1 for stats in self._buckets.values() if stats['samples'] >= self.min_samples)
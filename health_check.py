@@ -1,31 +1,58 @@
 """
-Health check endpoint for Render deployment
+Health check and metrics endpoints for Render deployment
 """
 import asyncio
 from aiohttp import web
 import logging
+from typing import Any, Callable, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
+HealthProbe = Callable[[], Dict[str, Any]]
+
 async def health_check(request):
-    """Simple health check endpoint"""
-    return web.json_response({
-        'status': 'healthy',
-        'service': 'video-encoder-bot'
-    })
-
-async def create_health_server():
-    """Create health check server"""
+    """Health check endpoint; answers 503 while the bot reports itself degraded"""
+    probe: Optional[HealthProbe] = request.app['health_probe']
+    report = {'status': 'healthy', 'service': 'video-encoder-bot'}
+
+    if probe:
+        try:
+            report.update(probe())
+        except Exception as e:
+            logger.error(f"Health probe failed: {e}")
+            report.update({'status': 'degraded', 'problems': [f"health probe failed: {e}"]})
+
+    return web.json_response(report, status=200 if report['status'] == 'healthy' else 503)
+
+async def metrics_endpoint(request):
+    """Prometheus text exposition of the bot's metrics"""
+    registry = request.app['metrics']
+    if registry is None:
+        raise web.HTTPNotFound()
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+async def create_health_server(metrics: Any = None, health_probe: Optional[HealthProbe] = None,
+                               port: int = 8080) -> web.AppRunner:
+    """Create health check server; call cleanup() on the returned runner to stop it"""
     app = web.Application()
+    app['metrics'] = metrics
+    app['health_probe'] = health_probe
     app.router.add_get('/health', health_check)
-    
-    runner = web.AppRunner(app)
+    app.router.add_get('/metrics', metrics_endpoint)
+
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
-    
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+
+    site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
-    
-    logger.info("Health check server started on port 8080")
+
+    logger.info(f"Health check server started on port {port}")
+    return runner
 
 if __name__ == "__main__":
-    asyncio.run(create_health_server())
\ No newline at end of file
+    async def serve():
+        await create_health_server()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
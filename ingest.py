@@ -0,0 +1,117 @@
+"""
+Streaming ingest for the video encoder bot
+
+Telegram media is pulled in chunks into a spool file that readers (ffprobe,
+ffmpeg) can follow while the transfer is still running.
+"""
+import asyncio
+import logging
+import struct
+from typing import Any, AsyncIterator, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bytes needed from the start of a file to decide whether it can be streamed
+HEAD_SIZE = 256 * 1024
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+def is_streamable(head: bytes) -> bool:
+    """Whether a container can be decoded front to back without seeking
+
+    Matroska/WebM, MPEG-TS and FLV always can. MP4/MOV only can when the moov
+    atom comes before the media data ("faststart"); anything unrecognised is
+    treated as not streamable.
+    """
+    if head.startswith(b'\x1a\x45\xdf\xa3'):  # EBML: Matroska / WebM
+        return True
+    if head.startswith(b'FLV'):
+        return True
+    if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47:  # MPEG-TS sync bytes
+        return True
+
+    # Walk the top-level ISO BMFF boxes
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box_type = struct.unpack('>I4s', head[offset:offset + 8])
+        if size == 1:
+            if offset + 16 > len(head):
+                return False
+            size = struct.unpack('>Q', head[offset + 8:offset + 16])[0]
+        elif size == 0:
+            return False  # Box runs to end of file
+
+        if box_type == b'moov':
+            return True
+        if box_type == b'mdat' or size < 8:
+            return False
+        offset += size
+
+    return False
+
+class SpoolFile:
+    """A file being written by a download that readers can follow as it grows"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._file = open(path, 'wb')
+        self._grown = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._grown.set()
+        self._grown = asyncio.Event()
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        self._file.flush()
+        self.size += len(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Mark the transfer complete (or failed) and wake all readers"""
+        if not self._file.closed:
+            self._file.close()
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def wait_for(self, size: int) -> None:
+        """Wait until at least size bytes are spooled or the transfer ended"""
+        while self.size < size and not self.done:
+            await self._grown.wait()
+
+    async def head(self, size: int = HEAD_SIZE) -> bytes:
+        await self.wait_for(size)
+        with open(self.path, 'rb') as f:
+            return f.read(size)
+
+    async def follow(self) -> AsyncIterator[bytes]:
+        """Yield the whole file from the start, waiting for data still in transit"""
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(READ_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                    continue
+                if self.done:
+                    if self.error:
+                        raise Exception(f"Download failed: {self.error}")
+                    return
+                await self._grown.wait()
+
+async def stream_to_spool(client: Any, message: Any, spool: SpoolFile,
+                          progress: Optional[Callable[[int, int], Any]] = None) -> None:
+    """Pull a message's media through Pyrogram's stream_media into the spool"""
+    media = message.video or message.document
+    try:
+        async for chunk in client.stream_media(message):
+            spool.write(chunk)
+            if progress:
+                progress(spool.size, media.file_size)
+        spool.finish()
+    except BaseException as e:
+        spool.finish(e)
+        raise
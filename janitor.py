@@ -0,0 +1,142 @@
+"""
+Session expiry and storage janitor for the video encoder bot
+"""
+import asyncio
+import heapq
+import logging
+import os
+import shutil
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class ExpiryQueue:
+    """Deadline min-heap that calls back each key when its deadline passes
+
+    Rescheduling or cancelling a key leaves its old heap entry behind; stale
+    entries are recognised against the current deadline and skipped. The
+    callback may return a new deadline to postpone the key instead of letting
+    it go.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, Hashable]] = []
+        self._deadlines: Dict[Hashable, float] = {}
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def schedule(self, key: Hashable, deadline: float) -> None:
+        """Expire key at deadline (a time.time() value), replacing any earlier schedule"""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if self._heap[0][1] == key:
+            self._changed.set()
+
+    def cancel(self, key: Hashable) -> None:
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self) -> Optional[float]:
+        """Earliest live deadline, dropping stale heap entries on the way"""
+        while self._heap:
+            deadline, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    async def run(self, on_expire: Callable[[Hashable], Awaitable[Optional[float]]]) -> None:
+        """Call on_expire(key) as deadlines pass, until cancelled"""
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > time.time():
+                self._changed.clear()
+                timeout = None if deadline is None else deadline - time.time()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            try:
+                postponed = await on_expire(key)
+            except Exception as e:
+                logger.error(f"Expiring {key} failed: {e}")
+                continue
+            if postponed is not None:
+                self.schedule(key, postponed)
+
+def last_modified(path: str) -> float:
+    """mtime of a file, or the newest mtime of a directory and its entries"""
+    latest = os.stat(path).st_mtime
+    if os.path.isdir(path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    latest = max(latest, entry.stat(follow_symlinks=False).st_mtime)
+                except OSError:
+                    pass
+    return latest
+
+class StorageJanitor:
+    """Removes files and directories nothing refers to any more
+
+    Crashes and failed uploads leave files behind that no session or job
+    owns. A sweep deletes entries of the storage directories that the caller
+    does not report live and that have not been touched for min_age seconds
+    (so files being written right now are safe), at most max_deletions per
+    pass. sweep() does blocking I/O; run it off the event loop, with an
+    is_live that only reads a snapshot.
+    """
+
+    def __init__(self, directories: List[str], min_age: float = 3600, max_deletions: int = 100):
+        self.directories = directories
+        self.min_age = min_age
+        self.max_deletions = max_deletions
+        self.removed = 0
+
+    def sweep(self, is_live: Callable[[str], bool]) -> int:
+        """One pass over the directories; returns the number of entries removed"""
+        now = time.time()
+        removed = 0
+
+        for directory in self.directories:
+            try:
+                with os.scandir(directory) as scan:
+                    entries = [entry.path for entry in scan]
+            except FileNotFoundError:
+                continue
+
+            for path in entries:
+                if removed >= self.max_deletions:
+                    logger.info(f"Janitor stopped after {removed} deletions, continuing next pass")
+                    self.removed += removed
+                    return removed
+                if is_live(path):
+                    continue
+
+                try:
+                    if now - last_modified(path) < self.min_age:
+                        continue
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    logger.warning(f"Janitor could not remove {path}: {e}")
+                    continue
+
+                logger.info(f"Janitor removed orphan {path}")
+                removed += 1
+
+        self.removed += removed
+        return removed
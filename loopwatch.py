@@ -0,0 +1,121 @@
+"""
+Event loop watchdog for the video encoder bot
+"""
+import asyncio
+import logging
+import os
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from metrics import Histogram, LoopLagMonitor
+
+logger = logging.getLogger(__name__)
+
+# Frames under these directories belong to Python or installed packages, not the bot
+_LIBRARY_DIRS = tuple(
+    os.path.realpath(path) + os.sep
+    for path in {sysconfig.get_paths()['stdlib'], sysconfig.get_paths()['purelib'], sysconfig.get_paths()['platlib']}
+)
+
+def _culprit(stack: traceback.StackSummary) -> str:
+    """Innermost bot function on a stack, or the innermost frame if there is none"""
+    for frame in reversed(stack):
+        if not os.path.realpath(frame.filename).startswith(_LIBRARY_DIRS):
+            break
+    else:
+        frame = stack[-1]
+    return f"{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})"
+
+class LoopWatchdog(LoopLagMonitor):
+    """Lag monitor that also catches whatever blocks the event loop
+
+    A helper thread watches the monitor's wake-ups. Once the loop has missed
+    one by threshold seconds, the thread grabs the loop thread's stack with
+    sys._current_frames() while it is still blocked, and logs it together
+    with the task (handler) that was running and the innermost bot function
+    on the stack. When the loop wakes up again the stall is logged with its
+    full duration and kept in stalls; culprits counts stalls per function.
+    """
+
+    def __init__(self, threshold: float = 0.5, interval: float = 0.1, histogram: Optional[Histogram] = None):
+        super().__init__(interval, histogram)
+        self.threshold = threshold
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=100)
+        self.culprits: Dict[str, int] = {}
+        self._beat = time.monotonic()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._stall: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        super().start()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        await super().stop()
+        if self._thread:
+            await asyncio.to_thread(self._thread.join, 1.0)
+
+    def _tick(self, lag: float) -> None:
+        super()._tick(lag)
+        self._beat = time.monotonic()
+
+        with self._lock:
+            stall, self._stall = self._stall, None
+        if stall:
+            stall['duration'] = round(lag, 3)
+            self.stalls.append(stall)
+            logger.warning(f"Event loop was blocked for {lag:.2f}s in {stall['culprit']} (task {stall['task']})")
+
+    def _running_task(self) -> str:
+        """Coroutine of the task the loop is running, read from the watchdog thread"""
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            task = None
+        if task is None:
+            return 'callback'
+        coro = task.get_coro()
+        return getattr(coro, '__qualname__', task.get_name())
+
+    def _watch(self) -> None:
+        """Watchdog thread: capture the loop thread's stack while it is blocked"""
+        poll = min(self.interval, self.threshold / 4)
+        while not self._stopped.wait(poll):
+            blocked = time.monotonic() - self._beat - self.interval
+            if blocked < self.threshold:
+                continue
+
+            with self._lock:
+                if self._stall is not None:
+                    continue  # This stall has been reported already
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is None:
+                    continue
+                stack = traceback.extract_stack(frame)
+                del frame
+                culprit = _culprit(stack)
+                stall = self._stall = {
+                    'time': time.time(),
+                    'task': self._running_task(),
+                    'culprit': culprit,
+                    'stack': stack.format()
+                }
+                self.culprits[culprit] = self.culprits.get(culprit, 0) + 1
+
+            logger.warning(f"Event loop blocked for {blocked:.2f}s so far in {culprit} "
+                           f"(task {stall['task']}):\n{''.join(stall['stack'])}")
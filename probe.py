@@ -0,0 +1,243 @@
+"""
+Async ffprobe metadata service for the video encoder bot
+"""
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from fractions import Fraction
+from typing import Any, Dict, List, Optional, TypedDict
+
+logger = logging.getLogger(__name__)
+
+class StreamInfo(TypedDict):
+    """One probed stream"""
+    index: int
+    codec_type: str
+    codec_name: str
+    bitrate: int
+    width: int
+    height: int
+    fps: float
+    pix_fmt: Optional[str]
+    channels: int
+    sample_rate: int
+
+class VideoInfo(TypedDict):
+    """Probed source metadata; the top-level fields describe the first video/audio streams"""
+    duration: float
+    width: int
+    height: int
+    codec: str
+    bitrate: int
+    fps: float
+    pix_fmt: Optional[str]
+    keyframe_interval: Optional[float]
+    has_audio: bool
+    audio_codec: Optional[str]
+    audio_bitrate: int
+    streams: List[StreamInfo]
+
+def parse_rational(value: Optional[str]) -> float:
+    """Parse an ffprobe rational such as '30000/1001' without eval"""
+    try:
+        fraction = Fraction(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return 0.0
+    return float(fraction)
+
+def _to_int(value: Any) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def parse_probe_data(data: Dict[str, Any]) -> Optional[VideoInfo]:
+    """Build a VideoInfo from ffprobe's JSON output; None when there is no video stream"""
+    streams: List[StreamInfo] = [
+        {
+            'index': _to_int(s.get('index')),
+            'codec_type': s.get('codec_type', 'unknown'),
+            'codec_name': s.get('codec_name', 'unknown'),
+            'bitrate': _to_int(s.get('bit_rate')),
+            'width': _to_int(s.get('width')),
+            'height': _to_int(s.get('height')),
+            'fps': parse_rational(s.get('avg_frame_rate')) or parse_rational(s.get('r_frame_rate')),
+            'pix_fmt': s.get('pix_fmt'),
+            'channels': _to_int(s.get('channels')),
+            'sample_rate': _to_int(s.get('sample_rate'))
+        }
+        for s in data.get('streams', [])
+    ]
+
+    video_stream = next((s for s in streams if s['codec_type'] == 'video'), None)
+    audio_stream = next((s for s in streams if s['codec_type'] == 'audio'), None)
+
+    if not video_stream:
+        return None
+
+    fmt = data.get('format', {})
+    return {
+        'duration': _to_float(fmt.get('duration')),
+        'width': video_stream['width'],
+        'height': video_stream['height'],
+        'codec': video_stream['codec_name'],
+        'bitrate': _to_int(fmt.get('bit_rate')),
+        'fps': video_stream['fps'],
+        'pix_fmt': video_stream['pix_fmt'],
+        'keyframe_interval': None,
+        'has_audio': audio_stream is not None,
+        'audio_codec': audio_stream['codec_name'] if audio_stream else None,
+        'audio_bitrate': audio_stream['bitrate'] if audio_stream else 0,
+        'streams': streams
+    }
+
+class ProbeService:
+    """Runs ffprobe off the event loop under a concurrency limit and memoises results
+
+    Results are keyed on the caller's cache key (the Telegram file_unique_id)
+    in a bounded LRU, so re-sent files are never probed twice.
+    """
+
+    # How much of the source to scan when measuring the keyframe interval
+    KEYFRAME_SCAN_SECONDS = 30
+
+    def __init__(self, max_concurrent: int = 4, cache_size: int = 256, timeout: float = 30):
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._cache: 'OrderedDict[str, VideoInfo]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_cached(self, cache_key: Optional[str]) -> Optional[VideoInfo]:
+        if not cache_key:
+            return None
+        if cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            self.hits += 1
+            return self._cache[cache_key]
+        self.misses += 1
+        return None
+
+    def remember(self, cache_key: Optional[str], info: Optional[VideoInfo]) -> None:
+        """Memoise a complete result"""
+        if not cache_key or not info or not info['duration']:
+            return
+        self._cache[cache_key] = info
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _run(self, args: List[str], stdin_feed: Optional[Any] = None, timeout: Optional[float] = None) -> Optional[bytes]:
+        """Run ffprobe with the given arguments and return stdout, or None on failure"""
+        async with self._semaphore:
+            process = await asyncio.create_subprocess_exec(
+                'ffprobe', '-v', 'quiet', *args,
+                stdin=asyncio.subprocess.PIPE if stdin_feed else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+
+            feeder = asyncio.create_task(stdin_feed(process)) if stdin_feed else None
+            try:
+                stdout = await asyncio.wait_for(process.stdout.read(), timeout or self.timeout)
+                await process.wait()
+            except asyncio.TimeoutError:
+                logger.warning(f"ffprobe timed out: {' '.join(args)}")
+                return None
+            finally:
+                if feeder:
+                    feeder.cancel()
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+            return stdout if process.returncode == 0 else None
+
+    async def _keyframe_interval(self, file_path: str) -> Optional[float]:
+        """Average seconds between keyframes over the start of the file"""
+        stdout = await self._run([
+            '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+            '-of', 'csv=p=0', '-read_intervals', f"%+{self.KEYFRAME_SCAN_SECONDS}", file_path
+        ])
+        if not stdout:
+            return None
+
+        keyframes = []
+        for line in stdout.decode(errors='replace').splitlines():
+            pts_time, _, flags = line.partition(',')
+            if 'K' in flags and pts_time not in ('', 'N/A'):
+                keyframes.append(float(pts_time))
+
+        if len(keyframes) < 2:
+            return None
+        return (keyframes[-1] - keyframes[0]) / (len(keyframes) - 1)
+
+    async def probe(self, file_path: str, cache_key: Optional[str] = None, refresh: bool = False) -> Optional[VideoInfo]:
+        """Probe a file on disk"""
+        if not refresh:
+            cached = self.get_cached(cache_key)
+            if cached:
+                return cached
+
+        try:
+            stdout = await self._run(['-print_format', 'json', '-show_format', '-show_streams', file_path])
+            if not stdout:
+                return None
+
+            info = parse_probe_data(json.loads(stdout))
+            if info:
+                info['keyframe_interval'] = await self._keyframe_interval(file_path)
+                self.remember(cache_key, info)
+            return info
+
+        except Exception as e:
+            logger.error(f"Error getting video info for {file_path}: {e}")
+            return None
+
+    async def probe_stream(self, spool: Any, cache_key: Optional[str] = None, timeout: float = 60) -> Optional[VideoInfo]:
+        """Probe a spool that is still downloading by piping it through stdin"""
+        cached = self.get_cached(cache_key)
+        if cached:
+            return cached
+
+        async def feed(process):
+            stream = spool.follow()
+            try:
+                async for chunk in stream:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # ffprobe has read all it needs
+            finally:
+                await stream.aclose()
+                if not process.stdin.is_closing():
+                    process.stdin.close()
+
+        try:
+            stdout = await self._run(
+                ['-print_format', 'json', '-show_format', '-show_streams', '-i', 'pipe:0'],
+                stdin_feed=feed, timeout=timeout
+            )
+            if not stdout:
+                return None
+
+            info = parse_probe_data(json.loads(stdout))
+            self.remember(cache_key, info)
+            return info
+
+        except Exception as e:
+            logger.error(f"Error probing stream {spool.path}: {e}")
+            return None
+
+    async def validate(self, file_path: str) -> bool:
+        """Whether a file is a decodable video with a duration"""
+        info = await self.probe(file_path)
+        return info is not None and info['duration'] > 0
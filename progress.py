@@ -0,0 +1,184 @@
+"""
+Coalescing, rate-limited progress message editor for the video encoder bot
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from pyrogram.errors import FloodWait, MessageNotModified
+
+logger = logging.getLogger(__name__)
+
+class ProgressReporter:
+    """Keeps only the latest progress text per message and flushes it politely
+
+    Each message is edited at most once every min_interval seconds per chat,
+    all edits share a global edits-per-second budget, identical texts are
+    dropped, and FloodWait pauses the flusher for as long as Telegram asks.
+    A reply markup set for a message (e.g. a Cancel button) is sent with
+    every edit of it, since an edit without one removes the buttons.
+    """
+
+    def __init__(self, min_interval: float = 3.0, edits_per_second: float = 20.0):
+        self.min_interval = min_interval
+        self.edits_per_second = edits_per_second
+        self.flood_waits = 0
+        self.edits = 0
+        self._pending: 'OrderedDict[Tuple[int, int], Tuple[Any, str]]' = OrderedDict()
+        self._last_text: 'OrderedDict[Tuple[int, int], str]' = OrderedDict()
+        self._markup: Dict[Tuple[int, int], Any] = {}
+        self._chat_ready: Dict[int, float] = {}
+        self._tokens = edits_per_second
+        self._tokens_updated = time.monotonic()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @staticmethod
+    def _key(message: Any) -> Tuple[int, int]:
+        return (message.chat.id, message.id)
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def set_markup(self, message: Any, markup: Any) -> None:
+        """Keep markup on the message through later edits; None stops adding it"""
+        key = self._key(message)
+        if markup is None:
+            self._markup.pop(key, None)
+        else:
+            self._markup[key] = markup
+
+    async def clear_markup(self, message: Any) -> None:
+        """Remove the markup set for the message from the message itself"""
+        if self._markup.pop(self._key(message), None) is None:
+            return
+        try:
+            await message.edit_reply_markup(None)
+        except Exception as e:
+            logger.debug(f"Could not remove buttons: {e}")
+
+    def update(self, message: Any, text: str) -> None:
+        """Record the latest progress text; may be called from any thread
+
+        Pyrogram runs sync progress callbacks on its executor threads, so
+        calls from outside the event loop are handed over to it instead of
+        touching the pending edits (or the wakeup event) from that thread.
+        """
+        if self._loop is not None and not self._on_loop():
+            self._loop.call_soon_threadsafe(self._update, message, text)
+            return
+        self._update(message, text)
+
+    def _on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _update(self, message: Any, text: str) -> None:
+        key = self._key(message)
+        if self._last_text.get(key) == text:
+            self._pending.pop(key, None)
+            return
+
+        self._pending[key] = (message, text)
+        self._wakeup.set()
+
+    async def edit_now(self, message: Any, text: str, reply_markup: Any = None) -> None:
+        """Replace any pending progress with a status text and send it right away
+
+        reply_markup, when given, is sent instead of the message's own markup.
+        """
+        key = self._key(message)
+        self._pending.pop(key, None)
+        if self._last_text.get(key) == text and reply_markup is None:
+            return
+
+        for _ in range(2):
+            try:
+                await message.edit_text(text, reply_markup=reply_markup or self._markup.get(key))
+                self._remember(key, text)
+                return
+            except MessageNotModified:
+                self._remember(key, text)
+                return
+            except FloodWait as e:
+                self.flood_waits += 1
+                logger.warning(f"FloodWait of {e.value}s on status edit")
+                await asyncio.sleep(e.value)
+
+    def _remember(self, key: Tuple[int, int], text: str) -> None:
+        self.edits += 1
+        self._last_text[key] = text
+        self._last_text.move_to_end(key)
+        self._chat_ready[key[0]] = time.monotonic() + self.min_interval
+        while len(self._last_text) > 1000:
+            self._last_text.popitem(last=False)
+
+    async def _take_token(self) -> None:
+        """Global token bucket limiting edits per second"""
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.edits_per_second,
+                               self._tokens + (now - self._tokens_updated) * self.edits_per_second)
+            self._tokens_updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.edits_per_second)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._flush_next()
+            except Exception as e:
+                # One bad edit must not stop progress reporting for everyone
+                logger.warning(f"Progress flusher error: {e}")
+                await asyncio.sleep(1)
+
+    async def _flush_next(self) -> None:
+        """Wait for pending progress and send the next edit that is due"""
+        if not self._pending:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+            return
+
+        now = time.monotonic()
+        ready = next((key for key in self._pending if self._chat_ready.get(key[0], 0) <= now), None)
+        if ready is None:
+            # Sleep until the earliest chat may be edited again, or new work arrives
+            delay = min(self._chat_ready.get(key[0], 0) for key in self._pending) - now
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(0.05, delay))
+            except asyncio.TimeoutError:
+                pass
+            return
+
+        await self._take_token()
+        entry = self._pending.pop(ready, None)
+        if entry is None:
+            return
+        message, text = entry
+
+        try:
+            await message.edit_text(text, reply_markup=self._markup.get(ready))
+            self._remember(ready, text)
+        except MessageNotModified:
+            self._remember(ready, text)
+        except FloodWait as e:
+            self.flood_waits += 1
+            logger.warning(f"FloodWait of {e.value}s while editing progress")
+            self._pending.setdefault(ready, entry)
+            await asyncio.sleep(e.value)
+        except Exception as e:
+            logger.debug(f"Progress edit skipped: {e}")
@@ -0,0 +1,472 @@
+"""
+Bounded, fair job scheduler for the video encoder bot
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Lower value runs first
+PRIORITY_ADMIN = 0
+PRIORITY_SHORT = 1
+PRIORITY_NORMAL = 2
+
+class Job:
+    """A unit of work waiting for, or holding, a worker slot"""
+
+    def __init__(self, user_id: int, video_id: str, run: Callable[[], Awaitable[Any]],
+                 priority: int = PRIORITY_NORMAL, cost: float = 0.0):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.video_id = video_id
+        self.run = run
+        self.priority = priority
+        self.cost = cost  # Estimated run time in seconds
+        self.seq = 0
+        self.state = 'queued'
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.preemptible = False  # Set when a stopped run keeps its progress for the next one
+        self.preempted = False  # True while a preempted run is unwinding
+        self.preemptions = 0
+        self.cancelled = False
+        self.requeued = False  # Set by a run that gives the job back to the queue when it returns
+        self.successor: Optional['Job'] = None  # Attached job taking over the worker slot
+        self.resume: Dict[str, Any] = {}  # State a preempted run leaves for its next run
+
+    def sort_key(self) -> Tuple[int, float, int]:
+        """Priority class first, then shortest job first"""
+        return (self.priority, self.cost, self.seq)
+
+    def remaining(self, now: Optional[float] = None) -> float:
+        """Estimated seconds until this job finishes"""
+        if self.started is None:
+            return self.cost
+        return max(0.0, self.cost - ((now or time.time()) - self.started))
+
+class ProcessingQueueView(Mapping):
+    """Read-only user_id -> video_id view of the scheduler's active jobs"""
+
+    def __init__(self, scheduler: 'JobScheduler'):
+        self._scheduler = scheduler
+
+    def _snapshot(self) -> Dict[int, str]:
+        view = {}
+        for job in self._scheduler.jobs():
+            view.setdefault(job.user_id, job.video_id)
+        return view
+
+    def __getitem__(self, user_id: int) -> str:
+        return self._snapshot()[user_id]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._snapshot())
+
+    def __len__(self) -> int:
+        return len(self._snapshot())
+
+class JobScheduler:
+    """Fixed-size worker pool with per-user round-robin and priority classes
+
+    Each user has their own priority queue, ordered by priority class and
+    then by estimated cost (shortest job first). When a worker becomes free,
+    the best priority class among the users' head jobs is chosen, and ties are
+    broken in round-robin order across users so one user's backlog cannot
+    starve everybody else.
+
+    With preemption enabled, a job submitted while every worker is busy may
+    stop a running preemptible job of a worse priority class that has run for
+    at least preempt_after seconds and still has more work left than the new
+    job. The stopped job goes back to its queue under its original sequence
+    number and runs again (resuming from its saved state) once a worker frees.
+
+    can_start, if given, is asked before a job is started while others are
+    running; while it says no (e.g. the machine is short of memory) queued
+    jobs are held back and checked again every hold_interval seconds.
+    """
+
+    def __init__(self, max_workers: int, preempt_after: float = 0, max_preemptions: int = 2,
+                 can_start: Optional[Callable[[], bool]] = None, hold_interval: float = 1.0):
+        self.max_workers = max(1, max_workers)
+        self.preempt_after = preempt_after  # 0 disables preemption
+        self.max_preemptions = max_preemptions
+        self.can_start = can_start
+        self.hold_interval = hold_interval
+        self._queues: Dict[int, List[Tuple[Tuple[int, int], Job]]] = {}
+        self._rotation: deque = deque()
+        self._jobs: Dict[str, Job] = {}
+        self._running: Dict[str, Job] = {}
+        self._attached: Dict[str, Job] = {}
+        self._seq = itertools.count()
+        self._last_seq = -1
+        self._pending = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Start the worker pool"""
+        for n in range(self.max_workers):
+            self._workers.append(asyncio.create_task(self._worker(n)))
+        logger.info(f"Job scheduler started with {self.max_workers} workers")
+
+    async def stop(self) -> None:
+        """Stop the workers, cancelling any running jobs"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def submit(self, job: Job) -> Job:
+        """Queue a job for execution"""
+        job.seq = self._last_seq = next(self._seq)
+        self._jobs[job.job_id] = job
+        self._enqueue(job)
+
+        victim = self._preemption_victim(job)
+        if victim:
+            self.preempt(victim)
+        return job
+
+    def attach(self, job: Job) -> Job:
+        """Run a job that only waits on work already in progress, without a worker slot
+
+        It is listed and can be cancelled like any other job, but is not
+        counted against the workers or preempted until a running job hands
+        its slot over (see hand_off). If the work is gone by the time the job
+        gets to it, the run calls requeue() and the job waits in the queue
+        for a slot like any other.
+        """
+        job.seq = self._last_seq = next(self._seq)
+        self._jobs[job.job_id] = job
+        self._attached[job.job_id] = job
+        job.state = 'running'
+        job.started = time.time()
+        job.task = asyncio.create_task(job.run())
+        job.task.add_done_callback(lambda task: self._detach(job, task))
+        logger.info(f"Job {job.job_id} for user {job.user_id} attached to work in progress")
+        return job
+
+    def _detach(self, job: Job, task: asyncio.Task) -> None:
+        if self._attached.pop(job.job_id, None) is None:
+            return  # Handed a worker slot; that worker finishes it
+        if job.requeued and not job.cancelled:
+            self._requeue(job)
+            logger.info(f"Attached job {job.job_id} queued for a worker")
+            return
+        if not task.cancelled() and task.exception():
+            logger.error(f"Job {job.job_id} failed: {task.exception()}")
+        job.state = 'done'
+        self._jobs.pop(job.job_id, None)
+
+    def is_attached(self, job: Job) -> bool:
+        return job.job_id in self._attached
+
+    def holds_slot(self, job: Job) -> bool:
+        """Whether job runs in a worker slot, or has been handed one"""
+        return job.job_id in self._running or any(running.successor is job for running in self._running.values())
+
+    def hand_off(self, job: Job, successor: Job) -> bool:
+        """Pass job's worker slot on to an attached job once job's run has unwound
+
+        For a job leaving work that the successor still waits on: the work
+        keeps running in that slot instead of outside the pool. The successor
+        is counted and can be preempted like any running job from then on.
+        """
+        if job.job_id not in self._running or job.successor or self._attached.pop(successor.job_id, None) is None:
+            return False
+        job.successor = successor
+        logger.info(f"Job {job.job_id} hands its worker slot to job {successor.job_id}")
+        return True
+
+    def requeue(self, job: Job) -> None:
+        """Queue a running or attached job again once its current run returns"""
+        job.requeued = True
+
+    def _requeue(self, job: Job) -> None:
+        job.state = 'queued'
+        job.started = None
+        job.task = None
+        job.preempted = False
+        job.requeued = False
+        self._enqueue(job)
+
+    def _enqueue(self, job: Job) -> None:
+        if job.user_id not in self._queues:
+            self._queues[job.user_id] = []
+            self._rotation.append(job.user_id)
+        heapq.heappush(self._queues[job.user_id], (job.sort_key(), job))
+        self._pending.set()
+
+    def cancel(self, job_id: str) -> bool:
+        """Withdraw a queued job or stop a running one; False if there is no such job
+
+        A running job is cancelled through its task and leaves the scheduler
+        when it has unwound; a queued job is removed right away.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancelled = True
+
+        if job.state == 'running':
+            if job.task and not job.task.done():
+                job.task.cancel()
+            return True
+
+        queue = self._queues[job.user_id]
+        queue[:] = [entry for entry in queue if entry[1] is not job]
+        heapq.heapify(queue)
+        if not queue:
+            del self._queues[job.user_id]
+            self._rotation.remove(job.user_id)
+
+        job.state = 'cancelled'
+        del self._jobs[job_id]
+        logger.info(f"Job {job_id} withdrawn from the queue")
+        return True
+
+    def preempt(self, job: Job) -> bool:
+        """Stop a running job and put it back in the queue"""
+        if job.state != 'running' or not job.task or job.task.done() or job.preempted:
+            return False
+        job.preempted = True
+        job.preemptions += 1
+        job.task.cancel()
+        logger.info(f"Preempting job {job.job_id} of user {job.user_id} "
+                    f"({job.remaining():.0f}s left, preemption {job.preemptions})")
+        return True
+
+    def _preemption_victim(self, job: Job) -> Optional[Job]:
+        """The running job to stop so that job can start, if any"""
+        if not self.preempt_after or len(self._running) < self.max_workers:
+            return None
+
+        now = time.time()
+        candidates = [
+            running for running in self._running.values()
+            if running.preemptible and not running.preempted and not running.cancelled
+            and running.preemptions < self.max_preemptions
+            and running.priority > job.priority
+            and now - running.started >= self.preempt_after
+            and running.remaining(now) > job.cost
+        ]
+        # Worst priority class first, then the most work left
+        return max(candidates, key=lambda running: (running.priority, running.remaining(now)), default=None)
+
+    def jobs(self) -> List[Job]:
+        """All queued and running jobs, oldest first"""
+        return sorted(self._jobs.values(), key=lambda job: job.seq)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def jobs_for_user(self, user_id: int) -> List[Job]:
+        return [job for job in self.jobs() if job.user_id == user_id]
+
+    def find_by_video(self, video_id: str) -> Optional[Job]:
+        return next((job for job in self._jobs.values() if job.video_id == video_id), None)
+
+    @property
+    def running_count(self) -> int:
+        return len(self._running)
+
+    @property
+    def queued_count(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _pick_from(self, queues: Dict[int, list], rotation: deque) -> Optional[Job]:
+        """Pop the next job to dispatch from the given queues and rotation"""
+        best_user = None
+        best_key = None
+
+        for index, user_id in enumerate(rotation):
+            head_key, _ = queues[user_id][0]
+            key = (head_key[0], index)
+            if best_key is None or key < best_key:
+                best_key = key
+                best_user = user_id
+
+        if best_user is None:
+            return None
+
+        _, job = heapq.heappop(queues[best_user])
+        rotation.remove(best_user)
+        if queues[best_user]:
+            rotation.append(best_user)
+        else:
+            del queues[best_user]
+
+        return job
+
+    def dispatch_order(self, extra: Optional[Job] = None) -> List[Job]:
+        """Queued jobs in the order they would be started, optionally with one more job submitted"""
+        queues = {user_id: list(heap) for user_id, heap in self._queues.items()}
+        rotation = deque(self._rotation)
+        order = []
+
+        if extra is not None:
+            if extra.user_id not in queues:
+                queues[extra.user_id] = []
+                rotation.append(extra.user_id)
+            heapq.heappush(queues[extra.user_id], (extra.sort_key(), extra))
+
+        while rotation:
+            order.append(self._pick_from(queues, rotation))
+
+        return order
+
+    def position(self, job_id: str) -> Tuple[int, float]:
+        """Queue position (1-based, 0 when running) and estimated seconds until start"""
+        job = self._jobs.get(job_id)
+        if job is None or job.state == 'running':
+            return 0, 0.0
+        return self._simulate(job)
+
+    def predict_start(self, job: Job) -> Tuple[int, float]:
+        """Where a job would be queued, and when it would start, if submitted now"""
+        job.seq = self._last_seq + 1
+        return self._simulate(job, extra=job)
+
+    def _simulate(self, job: Job, extra: Optional[Job] = None) -> Tuple[int, float]:
+        """Simulate the worker pool against the current estimates"""
+        now = time.time()
+        free_at = sorted(running.remaining(now) for running in self._running.values())
+        free_at += [0.0] * (self.max_workers - len(free_at))
+
+        for position, queued in enumerate(self.dispatch_order(extra), 1):
+            slot = min(range(len(free_at)), key=free_at.__getitem__)
+            if queued is job:
+                return position, free_at[slot]
+            free_at[slot] += queued.cost
+
+        return 0, 0.0
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            while not self._rotation:
+                self._pending.clear()
+                await self._pending.wait()
+
+            if self._running and self.can_start and not self.can_start():
+                await asyncio.sleep(self.hold_interval)
+                continue
+
+            job = self._pick_from(self._queues, self._rotation)
+            if job is None:
+                continue
+
+            job.state = 'running'
+            job.started = time.time()
+            self._running[job.job_id] = job
+
+            logger.info(f"Worker {worker_id} started job {job.job_id} for user {job.user_id} "
+                        f"after {job.started - job.created:.1f}s in queue")
+
+            job.task = asyncio.create_task(job.run())
+            while job:
+                job = await self._finish(job)
+
+    async def _finish(self, job: Job) -> Optional[Job]:
+        """Wait for a running job in this worker's slot; returns the job taking the slot over, if any"""
+        try:
+            await job.task
+        except asyncio.CancelledError:
+            if job.task and not job.task.done():
+                job.task.cancel()
+                raise
+            if not job.preempted:
+                logger.info(f"Job {job.job_id} cancelled")
+        except Exception as e:
+            logger.error(f"Job {job.job_id} failed: {e}")
+        finally:
+            self._running.pop(job.job_id, None)
+            if job.preempted and not job.cancelled and job.task.cancelled():
+                # Back in line under its original seq; its remaining cost is what is left
+                job.cost = job.remaining()
+                self._requeue(job)
+                logger.info(f"Job {job.job_id} re-queued after preemption")
+            elif job.requeued and not job.cancelled:
+                self._requeue(job)
+                logger.info(f"Job {job.job_id} re-queued")
+            else:
+                job.state = 'done'
+                self._jobs.pop(job.job_id, None)
+
+        successor, job.successor = job.successor, None
+        if successor:
+            self._running[successor.job_id] = successor
+        return successor
+
+class ChunkPool:
+    """Shared pool of encode slots for the chunks of segmented jobs
+
+    Waiting chunks are granted slots round-robin across owners (jobs), so a
+    long job split into many chunks interleaves with other jobs' chunks
+    instead of holding every slot until it finishes.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._active = 0
+        self._waiters: 'OrderedDict[Any, deque]' = OrderedDict()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    @asynccontextmanager
+    async def slot(self, owner: Any):
+        """Hold one encode slot for the duration of the block"""
+        if self._active < self.size and not self._waiters:
+            self._active += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(owner, deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as we were cancelled
+                    self._release()
+                else:
+                    self._discard(owner, waiter)
+                raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _discard(self, owner: Any, waiter: asyncio.Future) -> None:
+        waiters = self._waiters.get(owner)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[owner]
+
+    def _release(self) -> None:
+        """Hand the freed slot to the next owner in rotation, or return it"""
+        while self._waiters:
+            owner, waiters = next(iter(self._waiters.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._waiters.move_to_end(owner)
+            else:
+                del self._waiters[owner]
+
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self._active -= 1
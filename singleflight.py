@@ -0,0 +1,120 @@
+"""
+In-flight request coalescing for the video encoder bot
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+Listener = Callable[[Any], Awaitable[None]]
+
+class Flight:
+    """One shared run of a piece of work and the callers waiting on it"""
+
+    def __init__(self, key: Hashable, cleanup: Optional[Callable[[], None]] = None):
+        self.key = key
+        self.cleanup = cleanup
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self.members: List[Any] = []  # Whatever the waiters joined on behalf of, e.g. their jobs
+        self.listeners: List[Listener] = []
+        self.last_event: Any = None
+        self.lock = asyncio.Lock()  # For waiters taking turns with the result
+
+    async def report(self, event: Any) -> None:
+        """Pass a status or progress event on to every waiter"""
+        self.last_event = event
+        for listener in list(self.listeners):
+            try:
+                await listener(event)
+            except Exception as e:
+                logger.warning(f"Flight listener failed: {e}")
+
+    async def result(self) -> Any:
+        """Wait for the work; cancelling the caller leaves the work running"""
+        return await asyncio.shield(self.task)
+
+class SingleFlight:
+    """Runs identical work once for every caller that asks for it at the same time
+
+    The first caller for a key starts the work; callers joining while it is in
+    flight share it, receive its events from then on (starting with the most
+    recent one) and get the same result or exception. The flight stays open
+    until its last waiter leaves, so callers arriving while the others are
+    still using the result join it too. The work is cancelled only when every
+    waiter has left before it finished, and cleanup runs once the flight
+    closes.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def keys(self) -> List[Hashable]:
+        return list(self._flights)
+
+    def waiters(self, key: Hashable) -> int:
+        flight = self._flights.get(key)
+        return flight.waiters if flight else 0
+
+    @asynccontextmanager
+    async def join(self, key: Hashable, work: Callable[[Flight], Awaitable[Any]],
+                   listener: Optional[Listener] = None,
+                   cleanup: Optional[Callable[[], None]] = None,
+                   member: Any = None) -> AsyncIterator[Flight]:
+        """Share the flight for key for the duration of the block, starting it if needed
+
+        work(flight) is only called when no flight is open for key, and cleanup
+        belongs to the flight it starts. member, if given, is listed in
+        flight.members while the caller waits.
+        """
+        flight = self._flights.get(key)
+        joined = flight is not None
+        if not joined:
+            flight = self._flights[key] = Flight(key, cleanup)
+            flight.task = asyncio.create_task(work(flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"Joined work in flight for {key} ({flight.waiters} already waiting)")
+
+        # Counted before anything is awaited, so the flight cannot close under this caller
+        flight.waiters += 1
+        if member is not None:
+            flight.members.append(member)
+
+        try:
+            if listener:
+                if joined and flight.last_event is not None:
+                    await listener(flight.last_event)
+                flight.listeners.append(listener)
+            yield flight
+        finally:
+            flight.waiters -= 1
+            if member is not None:
+                flight.members.remove(member)
+            if listener in flight.listeners:
+                flight.listeners.remove(listener)
+            if not flight.waiters:
+                await self._close(flight)
+
+    async def _close(self, flight: Flight) -> None:
+        """Cancel the work if nobody wants it any more, then clean up"""
+        del self._flights[flight.key]
+        try:
+            if not flight.task.done():
+                logger.info(f"Last waiter left, cancelling work for {flight.key}")
+                flight.task.cancel()
+            await asyncio.gather(flight.task, return_exceptions=True)
+        finally:
+            if flight.cleanup:
+                flight.cleanup()
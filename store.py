@@ -0,0 +1,306 @@
+"""
+Persistent SQLite store for sessions, queued jobs and user statistics
+"""
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from janitor import last_modified
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    video_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id);
+CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON sessions (timestamp);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    video_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id);
+CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created);
+
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id INTEGER PRIMARY KEY,
+    videos_processed INTEGER NOT NULL DEFAULT 0,
+    total_size_processed INTEGER NOT NULL DEFAULT 0,
+    first_use TEXT NOT NULL,
+    last_use TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_stats_last_use ON user_stats (last_use);
+"""
+
+class Store:
+    """Thin thread-safe wrapper around one SQLite connection in WAL mode"""
+
+    def __init__(self, path: str, busy_timeout: int = 5000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Encoder worker processes share this database; busy_timeout (ms) bounds the wait for
+        # their write lock, which the bot keeps short since it waits on the event loop
+        self._conn.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        self._conn.executescript(SCHEMA)
+
+    def execute(self, sql: str, params: Tuple = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql: str, rows: List[Tuple]) -> None:
+        """Run a batch of writes in a single transaction"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Hold the database write lock for a read-modify-write across processes"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+class SessionTable(MutableMapping):
+    """video_id -> session dict, mirrored in memory and written through to SQLite
+
+    In-place changes to a session dict must be followed by save(video_id).
+    """
+
+    def __init__(self, store: Store):
+        self._store = store
+        self._data: Dict[str, Dict[str, Any]] = {}
+        for row in store.execute("SELECT video_id, data FROM sessions"):
+            self._data[row['video_id']] = json.loads(row['data'])
+
+    def __getitem__(self, video_id: str) -> Dict[str, Any]:
+        return self._data[video_id]
+
+    def __setitem__(self, video_id: str, session: Dict[str, Any]) -> None:
+        self._data[video_id] = session
+        self.save(video_id)
+
+    def __delitem__(self, video_id: str) -> None:
+        del self._data[video_id]
+        self._store.execute("DELETE FROM sessions WHERE video_id = ?", (video_id,))
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def save(self, video_id: str) -> None:
+        session = self._data[video_id]
+        self._store.execute(
+            "INSERT OR REPLACE INTO sessions (video_id, user_id, timestamp, data) VALUES (?, ?, ?, ?)",
+            (video_id, session['user_id'], session['timestamp'], json.dumps(session))
+        )
+
+    def for_user(self, user_id: int) -> List[str]:
+        rows = self._store.execute("SELECT video_id FROM sessions WHERE user_id = ? ORDER BY timestamp", (user_id,))
+        return [row['video_id'] for row in rows]
+
+    def older_than(self, timestamp: float) -> List[str]:
+        rows = self._store.execute("SELECT video_id FROM sessions WHERE timestamp < ? ORDER BY timestamp", (timestamp,))
+        return [row['video_id'] for row in rows]
+
+class JobTable:
+    """Conversions that were accepted but not finished, so they survive restarts"""
+
+    def __init__(self, store: Store):
+        self._store = store
+
+    def add(self, video_id: str, user_id: int, action: str, chat_id: int, message_id: int, created: float) -> None:
+        self._store.execute(
+            "INSERT OR REPLACE INTO jobs (video_id, user_id, action, chat_id, message_id, created) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (video_id, user_id, action, chat_id, message_id, created)
+        )
+
+    def remove(self, video_id: str) -> None:
+        self._store.execute("DELETE FROM jobs WHERE video_id = ?", (video_id,))
+
+    def get(self, video_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._store.execute("SELECT * FROM jobs WHERE video_id = ?", (video_id,))
+        return dict(rows[0]) if rows else None
+
+    def all(self) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self._store.execute("SELECT * FROM jobs ORDER BY created")]
+
+    def for_user(self, user_id: int) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self._store.execute(
+            "SELECT * FROM jobs WHERE user_id = ? ORDER BY created", (user_id,)
+        )]
+
+class StatsTable(MutableMapping):
+    """user_id -> stats dict with batched writes
+
+    Updates only touch memory and mark the user dirty; flush() writes every
+    dirty row in one transaction.
+    """
+
+    def __init__(self, store: Store):
+        self._store = store
+        self._data: Dict[int, Dict[str, Any]] = {}
+        self._dirty = set()
+        for row in store.execute("SELECT * FROM user_stats"):
+            stats = dict(row)
+            self._data[stats.pop('user_id')] = stats
+
+    def __getitem__(self, user_id: int) -> Dict[str, Any]:
+        return self._data[user_id]
+
+    def __setitem__(self, user_id: int, stats: Dict[str, Any]) -> None:
+        self._data[user_id] = stats
+        self._dirty.add(user_id)
+
+    def __delitem__(self, user_id: int) -> None:
+        del self._data[user_id]
+        self._dirty.discard(user_id)
+        self._store.execute("DELETE FROM user_stats WHERE user_id = ?", (user_id,))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._data)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def record(self, user_id: int, action: str, size: int = 0) -> None:
+        """Apply one stats event in memory"""
+        now = datetime.now().isoformat()
+        stats = self._data.setdefault(user_id, {
+            'videos_processed': 0,
+            'total_size_processed': 0,
+            'first_use': now,
+            'last_use': now
+        })
+        stats['last_use'] = now
+
+        if action == 'video_processed':
+            stats['videos_processed'] += 1
+            stats['total_size_processed'] += size
+
+        self._dirty.add(user_id)
+
+    def flush(self) -> int:
+        """Write all dirty rows in one transaction; returns the number written"""
+        if not self._dirty:
+            return 0
+
+        dirty, self._dirty = self._dirty, set()
+        rows = [
+            (user_id, s['videos_processed'], s['total_size_processed'], s['first_use'], s['last_use'])
+            for user_id in dirty if (s := self._data.get(user_id))
+        ]
+        try:
+            self._store.executemany(
+                "INSERT OR REPLACE INTO user_stats "
+                "(user_id, videos_processed, total_size_processed, first_use, last_use) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        except Exception:
+            self._dirty |= dirty
+            raise
+        return len(rows)
+
+    def totals(self) -> Dict[str, int]:
+        """Aggregate counts computed by SQLite"""
+        self.flush()
+        row = self._store.execute(
+            "SELECT COUNT(*) AS users, COALESCE(SUM(videos_processed), 0) AS videos, "
+            "COALESCE(SUM(total_size_processed), 0) AS size FROM user_stats"
+        )[0]
+        return dict(row)
+
+def reconcile_storage(sessions: SessionTable, jobs: JobTable, download_dir: str,
+                      scratch_dirs: List[str], scratch_min_age: float = 0) -> Dict[str, int]:
+    """Bring the database and the files on disk back in line after a restart
+
+    Sessions whose downloaded source is gone are dropped, partially streamed
+    sources are discarded (they are fetched again on demand), unreferenced
+    files in the download directory are removed, scratch directories are
+    emptied, and jobs without a session are forgotten. With scratch_min_age,
+    scratch entries touched in the last that many seconds are left alone,
+    since encoder workers sharing the storage may still be writing them.
+    """
+    now = time.time()
+    removed = {'sessions': 0, 'files': 0, 'jobs': 0}
+
+    for video_id in list(sessions):
+        session = sessions[video_id]
+        if session.get('downloaded'):
+            if not os.path.exists(session['path']):
+                del sessions[video_id]
+                removed['sessions'] += 1
+        elif os.path.exists(session['path']):
+            os.remove(session['path'])
+            removed['files'] += 1
+
+    live_paths = {os.path.abspath(session['path']) for session in sessions.values()}
+    if os.path.isdir(download_dir):
+        for name in os.listdir(download_dir):
+            path = os.path.join(download_dir, name)
+            if os.path.isfile(path) and os.path.abspath(path) not in live_paths:
+                os.remove(path)
+                removed['files'] += 1
+
+    for directory in scratch_dirs:
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if scratch_min_age and now - last_modified(path) < scratch_min_age:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed['files'] += 1
+
+    for job in jobs.all():
+        if job['video_id'] not in sessions:
+            jobs.remove(job['video_id'])
+            removed['jobs'] += 1
+
+    return removed
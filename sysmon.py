@@ -0,0 +1,122 @@
+"""
+System load sampler for the video encoder bot
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# Averaging windows in minutes, as for the Unix load average
+WINDOWS = (1, 5, 15)
+
+class Sample(NamedTuple):
+    time: float
+    cpu: float  # Percent of all cores since the previous sample
+    per_core: Tuple[float, ...]
+    memory_used: float  # Percent
+    memory_available: int  # Bytes
+    disk_free: int  # Bytes
+    disk_read: float  # Bytes per second since the previous sample
+    disk_write: float
+    ffmpeg_rss: int  # Bytes held by ffmpeg processes started by this one
+
+class SystemMonitor:
+    """Samples system load in the background into a fixed-size ring buffer
+
+    Readers get the latest sample and window averages without waiting:
+    psutil's CPU figures are measured between consecutive samples instead of
+    blocking for an interval. The buffer holds enough samples for the longest
+    window.
+    """
+
+    def __init__(self, path: str = '/', interval: float = 5.0):
+        self.path = path
+        self.interval = interval
+        self._samples: deque = deque(maxlen=int(max(WINDOWS) * 60 / interval) + 1)
+        self._last_io: Optional[Tuple[float, int, int]] = None
+        self._task: Optional[asyncio.Task] = None
+
+        # Prime the counters so the first real sample covers a full interval
+        psutil.cpu_percent(interval=None)
+        psutil.cpu_percent(interval=None, percpu=True)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # Walking the process tree is blocking I/O on /proc
+                self._samples.append(await asyncio.to_thread(self.sample))
+            except Exception as e:
+                logger.warning(f"System sample failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def sample(self) -> Sample:
+        """Take one sample now"""
+        now = time.time()
+        memory = psutil.virtual_memory()
+
+        disk_read = disk_write = 0.0
+        io = psutil.disk_io_counters()
+        if io:
+            if self._last_io:
+                last_time, last_read, last_write = self._last_io
+                elapsed = max(now - last_time, 1e-6)
+                disk_read = max(0, io.read_bytes - last_read) / elapsed
+                disk_write = max(0, io.write_bytes - last_write) / elapsed
+            self._last_io = (now, io.read_bytes, io.write_bytes)
+
+        return Sample(
+            time=now,
+            cpu=psutil.cpu_percent(interval=None),
+            per_core=tuple(psutil.cpu_percent(interval=None, percpu=True)),
+            memory_used=memory.percent,
+            memory_available=memory.available,
+            disk_free=psutil.disk_usage(self.path).free,
+            disk_read=disk_read,
+            disk_write=disk_write,
+            ffmpeg_rss=self._ffmpeg_rss()
+        )
+
+    @staticmethod
+    def _ffmpeg_rss() -> int:
+        """Resident memory of ffmpeg descendants, including those of local encoder workers"""
+        total = 0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                if child.name().startswith('ffmpeg'):
+                    total += child.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        return total
+
+    @property
+    def latest(self) -> Optional[Sample]:
+        return self._samples[-1] if self._samples else None
+
+    def history(self, seconds: float) -> List[Sample]:
+        """Samples taken in the last seconds"""
+        since = time.time() - seconds
+        return [sample for sample in self._samples if sample.time >= since]
+
+    def average(self, field: str, minutes: float) -> Optional[float]:
+        """Mean of a sample field over the last minutes, None before the first sample"""
+        samples = self.history(minutes * 60)
+        if not samples:
+            return None
+        return sum(getattr(sample, field) for sample in samples) / len(samples)
+
+    def averages(self, field: str) -> Dict[int, Optional[float]]:
+        """{minutes: mean} of a field over the 1, 5 and 15 minute windows"""
+        return {minutes: self.average(field, minutes) for minutes in WINDOWS}
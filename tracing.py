@@ -0,0 +1,238 @@
+"""
+Job tracing for the video encoder bot
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# ffmpeg progress samples kept per span; longer encodes keep every other sample
+MAX_SAMPLES = 120
+
+class Span:
+    """One timed stage of a trace, with attributes and optional progress samples"""
+
+    def __init__(self, trace: 'Trace', name: str, parent: Optional['Span'] = None,
+                 start: Optional[float] = None, **attrs: Any):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time() if start is None else start
+        self.end: Optional[float] = None
+        self.attrs: Dict[str, Any] = attrs
+        self.samples: List[Dict[str, Any]] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def sample(self, **values: Any) -> None:
+        """Record a progress sample, timed from the start of the span"""
+        self.samples.append({'t': round(time.time() - self.start, 2), **values})
+        if len(self.samples) > MAX_SAMPLES:
+            self.samples = self.samples[::2]
+
+    def close(self, end: Optional[float] = None, **attrs: Any) -> None:
+        """End the span; closing it again only adds attributes"""
+        self.attrs.update(attrs)
+        if self.end is None:
+            self.end = time.time() if end is None else end
+
+    def to_dict(self) -> Dict[str, Any]:
+        record = {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 3),
+            'end': round(self.end, 3) if self.end else None,
+            'duration': round(self.duration, 3),
+            'attrs': self.attrs
+        }
+        if self.samples:
+            record['samples'] = self.samples
+        return record
+
+class Trace:
+    """The spans of one video, from its arrival until its session is cleaned up
+
+    The root span stands for the whole trace; every job run on the video is
+    a 'job' span under it holding that run's stages.
+    """
+
+    def __init__(self, key: str, name: str = 'conversion', **attrs: Any):
+        self.key = key
+        self.trace_id = uuid.uuid4().hex
+        self.root = Span(self, name, key=key, **attrs)
+        self.spans: List[Span] = [self.root]
+
+    def open(self, name: str, parent: Optional[Span] = None, start: Optional[float] = None, **attrs: Any) -> Span:
+        """Start a span under parent (the root by default); the caller closes it"""
+        span = Span(self, name, parent or self.root, start, **attrs)
+        self.spans.append(span)
+        return span
+
+    def record(self, name: str, start: float, end: Optional[float] = None,
+               parent: Optional[Span] = None, **attrs: Any) -> Span:
+        """Add a stage that has already finished"""
+        span = self.open(name, parent, start, **attrs)
+        span.close(end)
+        return span
+
+    def summary(self) -> Dict[str, Any]:
+        """Time per stage name, summed over the trace, for the slowest jobs view
+
+        duration adds up the root's direct children (ingest and job runs), so
+        the time the user spends picking options is not counted.
+        """
+        stages: Dict[str, float] = {}
+        fps, speed = [], []
+        for span in self.spans[1:]:
+            if span.name != 'job':
+                stages[span.name] = stages.get(span.name, 0.0) + span.duration
+            if span.name == 'encode':
+                fps += [sample['fps'] for sample in span.samples if sample.get('fps')]
+                speed += [sample['speed'] for sample in span.samples if sample.get('speed')]
+
+        jobs = [span for span in self.spans if span.name == 'job']
+        return {
+            'trace_id': self.trace_id,
+            'key': self.key,
+            'attrs': self.root.attrs,
+            'start': self.root.start,
+            'elapsed': self.root.duration,
+            'duration': sum(span.duration for span in self.spans if span.parent_id == self.root.span_id),
+            'stages': stages,
+            'jobs': len(jobs),
+            'action': jobs[-1].attrs.get('action') if jobs else None,
+            'outcome': jobs[-1].attrs.get('outcome') if jobs else None,
+            'fps': sum(fps) / len(fps) if fps else None,
+            'speed': sum(speed) / len(speed) if speed else None
+        }
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('current_span', default=None)
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+class Tracer:
+    """Open traces by key, written out as JSON lines when they finish
+
+    Code deep in the pipeline opens spans under the current span of its
+    task, so stages nest under the job that runs them without passing the
+    trace around; tasks inherit the current span of the code creating them.
+    Finished traces are appended to a rotating JSONL file, one span per line,
+    and the summaries of those that ran a job kept in memory for the admin view.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 10 * 1024 * 1024,
+                 backups: int = 5, history: int = 200):
+        self._traces: Dict[str, Trace] = {}
+        self.recent: Deque[Dict[str, Any]] = deque(maxlen=history)
+        self._writer: Optional[logging.Logger] = None
+
+        if path:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._writer = logging.getLogger(f"{__name__}.spans")
+            self._writer.handlers = [handler]
+            self._writer.setLevel(logging.INFO)
+            self._writer.propagate = False
+
+    def __len__(self) -> int:
+        return len(self._traces)
+
+    def begin(self, key: str, **attrs: Any) -> Trace:
+        """The open trace for key, started if there is none"""
+        trace = self._traces.get(key)
+        if trace is None:
+            trace = self._traces[key] = Trace(key, **attrs)
+        else:
+            trace.root.attrs.update(attrs)
+        return trace
+
+    def get(self, key: str) -> Optional[Trace]:
+        return self._traces.get(key)
+
+    @staticmethod
+    def activate(span: Span) -> None:
+        """Make span the current span of the calling task from now on
+
+        Only for tasks that belong to the trace for their whole life, such as
+        a job's task; elsewhere use span() so the context is restored.
+        """
+        _current_span.set(span)
+
+    @staticmethod
+    def _parent(trace: Optional[Trace]) -> Optional[Span]:
+        """The current span, or the root of trace when the current span is in another trace"""
+        parent = _current_span.get()
+        if trace is not None and (parent is None or parent.trace is not trace):
+            parent = trace.root
+        return parent
+
+    @contextmanager
+    def span(self, name: str, trace: Optional[Trace] = None, **attrs: Any) -> Iterator[Optional[Span]]:
+        """Time the block as a child of the current span, or of trace's root
+
+        Does nothing (and yields None) outside a trace.
+        """
+        parent = self._parent(trace)
+        if parent is None:
+            yield None
+            return
+
+        span = parent.trace.open(name, parent, **attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.attrs['cancelled'] = True
+            raise
+        except Exception as e:
+            span.attrs['error'] = str(e)
+            raise
+        finally:
+            span.close()
+            _current_span.reset(token)
+
+    def open(self, name: str, trace: Optional[Trace] = None, **attrs: Any) -> Optional[Span]:
+        """Start a span under the current span without making it current; None outside a trace"""
+        parent = self._parent(trace)
+        return parent.trace.open(name, parent, **attrs) if parent else None
+
+    def finish(self, key: str) -> Optional[Dict[str, Any]]:
+        """Close the trace for key, write its spans out and return its summary"""
+        trace = self._traces.pop(key, None)
+        if trace is None:
+            return None
+
+        now = time.time()
+        for span in trace.spans:
+            span.close(now)
+
+        if self._writer:
+            for span in trace.spans:
+                try:
+                    self._writer.info(json.dumps(span.to_dict(), default=str))
+                except (TypeError, ValueError) as e:
+                    logger.warning(f"Could not write span {span.name} of trace {trace.trace_id}: {e}")
+
+        # Videos nobody converted are only written out
+        summary = trace.summary()
+        if summary['jobs']:
+            self.recent.append(summary)
+        return summary
+
+    def slowest(self, count: int = 5) -> List[Dict[str, Any]]:
+        """Summaries of the recent traces that ran a job, longest first"""
+        return sorted(self.recent, key=lambda summary: summary['duration'], reverse=True)[:count]
@@ -0,0 +1,654 @@
+"""
+FFmpeg process helpers for the video encoder bot
+"""
+import asyncio
+import glob
+import logging
+import os
+import shutil
+import signal
+import uuid
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, AsyncIterator, Awaitable, Callable, ContextManager, Dict, List, Optional, Tuple
+
+from encoders import ENCODERS, QUALITY_LEVELS
+
+logger = logging.getLogger(__name__)
+
+# Supported formats and presets
+SUPPORTED_FORMATS = {
+    'mp4': 'MP4 (H.264)',
+    'mkv': 'MKV (H.264)',
+    'avi': 'AVI (H.264)',
+    'webm': 'WebM (VP9)',
+    'mov': 'MOV (H.264)',
+    'hevc': 'MP4 (H.265)',
+    'av1': 'MP4 (AV1)'
+}
+
+# Quality levels; the encoder options behind each live in encoders.py
+QUALITY_PRESETS = QUALITY_LEVELS
+
+# Container extension for formats not named after their container
+FORMAT_EXTENSIONS = {
+    'hevc': 'mp4',
+    'av1': 'mp4'
+}
+
+# Muxer options per format; Apple players only accept HEVC in MP4 tagged hvc1
+CONTAINER_ARGS = {
+    'hevc': ['-tag:v', 'hvc1']
+}
+
+RESOLUTION_PRESETS = {
+    '240p': {'height': 240, 'bitrate': '400k'},
+    '360p': {'height': 360, 'bitrate': '800k'},
+    '480p': {'height': 480, 'bitrate': '1200k'},
+    '720p': {'height': 720, 'bitrate': '2500k'},
+    '1080p': {'height': 1080, 'bitrate': '5000k'}
+}
+
+# Video codec each output format is encoded to, as ffprobe names it
+TARGET_VIDEO_CODECS = {
+    'mp4': 'h264',
+    'mkv': 'h264',
+    'avi': 'h264',
+    'webm': 'vp9',
+    'mov': 'h264',
+    'hevc': 'hevc',
+    'av1': 'av1'
+}
+
+# Audio codec encoded to per format when the source audio cannot be copied
+TARGET_AUDIO_CODECS = {
+    'webm': 'opus'
+}
+
+# Source audio codecs that can be passed through untouched per format
+PASSTHROUGH_AUDIO_CODECS = {
+    'mp4': {'aac'},
+    'mkv': {'aac', 'opus'},
+    'avi': {'aac'},
+    'webm': {'opus'},
+    'mov': {'aac'},
+    'hevc': {'aac'},
+    'av1': {'aac'}
+}
+
+# Sources above this frame rate get proportionally more bits per rung
+HIGH_FRAME_RATE = 40
+HIGH_FRAME_RATE_BITRATE_FACTOR = 1.5
+
+# Watermark font size is tuned for this output height
+WATERMARK_REFERENCE_HEIGHT = 720
+
+# Async callable receiving the latest progress snapshot from ffmpeg
+ProgressCallback = Callable[[Dict[str, Any]], Awaitable[None]]
+
+def watermark_filter(text: str, fontsize: int = 24, margin: int = 10) -> str:
+    """Build the drawtext filter used for the watermark"""
+    return (f"drawtext=text='{text}':fontcolor=white:fontsize={fontsize}"
+            f":x={margin}:y={margin}:enable='between(t,0,999999)'")
+
+def parse_bitrate(value: str) -> int:
+    """Bits per second of an ffmpeg bitrate such as '2500k'"""
+    multipliers = {'k': 1000, 'M': 1000000}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+def plan_transcode(info: Optional[Dict[str, Any]], resolution: str, format_type: str,
+                   watermark_text: Optional[str] = None) -> Dict[str, Any]:
+    """Decide how much work a rendition really needs
+
+    Compares the probed source with the requested target and returns
+    {'video': 'copy'|'encode', 'audio': 'copy'|'encode'|'none', 'scale_height': int|None,
+    'bitrate': int|None}. Without probe information every stream is re-encoded
+    and scaled at the preset bitrate, as before.
+    """
+    target_height = RESOLUTION_PRESETS[resolution]['height'] if resolution in RESOLUTION_PRESETS else None
+
+    if not info:
+        return {'video': 'encode', 'audio': 'encode', 'scale_height': target_height,
+                'bitrate': rung_bitrate(None, resolution)}
+
+    # Never upscale: scaling to the same or a larger height is a no-op at best
+    scale_height = target_height if target_height and info.get('height', 0) > target_height else None
+
+    video = 'encode'
+    if not scale_height and not watermark_text and info.get('codec') == TARGET_VIDEO_CODECS.get(format_type, 'h264'):
+        video = 'copy'
+
+    if not info.get('has_audio', True):
+        audio = 'none'
+    elif info.get('audio_codec') in PASSTHROUGH_AUDIO_CODECS.get(format_type, set()):
+        audio = 'copy'
+    else:
+        audio = 'encode'
+
+    return {'video': video, 'audio': audio, 'scale_height': scale_height, 'bitrate': rung_bitrate(info, resolution)}
+
+def source_video_bitrate(info: Optional[Dict[str, Any]]) -> int:
+    """Bits per second of the source's video stream, 0 when unknown"""
+    if not info:
+        return 0
+    video_stream = next((s for s in info.get('streams', []) if s['codec_type'] == 'video'), None)
+    if video_stream and video_stream['bitrate']:
+        return video_stream['bitrate']
+    # Containers such as MKV only report the overall bitrate
+    return max(0, info.get('bitrate', 0) - info.get('audio_bitrate', 0))
+
+def rung_bitrate(info: Optional[Dict[str, Any]], resolution: str) -> Optional[int]:
+    """Video bitrate of a ladder rung, adapted to the source
+
+    High frame rate sources get more bits per rung, and no rung gets more
+    bits than the source video has: re-encoding cannot add detail.
+    """
+    if resolution not in RESOLUTION_PRESETS:
+        return None
+
+    bitrate = parse_bitrate(RESOLUTION_PRESETS[resolution]['bitrate'])
+    if info and (info.get('fps') or 0) > HIGH_FRAME_RATE:
+        bitrate *= HIGH_FRAME_RATE_BITRATE_FACTOR
+
+    source_bitrate = source_video_bitrate(info)
+    if source_bitrate:
+        bitrate = min(bitrate, source_bitrate)
+
+    return int(bitrate)
+
+def build_ladder(info: Optional[Dict[str, Any]], renditions: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """The renditions [(resolution, format), ...] worth producing from a source
+
+    Rungs above the source height would only be upscaled copies of a lower
+    rung, so they are dropped. If every rung is above the source the lowest
+    one is kept, encoded at the source height. Without probe information the
+    renditions are returned unchanged.
+    """
+    if not info or not info.get('height'):
+        return list(renditions)
+
+    ladder = [(resolution, format_type) for resolution, format_type in renditions
+              if RESOLUTION_PRESETS.get(resolution, {}).get('height', 0) <= info['height']]
+    if not ladder and renditions:
+        ladder = [min(renditions, key=lambda rung: RESOLUTION_PRESETS.get(rung[0], {}).get('height', 0))]
+    return ladder
+
+def estimate_output_size(info: Optional[Dict[str, Any]], resolution: str, format_type: str,
+                         watermark_text: Optional[str] = None, source_size: int = 0) -> int:
+    """Generous estimate of a rendition's size in bytes, used to reserve disk space"""
+    plan = plan_transcode(info, resolution, format_type, watermark_text)
+    duration = info.get('duration', 0) if info else 0
+    if plan['video'] == 'copy' or not duration or resolution not in RESOLUTION_PRESETS:
+        return source_size
+
+    bitrate = plan['bitrate']
+    if plan['audio'] == 'copy':
+        bitrate += info.get('audio_bitrate') or 128000
+    elif plan['audio'] == 'encode':
+        bitrate += 128000
+
+    # Rate control overshoots on complex scenes, and the container adds a little
+    return int(duration * bitrate / 8 * 1.25)
+
+def video_filters(plan: Dict[str, Any], watermark_text: Optional[str] = None) -> List[str]:
+    """Scale and watermark filters for a planned rendition"""
+    filters = []
+
+    # Resolution scaling
+    if plan['scale_height']:
+        filters.append(f"scale=-2:{plan['scale_height']}")
+
+    # Watermark
+    if watermark_text:
+        filters.append(watermark_filter(watermark_text))
+
+    return filters
+
+def thread_args(threads: Optional[int]) -> List[str]:
+    """Filter and decoder thread limits; these must come before the input"""
+    if not threads:
+        return []
+    return ['-filter_threads', str(threads), '-filter_complex_threads', str(threads), '-threads', str(threads)]
+
+def cpu_grant(cpu: Any) -> ContextManager:
+    """A share of the CPU budget for one ffmpeg process, or nothing without a budget"""
+    return cpu.grant() if cpu else nullcontext()
+
+def output_extension(format_type: str) -> str:
+    """File extension of an output in this format"""
+    return FORMAT_EXTENSIONS.get(format_type, format_type)
+
+def available_formats() -> Dict[str, str]:
+    """Supported formats whose video encoder this ffmpeg build provides"""
+    return {fmt: desc for fmt, desc in SUPPORTED_FORMATS.items()
+            if ENCODERS.supports(TARGET_VIDEO_CODECS.get(fmt, 'h264'))}
+
+def video_encoder_args(resolution: str, quality_preset: str, format_type: str, plan: Dict[str, Any],
+                       threads: Optional[int] = None) -> List[str]:
+    """Video encoder settings from the codec profile for the format and quality level"""
+    if plan['video'] == 'copy':
+        return ['-c:v', 'copy']
+
+    # The planned rung bitrate caps the stream, or the preset's without a plan
+    bitrate = plan.get('bitrate')
+    if not bitrate and resolution in RESOLUTION_PRESETS:
+        bitrate = parse_bitrate(RESOLUTION_PRESETS[resolution]['bitrate'])
+    height = plan.get('scale_height') or RESOLUTION_PRESETS.get(resolution, {}).get('height')
+
+    return ENCODERS.video_args(TARGET_VIDEO_CODECS.get(format_type, 'h264'), quality_preset,
+                               bitrate=bitrate, height=height, threads=threads)
+
+def audio_encoder_args(format_type: str, plan: Dict[str, Any]) -> List[str]:
+    """Audio encoder settings for a planned rendition"""
+    if plan['audio'] == 'copy':
+        return ['-c:a', 'copy']
+    if plan['audio'] == 'none':
+        return ['-an']
+    return ENCODERS.audio_args(TARGET_AUDIO_CODECS.get(format_type, 'aac'))
+
+def encoder_args(resolution: str, quality_preset: str, format_type: str,
+                 plan: Optional[Dict[str, Any]] = None, threads: Optional[int] = None) -> List[str]:
+    """Encoder settings for one rendition, taken from the quality and resolution presets"""
+    plan = plan or {'video': 'encode', 'audio': 'encode'}
+    return (video_encoder_args(resolution, quality_preset, format_type, plan, threads)
+            + audio_encoder_args(format_type, plan))
+
+def build_transcode_command(input_file: str, output_file: str, resolution: str, quality_preset: str,
+                            format_type: str, watermark_text: Optional[str] = None,
+                            info: Optional[Dict[str, Any]] = None, threads: Optional[int] = None) -> List[str]:
+    """Build the ffmpeg command for a single rendition, limited to threads if given"""
+    plan = plan_transcode(info, resolution, format_type, watermark_text)
+    cmd = ['ffmpeg', *thread_args(threads), '-i', input_file, '-y']
+
+    filters = video_filters(plan, watermark_text) if plan['video'] == 'encode' else []
+    if filters:
+        cmd.extend(['-vf', ','.join(filters)])
+
+    cmd.extend(encoder_args(resolution, quality_preset, format_type, plan, threads))
+    cmd.extend(CONTAINER_ARGS.get(format_type, []))
+    cmd.append(output_file)
+    return cmd
+
+def build_batch_command(input_file: str, outputs: List[Tuple[str, str, str]], quality_preset: str,
+                        watermark_text: Optional[str] = None,
+                        info: Optional[Dict[str, Any]] = None, threads: Optional[int] = None) -> List[str]:
+    """Build one ffmpeg command that decodes once and encodes every rendition
+
+    outputs is a list of (output_file, resolution, format_type). The source is
+    decoded and watermarked a single time, then a split filter feeds a scaler
+    and encoder per rendition. Renditions the planner can stream-copy are
+    mapped straight from the input. The encoders run side by side, so they
+    divide threads between them.
+    """
+    cmd = ['ffmpeg', *thread_args(threads), '-i', input_file, '-y']
+    plans = [plan_transcode(info, resolution, format_type, watermark_text)
+             for _, resolution, format_type in outputs]
+    encoded = [i for i, plan in enumerate(plans) if plan['video'] == 'encode']
+    encoder_threads = max(1, threads // len(encoded)) if threads and encoded else None
+
+    if encoded:
+        # Shared prefix: watermark once at source resolution, scaled so it
+        # matches the single-rendition look at the reference height
+        chain = '[0:v]'
+        if watermark_text:
+            source_height = info.get('height', 0) if info else 0
+            scale = source_height / WATERMARK_REFERENCE_HEIGHT if source_height else 1.0
+            chain += watermark_filter(
+                watermark_text,
+                fontsize=max(8, round(24 * scale)),
+                margin=max(2, round(10 * scale))
+            ) + ','
+
+        split_labels = ''.join(f"[s{i}]" for i in encoded)
+        graph = [f"{chain}split={len(encoded)}{split_labels}"]
+
+        for i in encoded:
+            if plans[i]['scale_height']:
+                graph.append(f"[s{i}]scale=-2:{plans[i]['scale_height']}[v{i}]")
+            else:
+                graph.append(f"[s{i}]null[v{i}]")
+
+        cmd.extend(['-filter_complex', ';'.join(graph)])
+
+    for i, (output_file, resolution, format_type) in enumerate(outputs):
+        video_map = f"[v{i}]" if plans[i]['video'] == 'encode' else '0:v:0'
+        cmd.extend(['-map', video_map, '-map', '0:a?'])
+        cmd.extend(encoder_args(resolution, quality_preset, format_type, plans[i], encoder_threads))
+        cmd.extend(CONTAINER_ARGS.get(format_type, []))
+        cmd.append(output_file)
+
+    return cmd
+
+def _to_float(value: Optional[str]) -> float:
+    """Parse a numeric ffmpeg progress value, treating N/A as zero"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def build_progress(fields: Dict[str, str], duration: Optional[float] = None) -> Dict[str, Any]:
+    """Turn one block of ffmpeg `-progress` key=value pairs into a progress snapshot"""
+    # out_time_us is authoritative; out_time_ms is also microseconds despite its name
+    out_time_us = _to_float(fields.get('out_time_us') or fields.get('out_time_ms'))
+    out_time = max(0.0, out_time_us / 1_000_000)
+    speed = _to_float(fields.get('speed', '').rstrip('x'))
+
+    progress = {
+        'out_time': out_time,
+        'fps': _to_float(fields.get('fps')),
+        'speed': speed,
+        'total_size': int(_to_float(fields.get('total_size'))),
+        'percent': None,
+        'eta': None,
+        'done': fields.get('progress') == 'end'
+    }
+
+    if duration and duration > 0:
+        progress['percent'] = min(100.0, out_time / duration * 100)
+        if speed > 0:
+            progress['eta'] = max(0.0, (duration - out_time) / speed)
+
+    return progress
+
+async def feed_stdin(process: asyncio.subprocess.Process, input_stream: AsyncIterator[bytes]) -> None:
+    """Write an async byte stream to a subprocess's stdin, then close it"""
+    try:
+        async for chunk in input_stream:
+            process.stdin.write(chunk)
+            await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The reader exited early; it has seen everything it needed
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except Exception:
+            pass
+        if hasattr(input_stream, 'aclose'):
+            await input_stream.aclose()
+
+async def terminate_process_group(process: asyncio.subprocess.Process, grace: float = 5.0) -> None:
+    """Stop a process started in its own session, together with anything it spawned
+
+    SIGTERM lets ffmpeg close its files; whatever is still alive after grace
+    seconds is killed.
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break
+        try:
+            await asyncio.wait_for(process.wait(), grace)
+            return
+        except asyncio.TimeoutError:
+            continue
+    await process.wait()
+
+async def run_ffmpeg(cmd: List[str], duration: Optional[float] = None,
+                     progress_callback: Optional[ProgressCallback] = None,
+                     input_stream: Optional[AsyncIterator[bytes]] = None,
+                     grant: Any = None) -> None:
+    """Run an ffmpeg command without blocking the event loop
+
+    ffmpeg's machine-readable progress is read from stdout line by line and each
+    completed block is passed to progress_callback. When input_stream is given
+    its chunks are written to ffmpeg's stdin (use 'pipe:0' as the input). A CPU
+    grant is bound to the process so it can be pinned to its cores. ffmpeg runs
+    in its own process group, which is terminated if the awaiting task is
+    cancelled.
+    """
+    cmd = [cmd[0], '-progress', 'pipe:1', '-nostats'] + cmd[1:]
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if input_stream else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+
+    if grant:
+        grant.attach(process.pid)
+
+    feeder_task = asyncio.create_task(feed_stdin(process, input_stream)) if input_stream else None
+
+    # Keep only the tail of stderr for error reporting; it must be drained
+    # concurrently or ffmpeg blocks once the pipe buffer fills up
+    stderr_tail = deque(maxlen=20)
+
+    async def drain_stderr():
+        async for line in process.stderr:
+            stderr_tail.append(line.decode(errors='replace').rstrip())
+
+    stderr_task = asyncio.create_task(drain_stderr())
+
+    try:
+        fields = {}
+        async for raw_line in process.stdout:
+            line = raw_line.decode(errors='replace').strip()
+            if '=' not in line:
+                continue
+
+            key, value = line.split('=', 1)
+            fields[key] = value
+
+            if key == 'progress':
+                if progress_callback:
+                    try:
+                        await progress_callback(build_progress(fields, duration))
+                    except Exception as e:
+                        logger.warning(f"Progress callback error: {e}")
+                fields = {}
+
+        await process.wait()
+        await stderr_task
+
+    finally:
+        if process.returncode is None:
+            await terminate_process_group(process)
+        if not stderr_task.done():
+            stderr_task.cancel()
+        if feeder_task and not feeder_task.done():
+            feeder_task.cancel()
+
+    if process.returncode != 0:
+        error_output = "\n".join(stderr_tail)
+        raise Exception(f"FFmpeg error: {error_output}")
+
+def segment_length(duration: float, workers: int, min_seconds: float) -> float:
+    """Chunk length giving roughly two chunks per worker for load balancing"""
+    return max(min_seconds, duration / (max(1, workers) * 2))
+
+async def transcode_segmented(input_file: str, output_file: str, resolution: str, quality_preset: str,
+                              format_type: str, workdir: str, pool: Any, owner: Any,
+                              watermark_text: Optional[str] = None, info: Optional[Dict[str, Any]] = None,
+                              min_segment_seconds: float = 30,
+                              progress_callback: Optional[ProgressCallback] = None, cpu: Any = None,
+                              resumable: bool = False) -> None:
+    """Encode a long source as keyframe-aligned chunks in parallel
+
+    The video is split with stream copy at keyframes, each chunk is encoded
+    with identical encoder settings while holding a slot from pool (and a
+    share of the cpu budget), the audio is handled once for the whole file,
+    and the pieces are joined with the concat demuxer without re-encoding.
+
+    When resumable, a cancelled run leaves workdir in place and a later run
+    with the same workdir reuses the split and every finished chunk; the
+    caller then owns removing workdir if the encode is abandoned.
+    """
+    plan = plan_transcode(info, resolution, format_type, watermark_text)
+    duration = info['duration'] if info else 0
+    os.makedirs(workdir, exist_ok=True)
+    keep_workdir = False
+
+    # Chunks shorter than a GOP would mostly be cut at the same keyframe
+    if info and info.get('keyframe_interval'):
+        min_segment_seconds = max(min_segment_seconds, 2 * info['keyframe_interval'])
+
+    try:
+        # Split at keyframes without re-encoding, unless a previous run already did
+        split_marker = os.path.join(workdir, 'split.done')
+        if os.path.exists(split_marker):
+            with open(split_marker) as f:
+                seg_len = float(f.read())
+        else:
+            seg_len = segment_length(duration, pool.size, min_segment_seconds)
+            await run_ffmpeg([
+                'ffmpeg', '-i', input_file, '-y', '-map', '0:v:0', '-c', 'copy', '-an',
+                '-f', 'segment', '-segment_time', f"{seg_len:.3f}", '-reset_timestamps', '1',
+                os.path.join(workdir, 'chunk_%04d.mkv')
+            ])
+            with open(split_marker, 'w') as f:
+                f.write(f"{seg_len:.3f}")
+        chunks = sorted(glob.glob(os.path.join(workdir, 'chunk_*.mkv')))
+
+        # Per-chunk progress, merged into one snapshot for the caller
+        chunk_progress: Dict[int, Dict[str, Any]] = {}
+
+        async def report(index: int, progress: Dict[str, Any]) -> None:
+            chunk_progress[index] = progress
+            if progress_callback:
+                active = [p for p in chunk_progress.values() if not p['done']]
+                merged = build_progress({}, duration)
+                merged.update({
+                    'out_time': sum(p['out_time'] for p in chunk_progress.values()),
+                    'fps': sum(p['fps'] for p in active),
+                    'speed': sum(p['speed'] for p in active),
+                    'total_size': sum(p['total_size'] for p in chunk_progress.values())
+                })
+                if duration:
+                    merged['percent'] = min(100.0, merged['out_time'] / duration * 100)
+                    if merged['speed'] > 0:
+                        merged['eta'] = max(0.0, (duration - merged['out_time']) / merged['speed'])
+                await progress_callback(merged)
+
+        async def encode_chunk(index: int, chunk: str) -> str:
+            encoded = os.path.join(workdir, f"enc_{index:04d}.mkv")
+            if os.path.exists(encoded):
+                # Finished by an earlier run
+                chunk_progress[index] = {**build_progress({'progress': 'end'}),
+                                         'out_time': min(seg_len, max(0.0, duration - index * seg_len)),
+                                         'total_size': os.path.getsize(encoded)}
+                return encoded
+            partial = os.path.join(workdir, f"enc_{index:04d}.part.mkv")
+
+            async with pool.slot(owner):
+                with cpu_grant(cpu) as grant:
+                    threads = grant.threads if grant else None
+                    cmd = ['ffmpeg', *thread_args(threads), '-i', chunk, '-y']
+                    filters = video_filters(plan, watermark_text)
+                    if filters:
+                        cmd.extend(['-vf', ','.join(filters)])
+                    cmd.extend(video_encoder_args(resolution, quality_preset, format_type, plan, threads))
+                    cmd.extend(['-an', partial])
+
+                    await run_ffmpeg(cmd, progress_callback=lambda p: report(index, p), grant=grant)
+            # Only complete chunks carry the final name, so a resumed run can trust them
+            os.replace(partial, encoded)
+            return encoded
+
+        async def encode_audio() -> Optional[str]:
+            if plan['audio'] == 'none':
+                return None
+            audio_file = os.path.join(workdir, 'audio.mka')
+            if os.path.exists(audio_file):
+                return audio_file
+            partial = os.path.join(workdir, 'audio.part.mka')
+            cmd = ['ffmpeg', '-i', input_file, '-y', '-vn', '-map', '0:a:0']
+            cmd.extend(audio_encoder_args(format_type, plan))
+            cmd.append(partial)
+            async with pool.slot(owner):
+                await run_ffmpeg(cmd)
+            os.replace(partial, audio_file)
+            return audio_file
+
+        tasks = [asyncio.ensure_future(encode_audio())]
+        tasks += [asyncio.ensure_future(encode_chunk(index, chunk)) for index, chunk in enumerate(chunks)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # One chunk failed or we were cancelled: stop the rest before cleanup
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        audio_file, encoded_chunks = results[0], results[1:]
+
+        # Join the chunks back together with stream copy
+        list_file = os.path.join(workdir, 'concat.txt')
+        with open(list_file, 'w') as f:
+            for encoded in encoded_chunks:
+                f.write(f"file '{os.path.abspath(encoded)}'\n")
+
+        cmd = ['ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_file, '-y']
+        if audio_file:
+            cmd.extend(['-i', audio_file, '-map', '0:v:0', '-map', '1:a:0'])
+        cmd.extend(['-c', 'copy', *CONTAINER_ARGS.get(format_type, []), output_file])
+        await run_ffmpeg(cmd)
+
+    except asyncio.CancelledError:
+        keep_workdir = resumable
+        raise
+
+    finally:
+        if not keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+async def transcode_file(input_file: str, output_file: str, resolution: str, quality_preset: str,
+                         format_type: str, watermark_text: Optional[str] = None,
+                         info: Optional[Dict[str, Any]] = None, pool: Any = None, temp_dir: str = 'temp',
+                         segment_min_duration: float = 0, min_segment_seconds: float = 30,
+                         progress_callback: Optional[ProgressCallback] = None,
+                         input_stream: Optional[AsyncIterator[bytes]] = None, cpu: Any = None,
+                         workdir: Optional[str] = None) -> None:
+    """Encode one rendition, in parallel chunks when the source is long enough
+
+    Segmenting needs a pool, a seekable input and a video encode (stream copy
+    is already fast); everything else runs as a single ffmpeg process. Every
+    encoding process draws its threads from the cpu budget when one is given.
+    Passing a fixed workdir makes a cancelled segmented encode resumable.
+    """
+    plan = plan_transcode(info, resolution, format_type, watermark_text)
+    duration = info['duration'] if info else None
+
+    if (plan['video'] == 'encode' and pool and segment_min_duration and duration
+            and duration >= segment_min_duration and not input_stream):
+        await transcode_segmented(
+            input_file, output_file, resolution, quality_preset, format_type,
+            workdir=workdir or os.path.join(temp_dir, uuid.uuid4().hex),
+            pool=pool, owner=output_file,
+            watermark_text=watermark_text, info=info,
+            min_segment_seconds=min_segment_seconds,
+            progress_callback=progress_callback,
+            cpu=cpu, resumable=workdir is not None
+        )
+        return
+
+    # Stream copies barely use the CPU and take no share of it
+    with cpu_grant(cpu if plan['video'] == 'encode' else None) as grant:
+        cmd = build_transcode_command(
+            input_file, output_file, resolution, quality_preset, format_type,
+            watermark_text=watermark_text,
+            info=info,
+            threads=grant.threads if grant else None
+        )
+        await run_ffmpeg(cmd, duration=duration, progress_callback=progress_callback,
+                         input_stream=input_stream, grant=grant)
+
+async def transcode_renditions(input_file: str, outputs: List[Tuple[str, str, str]], quality_preset: str,
+                               watermark_text: Optional[str] = None, info: Optional[Dict[str, Any]] = None,
+                               progress_callback: Optional[ProgressCallback] = None,
+                               input_stream: Optional[AsyncIterator[bytes]] = None, cpu: Any = None) -> None:
+    """Encode several renditions from one decode of the source in a single ffmpeg run"""
+    with cpu_grant(cpu) as grant:
+        cmd = build_batch_command(
+            input_file, outputs, quality_preset,
+            watermark_text=watermark_text,
+            info=info,
+            threads=grant.threads if grant else None
+        )
+        await run_ffmpeg(cmd, duration=info['duration'] if info else None, progress_callback=progress_callback,
+                         input_stream=input_stream, grant=grant)
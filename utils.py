@@ -2,8 +2,6 @@
 Utility functions for the video encoder bot
 """
 import os
-import json
-import subprocess
 import logging
 from typing import Dict, Optional, Any
 
@@ -34,51 +32,6 @@ def format_duration(seconds: float) -> str:
     else:
         return f"{minutes:02d}:{secs:02d}"
 
-def get_video_info(file_path: str) -> Optional[Dict[str, Any]]:
-    """Extract video information using ffprobe"""
-    try:
-        cmd = [
-            'ffprobe', '-v', 'quiet', '-print_format', 'json',
-            '-show_format', '-show_streams', file_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            video_stream = next((s for s in data['streams'] if s['codec_type'] == 'video'), None)
-            audio_stream = next((s for s in data['streams'] if s['codec_type'] == 'audio'), None)
-            
-            if video_stream:
-                info = {
-                    'duration': float(data['format'].get('duration', 0)),
-                    'width': int(video_stream.get('width', 0)),
-                    'height': int(video_stream.get('height', 0)),
-                    'video_codec': video_stream.get('codec_name', 'unknown'),
-                    'bitrate': int(data['format'].get('bit_rate', 0)),
-                    'fps': eval(video_stream.get('r_frame_rate', '0/1')) if video_stream.get('r_frame_rate') else 0,
-                    'has_audio': audio_stream is not None
-                }
-                
-                if audio_stream:
-                    info['audio_codec'] = audio_stream.get('codec_name', 'unknown')
-                    info['audio_bitrate'] = int(audio_stream.get('bit_rate', 0))
-                
-                return info
-                
-    except Exception as e:
-        logger.error(f"Error getting video info for {file_path}: {e}")
-    
-    return None
-
-def validate_video_file(file_path: str) -> bool:
-    """Validate if file is a valid video"""
-    try:
-        info = get_video_info(file_path)
-        return info is not None and info.get('duration', 0) > 0
-    except Exception:
-        return False
-
 def clean_filename(filename: str) -> str:
     """Clean filename for safe file operations"""
     import re
@@ -91,30 +44,6 @@ def clean_filename(filename: str) -> str:
     
     return filename or "video"
 
-def estimate_processing_time(duration: float, resolution: str, quality: str) -> float:
-    """Estimate processing time based on video properties"""
-    # Base processing time (seconds per second of video)
-    base_multiplier = {
-        '240p': 0.5,
-        '360p': 0.7,
-        '480p': 1.0,
-        '720p': 1.5,
-        '1080p': 2.5
-    }
-    
-    quality_multiplier = {
-        'ultrafast': 0.3,
-        'fast': 0.7,
-        'medium': 1.0,
-        'slow': 1.8,
-        'veryslow': 3.0
-    }
-    
-    base = base_multiplier.get(resolution, 1.0)
-    quality_mult = quality_multiplier.get(quality, 1.0)
-    
-    return duration * base * quality_mult
-
 def check_disk_space(required_bytes: int, path: str = ".") -> bool:
     """Check if there's enough disk space"""
     try:
@@ -0,0 +1,206 @@
+"""
+Encoder worker for the video encoder bot
+
+Run `python worker.py` on any host that mounts the bot's STORAGE_DIR. A
+worker leases encode jobs from the shared queue, runs ffmpeg and reports
+progress back through the database; it needs no Telegram credentials.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import Config
+from encoders import ENCODERS
+from cpubudget import CpuBudget, available_cores
+from estimator import ProcessingEstimator
+from scheduler import ChunkPool
+from store import Store
+from transcoder import ProgressCallback, transcode_file, transcode_renditions
+from workqueue import EncodeQueue, from_storage_path
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def local_path(path: str) -> str:
+    return from_storage_path(path, Config.STORAGE_DIR)
+
+def rendition_list(kind: str, payload: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """(resolution, format) of every rendition an encode job produces"""
+    if kind == 'batch':
+        return [(resolution, format_type) for _, resolution, format_type in payload['outputs']]
+    return [(payload['resolution'], payload['format'])]
+
+def output_paths(kind: str, payload: Dict[str, Any]) -> List[str]:
+    """Files an encode job writes"""
+    if kind == 'batch':
+        return [local_path(path) for path, _, _ in payload['outputs']]
+    return [local_path(payload['output'])]
+
+async def execute_encode(kind: str, payload: Dict[str, Any], pool: Any, cpu: Any = None,
+                         progress_callback: Optional[ProgressCallback] = None) -> None:
+    """Run one encode job as described by the front-end's payload"""
+    info = payload['info']
+
+    if kind == 'single':
+        await transcode_file(
+            local_path(payload['input']), local_path(payload['output']),
+            payload['resolution'], payload['quality'], payload['format'],
+            watermark_text=payload['watermark_text'], info=info,
+            pool=pool, temp_dir=Config.TEMP_DIR,
+            segment_min_duration=Config.SEGMENT_MIN_DURATION,
+            min_segment_seconds=Config.SEGMENT_MIN_SECONDS,
+            progress_callback=progress_callback,
+            cpu=cpu
+        )
+    elif kind == 'batch':
+        outputs = [(local_path(path), resolution, format_type)
+                   for path, resolution, format_type in payload['outputs']]
+        await transcode_renditions(
+            local_path(payload['input']), outputs, payload['quality'],
+            watermark_text=payload['watermark_text'], info=info,
+            progress_callback=progress_callback, cpu=cpu
+        )
+    else:
+        raise ValueError(f"Unknown encode job kind: {kind}")
+
+class EncodeWorker:
+    """Leases jobs from the encode queue and runs them, keeping their leases alive
+
+    The lease is renewed every heartbeat_interval seconds together with the
+    latest progress snapshot. If renewing fails (the job was cancelled, or the
+    lease expired and went to another worker) the encode is stopped.
+    """
+
+    def __init__(self, queue: EncodeQueue, worker_id: str, concurrency: int = 1,
+                 lease_seconds: float = 60, heartbeat_interval: float = 5, poll_interval: float = 1,
+                 estimator: Optional[ProcessingEstimator] = None):
+        self.queue = queue
+        self.estimator = estimator
+        self.worker_id = worker_id
+        self.concurrency = max(1, concurrency)
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.pool = ChunkPool(len(available_cores(Config.CPU_CORES)) // self.concurrency)
+        self.cpu = CpuBudget(Config.CPU_CORES, pin=Config.CPU_AFFINITY,
+                             expected=self.concurrency + self.pool.size)
+        self.active = 0
+
+    async def run(self) -> None:
+        logger.info(f"Encoder worker {self.worker_id} started with {self.concurrency} slot(s)")
+        slots = [asyncio.create_task(self._slot()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*slots)
+        finally:
+            for slot in slots:
+                slot.cancel()
+            await asyncio.gather(*slots, return_exceptions=True)
+
+    async def _slot(self) -> None:
+        while True:
+            job = self.queue.lease(self.worker_id, self.lease_seconds)
+            if job is None:
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self._execute(job)
+
+    def _remove_outputs(self, job: Dict[str, Any]) -> None:
+        for path in output_paths(job['kind'], job['payload']):
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def _execute(self, job: Dict[str, Any]) -> None:
+        job_id = job['job_id']
+        latest = {}
+
+        async def progress(snapshot):
+            latest['progress'] = snapshot
+
+        logger.info(f"Worker {self.worker_id} leased {job['kind']} job {job_id} (attempt {job['attempts']})")
+        start_time = time.time()
+        self.active += 1
+        concurrent = self.active
+        task = asyncio.create_task(execute_encode(job['kind'], job['payload'], self.pool, self.cpu, progress))
+
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=self.heartbeat_interval)
+                if task.done():
+                    break
+                if not self.queue.heartbeat(job_id, self.worker_id, self.lease_seconds, latest.pop('progress', None)):
+                    logger.warning(f"Job {job_id} was cancelled or its lease was lost; stopping encode")
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    self._remove_outputs(job)
+                    return
+            task.result()
+
+        except asyncio.CancelledError:
+            # Worker shutdown: hand the job to another worker
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self._remove_outputs(job)
+            self.queue.release(job_id, self.worker_id)
+            raise
+
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            self._remove_outputs(job)
+            self.queue.fail(job_id, self.worker_id, str(e))
+            return
+
+        finally:
+            self.active -= 1
+
+        # Record before completing, so the waiting front-end reloads fresh calibration
+        if self.estimator:
+            payload = job['payload']
+            self.estimator.record(payload['info'], rendition_list(job['kind'], payload), payload['quality'],
+                                  concurrent, time.time() - start_time)
+
+        self.queue.complete(job_id, self.worker_id)
+        logger.info(f"Job {job_id} finished")
+
+async def main(args: argparse.Namespace) -> None:
+    """Serve the encode queue until interrupted"""
+    Config.create_directories()
+    await ENCODERS.detect()
+    store = Store(Config.DATABASE_PATH)
+    worker = EncodeWorker(
+        EncodeQueue(store),
+        args.id or f"{socket.gethostname()}-{os.getpid()}",
+        concurrency=args.concurrency,
+        lease_seconds=Config.WORKER_LEASE_SECONDS,
+        heartbeat_interval=Config.WORKER_HEARTBEAT_INTERVAL,
+        poll_interval=Config.WORKER_POLL_INTERVAL,
+        estimator=ProcessingEstimator(store, Config.WATERMARK_TEXT)
+    )
+
+    # Stop cleanly on SIGTERM too, so leased jobs are released right away
+    main_task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, main_task.cancel)
+
+    try:
+        await worker.run()
+    except asyncio.CancelledError:
+        logger.info(f"Encoder worker {worker.worker_id} stopped")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encoder worker for the video encoder bot")
+    parser.add_argument('--id', help="Worker name shown in leases (default: host-pid)")
+    parser.add_argument('--concurrency', type=int, default=Config.WORKER_CONCURRENCY,
+                        help="Jobs encoded at the same time")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,208 @@
+"""
+Durable encode job queue shared by the bot front-end and encoder workers
+"""
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from store import Store
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS encode_jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    progress TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_encode_jobs_state ON encode_jobs (state, created);
+"""
+
+# Job states; the last three are final
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINAL_STATES = (DONE, FAILED, CANCELLED)
+
+def to_storage_path(path: str, storage_dir: str) -> str:
+    """Path relative to the storage directory, as stored in job payloads
+
+    Hosts may mount the shared storage at different places, so payloads never
+    carry absolute paths.
+    """
+    return os.path.relpath(path, storage_dir or os.curdir)
+
+def from_storage_path(path: str, storage_dir: str) -> str:
+    return os.path.join(storage_dir, path)
+
+class EncodeQueue:
+    """Encode jobs in SQLite, handed to workers under time-limited leases
+
+    A worker owns a job only while it keeps renewing the lease with
+    heartbeat(). When a worker dies its lease runs out and the job is queued
+    again for the next worker, until max_attempts leases have been spent.
+    Every state change happens inside one write transaction, so any number of
+    worker processes can share the database file.
+    """
+
+    def __init__(self, store: Store):
+        self._store = store
+        with store.transaction() as conn:
+            for statement in SCHEMA.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+
+    @staticmethod
+    def _decode(row: Any) -> Dict[str, Any]:
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        return job
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], max_attempts: int = 3) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._store.transaction() as conn:
+            conn.execute(
+                "INSERT INTO encode_jobs (job_id, kind, payload, state, max_attempts, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), QUEUED, max(1, max_attempts), now, now)
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._store.execute("SELECT * FROM encode_jobs WHERE job_id = ?", (job_id,))
+        return self._decode(rows[0]) if rows else None
+
+    def lease(self, worker_id: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        """Claim the oldest runnable job, reclaiming leases of dead workers first"""
+        now = time.time()
+        with self._store.transaction() as conn:
+            conn.execute(
+                "UPDATE encode_jobs SET state = ?, worker = NULL, updated = ? "
+                "WHERE state = ? AND lease_expires < ? AND attempts < max_attempts",
+                (QUEUED, now, LEASED, now)
+            )
+            conn.execute(
+                "UPDATE encode_jobs SET state = ?, error = 'Worker lease expired too many times', updated = ? "
+                "WHERE state = ? AND lease_expires < ?",
+                (FAILED, now, LEASED, now)
+            )
+
+            row = conn.execute(
+                "SELECT job_id FROM encode_jobs WHERE state = ? ORDER BY created LIMIT 1", (QUEUED,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            conn.execute(
+                "UPDATE encode_jobs SET state = ?, worker = ?, attempts = attempts + 1, "
+                "lease_expires = ?, updated = ? WHERE job_id = ?",
+                (LEASED, worker_id, now + lease_seconds, now, row['job_id'])
+            )
+            job = conn.execute("SELECT * FROM encode_jobs WHERE job_id = ?", (row['job_id'],)).fetchone()
+
+        return self._decode(job)
+
+    def heartbeat(self, job_id: str, worker_id: str, lease_seconds: float,
+                  progress: Optional[Dict[str, Any]] = None) -> bool:
+        """Extend the lease and publish progress; False once the job is no longer ours"""
+        now = time.time()
+        with self._store.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE encode_jobs SET lease_expires = ?, progress = COALESCE(?, progress), updated = ? "
+                "WHERE job_id = ? AND worker = ? AND state = ?",
+                (now + lease_seconds, json.dumps(progress) if progress else None, now, job_id, worker_id, LEASED)
+            )
+            return cursor.rowcount > 0
+
+    def complete(self, job_id: str, worker_id: str) -> bool:
+        now = time.time()
+        with self._store.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE encode_jobs SET state = ?, worker = NULL, error = NULL, updated = ? "
+                "WHERE job_id = ? AND worker = ? AND state = ?",
+                (DONE, now, job_id, worker_id, LEASED)
+            )
+            return cursor.rowcount > 0
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """Record a failed attempt; the job is retried while attempts remain"""
+        now = time.time()
+        with self._store.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE encode_jobs SET state = CASE WHEN attempts < max_attempts THEN ? ELSE ? END, "
+                "worker = NULL, error = ?, updated = ? WHERE job_id = ? AND worker = ? AND state = ?",
+                (QUEUED, FAILED, error, now, job_id, worker_id, LEASED)
+            )
+            return cursor.rowcount > 0
+
+    def release(self, job_id: str, worker_id: str) -> bool:
+        """Give a job back without counting the attempt, e.g. on worker shutdown"""
+        now = time.time()
+        with self._store.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE encode_jobs SET state = ?, worker = NULL, attempts = attempts - 1, updated = ? "
+                "WHERE job_id = ? AND worker = ? AND state = ?",
+                (QUEUED, now, job_id, worker_id, LEASED)
+            )
+            return cursor.rowcount > 0
+
+    def cancel(self, job_id: str) -> None:
+        """Withdraw a job; a worker running it notices at its next heartbeat"""
+        now = time.time()
+        with self._store.transaction() as conn:
+            conn.execute(
+                "UPDATE encode_jobs SET state = ?, updated = ? WHERE job_id = ? AND state IN (?, ?)",
+                (CANCELLED, now, job_id, QUEUED, LEASED)
+            )
+
+    def cancel_all(self) -> int:
+        """Withdraw every unfinished job; used when the front-end restarts"""
+        now = time.time()
+        with self._store.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE encode_jobs SET state = ?, updated = ? WHERE state IN (?, ?)",
+                (CANCELLED, now, QUEUED, LEASED)
+            )
+            return cursor.rowcount
+
+    def remove(self, job_id: str) -> None:
+        self._store.execute("DELETE FROM encode_jobs WHERE job_id = ?", (job_id,))
+
+    def purge(self, older_than: float) -> int:
+        """Delete final jobs last updated before the given timestamp"""
+        with self._store.transaction() as conn:
+            cursor = conn.execute(
+                f"DELETE FROM encode_jobs WHERE state IN ({', '.join('?' * len(FINAL_STATES))}) AND updated < ?",
+                (*FINAL_STATES, older_than)
+            )
+            return cursor.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs in each state"""
+        rows = self._store.execute("SELECT state, COUNT(*) AS jobs FROM encode_jobs GROUP BY state")
+        return {row['state']: row['jobs'] for row in rows}
+
+    def workers(self) -> List[str]:
+        """Workers currently holding a live lease"""
+        rows = self._store.execute(
+            "SELECT DISTINCT worker FROM encode_jobs WHERE state = ? AND lease_expires >= ?",
+            (LEASED, time.time())
+        )
+        return [row['worker'] for row in rows]